@@ -0,0 +1,44 @@
+"""
+ACL check benchmark.
+
+Compares checking a topic against the allowed topics of a device with topic_ac, as done before ACL compilation,
+with a compiled TopicMatcher and with a decision cache lookup.
+
+Usage: python -m benchmarks.bench_acl
+"""
+import timeit
+
+from hbmqtt.plugins.topic_checking import TopicAccessControlListPlugin, TopicMatcher
+from hbmqtt.utils import LRUCache
+
+
+USER = {
+    'acl_publish_all': ['user42/config'] + ['user42/shared/%d/#' % index for index in range(20)],
+    'acl_publish': {'device42': ['user42/device42/#', 'user42/+/status']},
+}
+TOPIC = 'user42/device42/telemetry'
+
+
+def topic_ac_check():
+    allowed_topics = USER['acl_publish_all'] + USER['acl_publish']['device42']
+    for allowed_topic in allowed_topics:
+        if TopicAccessControlListPlugin.topic_ac(TOPIC, allowed_topic):
+            return True
+    return False
+
+
+def main():
+    matcher = TopicMatcher(USER['acl_publish_all'] + USER['acl_publish']['device42'])
+    decisions = LRUCache(10000)
+    decisions.put(('user42', 'device42', True, TOPIC), True)
+    assert topic_ac_check() and matcher.allows(TOPIC)
+    runs = 100000
+    for label, check in (('topic_ac', topic_ac_check),
+                         ('compiled matcher', lambda: matcher.allows(TOPIC)),
+                         ('decision cache', lambda: decisions.get(('user42', 'device42', True, TOPIC)))):
+        elapsed = timeit.timeit(check, number=runs) / runs
+        print("%18s %10.2f us/check" % (label, elapsed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Device provisioning benchmark.
+
+Adds devices one at a time to a user, as done by the 'add_device' config command, with the YAML and SQLite
+identity stores. The YAML store rewrites the whole file for each device.
+
+Usage: python -m benchmarks.bench_identities [devices]
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from hbmqtt.identities import YamlIdentityStore, SQLiteIdentityStore
+
+
+DEVICES = 200
+KEY_HASH = '$5$rounds=535000$' + 'x' * 59
+
+
+@asyncio.coroutine
+def provision(store, devices):
+    yield from store.add_user('user', KEY_HASH, 'device0', KEY_HASH)
+    start = time.monotonic()
+    for index in range(1, devices):
+        yield from store.add_device('user', 'device%d' % index, KEY_HASH)
+        yield from store.add_acl('user', {'acl_publish': {'device%d' % index: ['user/device%d/#' % index]}})
+    elapsed = time.monotonic() - start
+    yield from store.close()
+    return elapsed
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else DEVICES
+    directory = tempfile.mkdtemp()
+    loop = asyncio.get_event_loop()
+    try:
+        print("%8s %14s %16s" % ("store", "total (s)", "per device (ms)"))
+        for label, store in (('yaml', YamlIdentityStore(os.path.join(directory, 'users.yaml'))),
+                             ('sqlite', SQLiteIdentityStore(os.path.join(directory, 'identities.db')))):
+            elapsed = loop.run_until_complete(provision(store, devices))
+            print("%8s %14.2f %16.3f" % (label, elapsed, elapsed / devices * 1e3))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
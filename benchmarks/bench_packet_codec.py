@@ -0,0 +1,90 @@
+"""
+Packet decoding benchmark.
+
+For each packet type, compares decoding the packet field by field from a stream, as done before packets were read
+at once, with reading the rest of the packet at once after its fixed header, and with decoding it from memory with
+from_bytes(). Streams are asyncio stream readers already fed with the packet, as for TCP connections, which never
+suspend.
+
+Usage: python -m benchmarks.bench_packet_codec
+"""
+import asyncio
+import timeit
+
+from hbmqtt.adapters import StreamReaderAdapter
+from hbmqtt.mqtt import (
+    ConnectPacket, ConnackPacket, PublishPacket, PubackPacket, PubrecPacket, PubrelPacket, PubcompPacket,
+    SubscribePacket, SubackPacket, UnsubscribePacket, UnsubackPacket, PingReqPacket, PingRespPacket,
+    DisconnectPacket)
+from hbmqtt.mqtt.connect import ConnectVariableHeader, ConnectPayload
+
+
+def build_packets():
+    connect_header = ConnectVariableHeader(keep_alive=60)
+    connect_header.clean_session_flag = True
+    connect_header.username_flag = True
+    connect_header.password_flag = True
+    return [
+        ConnectPacket(vh=connect_header, payload=ConnectPayload('device42', None, None, 'user42-device42', 'key')),
+        ConnackPacket.build(0, 0),
+        PublishPacket.build('user42/device42/telemetry', b'{"temperature": 21.5}', None, False, 0, False),
+        PublishPacket.build('user42/device42/telemetry', b'x' * 4096, 42, False, 1, False),
+        PublishPacket.build('user42/device42/firmware', b'x' * 65536, 42, False, 1, False),
+        PubackPacket.build(42),
+        PubrecPacket.build(42),
+        PubrelPacket.build(42),
+        PubcompPacket.build(42),
+        SubscribePacket.build([('user42/device42/#', 1), ('user42/+/config', 0)], 42),
+        SubackPacket.build(42, [1, 0]),
+        UnsubscribePacket.build(['user42/device42/#'], 42),
+        UnsubackPacket.build(42),
+        PingReqPacket(),
+        PingRespPacket(),
+        DisconnectPacket(),
+    ]
+
+
+def stream_reader(data, loop):
+    reader = asyncio.StreamReader(loop=loop)
+    reader.feed_data(data)
+    return StreamReaderAdapter(reader)
+
+
+def run(coro):
+    # Data is already fed to readers, run the coroutine to its end
+    try:
+        coro.send(None)
+    except StopIteration as result:
+        return result.value
+    raise RuntimeError("Coroutine suspended")
+
+
+@asyncio.coroutine
+def decode_fields(cls, reader):
+    # Decoding before packets were read at once
+    fixed_header = yield from cls.FIXED_HEADER.from_stream(reader)
+    variable_header = None
+    if cls.VARIABLE_HEADER:
+        variable_header = yield from cls.VARIABLE_HEADER.from_stream(reader, fixed_header)
+    return (yield from cls._from_stream_fields(reader, fixed_header, variable_header))
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    runs = 20000
+    print("%28s %8s %14s %14s %14s" % ("packet", "bytes", "fields (us)", "stream (us)", "from_bytes (us)"))
+    for packet in build_packets():
+        cls = type(packet)
+        data = bytes(packet.to_bytes())
+        label = cls.__name__
+        if cls is PublishPacket:
+            label += ' QoS %d' % packet.qos
+        fields_time = timeit.timeit(lambda: run(decode_fields(cls, stream_reader(data, loop))), number=runs) / runs
+        stream_time = timeit.timeit(lambda: run(cls.from_stream(stream_reader(data, loop))), number=runs) / runs
+        bytes_time = timeit.timeit(lambda: cls.from_bytes(data), number=runs) / runs
+        print("%28s %8d %14.2f %14.2f %14.2f" % (label, len(data), fields_time * 1e6, stream_time * 1e6,
+                                                  bytes_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
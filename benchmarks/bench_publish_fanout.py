@@ -0,0 +1,51 @@
+"""
+PUBLISH fan-out encoding benchmark.
+
+Compares the cost of serializing one message for N subscribers by building and encoding a PUBLISH packet per
+subscriber, with encoding a shared PublishFrame once and patching the packet ID for each subscriber. The frame is
+measured as written by the broker handler, with an outgoing message per subscriber, with and without building the
+PUBLISH packet of each message.
+
+Usage: python -m benchmarks.bench_publish_fanout
+"""
+import timeit
+
+from hbmqtt.mqtt.constants import QOS_1
+from hbmqtt.mqtt.publish import PublishFrame
+from hbmqtt.session import OutgoingApplicationMessage
+
+
+TOPIC = 'user42/device42/telemetry'
+SUBSCRIBERS = 100
+
+
+def per_subscriber(data):
+    for packet_id in range(1, SUBSCRIBERS + 1):
+        message = OutgoingApplicationMessage(packet_id, TOPIC, QOS_1, data, False)
+        message.build_publish_packet().to_bytes()
+
+
+def shared_frame(data, build_packet=False):
+    frame = PublishFrame(TOPIC, data, QOS_1)
+    for packet_id in range(1, SUBSCRIBERS + 1):
+        message = OutgoingApplicationMessage(packet_id, TOPIC, QOS_1, data, False, frame)
+        if build_packet:
+            # Before PUBLISH packets of messages sent from a frame were built lazily
+            message.publish_packet = message.build_publish_packet()
+        frame.to_buffers(packet_id)
+        message.frame_sent()
+
+
+def main():
+    print("%12s %22s %22s %22s" % ("payload", "per subscriber (us)", "frame + packet (us)", "shared frame (us)"))
+    for size in (64, 4096, 16384, 65536):
+        data = b'x' * size
+        runs = 200
+        legacy_time = timeit.timeit(lambda: per_subscriber(data), number=runs) / runs
+        packet_time = timeit.timeit(lambda: shared_frame(data, True), number=runs) / runs
+        frame_time = timeit.timeit(lambda: shared_frame(data), number=runs) / runs
+        print("%12d %22.1f %22.1f %22.1f" % (size, legacy_time * 1e6, packet_time * 1e6, frame_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Retained messages store benchmark.
+
+Measures the cost of logging retained message changes, including snapshot compactions, and the time taken by a
+broker to restore them on start.
+
+Usage: python -m benchmarks.bench_retained_restore [topics]
+"""
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from hbmqtt.broker import Broker
+from hbmqtt.retained import RetainedMessageStore
+
+
+TOPICS = 1000000
+PAYLOAD = b'{"firmware": "1.2.3", "interval": 60}'
+
+
+def broker_config(directory):
+    password_file = os.path.join(directory, 'users.yaml')
+    return {
+        'listeners': {'default': {'type': 'tcp'}},
+        'sys_interval': 0,
+        'auth': {'password-file': password_file, 'allow-anonymous': True},
+        'topic-check': {'enabled': False, 'acl': {'file': password_file}},
+        'retained-dir': os.path.join(directory, 'retained'),
+    }
+
+
+def main():
+    topics = int(sys.argv[1]) if len(sys.argv) > 1 else TOPICS
+    logging.basicConfig(level=logging.WARNING)
+    directory = tempfile.mkdtemp()
+    loop = asyncio.get_event_loop()
+    try:
+        store = RetainedMessageStore(broker_config(directory)['retained-dir'])
+        store.load()
+        start = time.monotonic()
+        for index in range(topics):
+            store.set('user%d/device%d/config' % (index // 10, index), PAYLOAD, 1)
+        # Update them all once more, triggering compactions of a large store
+        for index in range(topics):
+            store.set('user%d/device%d/config' % (index // 10, index), PAYLOAD, 1)
+        elapsed = time.monotonic() - start
+        store.close()
+        print("retain: %.2f us/message" % (elapsed / (2 * topics) * 1e6))
+
+        broker = Broker(broker_config(directory))
+        start = time.monotonic()
+        loop.run_until_complete(broker.start())
+        elapsed = time.monotonic() - start
+        print("%d retained messages restored in %.2f s" % (len(broker._retained_messages), elapsed))
+        loop.run_until_complete(broker.shutdown())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
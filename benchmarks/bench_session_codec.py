@@ -0,0 +1,58 @@
+"""
+Session state encoding benchmark.
+
+Compares the size and the encode/decode time of the state of a persistent session with the binary session codec,
+with pickle of the same state and with pickle of the session message objects, as saved before the codec.
+
+Usage: python -m benchmarks.bench_session_codec
+"""
+import pickle
+import timeit
+
+from hbmqtt.session import Session, OutgoingApplicationMessage
+from hbmqtt.session_codec import encode_state, decode_state
+
+
+INFLIGHT = 20
+OFFLINE = 100
+PAYLOAD_SIZE = 200
+
+
+def build_session():
+    session = Session()
+    session.client_id = 'device42'
+    session.username = 'user42-device42'
+    payloads = [bytes([index]) * PAYLOAD_SIZE for index in range(5)]
+    for index in range(INFLIGHT):
+        message = OutgoingApplicationMessage(session.next_packet_id, 'user42/device42/telemetry/%d' % index, 1,
+                                             payloads[index % len(payloads)], False)
+        message.publish_packet = message.build_publish_packet()
+        session.inflight_out[message.packet_id] = message
+    for index in range(OFFLINE):
+        session.retained_messages.put_nowait(
+            OutgoingApplicationMessage(None, 'user42/device42/config', 1, payloads[index % len(payloads)], False))
+    return session
+
+
+def main():
+    session = build_session()
+    state = session.persistent_state()
+    # Offline messages of an OverloadQueue aren't part of the state, add them as the offline store would
+    state['messages'] = [(message.topic, message.data, message.qos) for message in session.retained_messages._queue]
+    objects = {'inflight_out': session.inflight_out, 'messages': list(session.retained_messages._queue)}
+    assert decode_state(encode_state(state)) == state
+
+    runs = 1000
+    print("%24s %10s %14s %14s" % ("encoding", "bytes", "encode (us)", "decode (us)"))
+    for label, encode, decode in (('session codec', encode_state, decode_state),
+                                  ('pickle state', pickle.dumps, pickle.loads),
+                                  ('pickle message objects', pickle.dumps, pickle.loads)):
+        value = objects if label == 'pickle message objects' else state
+        data = encode(value)
+        encode_time = timeit.timeit(lambda: encode(value), number=runs) / runs
+        decode_time = timeit.timeit(lambda: decode(data), number=runs) / runs
+        print("%24s %10d %14.1f %14.1f" % (label, len(data), encode_time * 1e6, decode_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
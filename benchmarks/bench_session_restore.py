@@ -0,0 +1,68 @@
+"""
+Persistent sessions restore benchmark.
+
+Saves sessions with the SQLite persistence plugin, then measures the start time of a broker restoring them. Only
+subscriptions are loaded at start, the state of a session is loaded when its client reconnects.
+
+Usage: python -m benchmarks.bench_session_restore [sessions]
+"""
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from hbmqtt.broker import Broker
+from hbmqtt.session import Session
+
+
+SESSIONS = 100000
+SUBSCRIPTIONS = 2
+
+
+def broker_config(directory):
+    password_file = os.path.join(directory, 'users.yaml')
+    return {
+        'listeners': {'default': {'type': 'tcp'}},
+        'sys_interval': 0,
+        'auth': {'password-file': password_file, 'allow-anonymous': True},
+        'topic-check': {'enabled': False, 'acl': {'file': password_file}},
+        'persistence': {'file': os.path.join(directory, 'sessions.db')},
+    }
+
+
+@asyncio.coroutine
+def save_sessions(broker, sessions):
+    plugin = broker.plugins_manager.get_plugin('persistence').object
+    saves = []
+    for index in range(sessions):
+        session = Session()
+        session.client_id = 'device%d' % index
+        subscriptions = [('user%d/device%d/%d' % (index, index, sub), 1) for sub in range(SUBSCRIPTIONS)]
+        saves.append(plugin.save_session(session, subscriptions, session.persistent_state()))
+    yield from asyncio.gather(*saves)
+    yield from plugin.on_broker_post_shutdown()
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else SESSIONS
+    logging.basicConfig(level=logging.WARNING)
+    directory = tempfile.mkdtemp()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(save_sessions(Broker(broker_config(directory)), sessions))
+        broker = Broker(broker_config(directory))
+        start = time.monotonic()
+        loop.run_until_complete(broker.start())
+        elapsed = time.monotonic() - start
+        restored = len(broker._unloaded_sessions)
+        print("%d sessions restored in %.2f s (%.1f us/session)" % (restored, elapsed, elapsed / max(restored, 1) * 1e6))
+        loop.run_until_complete(broker.shutdown())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
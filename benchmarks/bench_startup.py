@@ -0,0 +1,86 @@
+"""
+Broker startup benchmark.
+
+Runs fresh Python processes and reports the time taken to import hbmqtt.broker, and the time from process start
+until a first client connection is accepted (CONNACK received) by a broker with a TCP listener.
+
+Usage: python -m benchmarks.bench_startup [runs]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.bench_connect_storm import write_password_file
+
+
+PORT = 18892
+RUNS = 5
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import hbmqtt.broker
+print(time.perf_counter() - start)
+"""
+
+CONNECT_SCRIPT = """
+import time
+start = time.perf_counter()
+import asyncio
+from hbmqtt.broker import Broker
+
+
+def mqtt_string(value):
+    return len(value).to_bytes(2, 'big') + value
+
+
+@asyncio.coroutine
+def first_connection(password_file, port):
+    config = {
+        'listeners': {'default': {'type': 'tcp', 'bind': '127.0.0.1:%%d' %% port}},
+        'sys_interval': 0,
+        'auth': {'password-file': password_file, 'allow-anonymous': True},
+        'topic-check': {'enabled': False, 'acl': {'file': password_file}},
+    }
+    broker = Broker(config)
+    yield from broker.start()
+    reader, writer = yield from asyncio.open_connection('127.0.0.1', port)
+    # CONNECT, clean session with username and password
+    body = mqtt_string(b'MQTT') + bytes((4, 0xC2)) + (60).to_bytes(2, 'big') + \\
+        mqtt_string(b'startup') + mqtt_string(b'user0-dev') + mqtt_string(b'pw-key')
+    writer.write(bytes((0x10, len(body))) + body)
+    connack = yield from reader.readexactly(4)
+    elapsed = time.perf_counter() - start
+    assert connack[3] == 0, "connection refused: %%d" %% connack[3]
+    writer.close()
+    yield from broker.shutdown()
+    return elapsed
+
+print(asyncio.get_event_loop().run_until_complete(first_connection(%r, %d)))
+"""
+
+
+def run_script(script):
+    output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.DEVNULL)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    directory = tempfile.mkdtemp()
+    try:
+        password_file = os.path.join(directory, 'users.yaml')
+        write_password_file(password_file, 1)
+        import_times = [run_script(IMPORT_SCRIPT) for run in range(runs)]
+        connect_times = [run_script(CONNECT_SCRIPT % (password_file, PORT)) for run in range(runs)]
+        print("%32s %10s %10s" % ("", "min (ms)", "avg (ms)"))
+        for label, times in (('import hbmqtt.broker', import_times), ('first accepted connection', connect_times)):
+            print("%32s %10.1f %10.1f" % (label, min(times) * 1e3, sum(times) / len(times) * 1e3))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Subscription matching benchmark.
+
+Compares the cost of matching one published topic against the broker subscriptions using the former linear
+filter scan (one regex per wildcard filter) and the topic tree, for a growing number of device subscriptions.
+
+Usage: python -m benchmarks.bench_subscriptions
+"""
+import re
+import timeit
+
+from hbmqtt.topics import SubscriptionTree
+
+
+def legacy_matches(topic, a_filter):
+    if "#" not in a_filter and "+" not in a_filter:
+        return a_filter == topic
+    match_pattern = re.compile(a_filter.replace('#', '.*').replace('$', r'\$').replace('+', r'[/\$\s\w\d]+'))
+    return match_pattern.match(topic)
+
+
+def legacy_match(subscriptions, topic):
+    matched = []
+    for k_filter in subscriptions:
+        if topic.startswith("$") and (k_filter.startswith("+") or k_filter.startswith("#")):
+            continue
+        if legacy_matches(topic, k_filter):
+            matched.extend(subscriptions[k_filter])
+    return matched
+
+
+def build(count):
+    legacy = dict()
+    tree = SubscriptionTree()
+    for i in range(count):
+        client_id = 'device%d' % i
+        a_filter = 'user%d/device%d/#' % (i // 10, i)
+        legacy[a_filter] = [(client_id, 1)]
+        tree.add(a_filter, client_id, 1)
+    return legacy, tree
+
+
+def main():
+    print("%12s %18s %18s" % ("filters", "linear scan (us)", "topic tree (us)"))
+    for count in (100, 1000, 10000, 50000):
+        legacy, tree = build(count)
+        topic = 'user%d/device%d/telemetry' % ((count // 2) // 10, count // 2)
+        assert len(legacy_match(legacy, topic)) == len(tree.match(topic)) == 1
+        legacy_runs = max(1, 20000 // count)
+        legacy_time = timeit.timeit(lambda: legacy_match(legacy, topic), number=legacy_runs) / legacy_runs
+        tree_time = timeit.timeit(lambda: tree.match(topic), number=20000) / 20000
+        print("%12d %18.1f %18.2f" % (count, legacy_time * 1e6, tree_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import logging
 import asyncio
 import os
 from hbmqtt.broker import Broker
+from hbmqtt.workers import run_workers
 from hbmqtt.version import get_version
 from docopt import docopt
 from hbmqtt.utils import read_yaml_config
@@ -23,6 +24,11 @@ def main(*args, **kwargs):
 
     print(config)
 
+    workers = config.get('workers', 1)
+    if workers > 1:
+        run_workers(config, workers)
+        return
+
     loop = asyncio.get_event_loop()
     broker = Broker(config)
     try:
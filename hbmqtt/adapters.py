@@ -3,17 +3,66 @@
 # See the file license.txt for copying permission.
 import asyncio
 import io
-from websockets.protocol import WebSocketCommonProtocol
-from websockets.exceptions import ConnectionClosed
 from asyncio import StreamReader, StreamWriter
 import logging
 
 
+class TrafficCounters:
+    """
+    Bytes and MQTT packets received and sent over a connection, or over all connections of a listener. PUBLISH
+    packets are also counted on their own.
+
+    Counters of a connection also update the counters of their parent, so that listener totals are always current.
+
+    :param parent: listener counters, or None
+    """
+    __slots__ = ('bytes_received', 'bytes_sent', 'packets_received', 'packets_sent', 'publish_received',
+                 'publish_sent', 'parent')
+
+    def __init__(self, parent=None):
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.packets_sent = 0
+        self.publish_received = 0
+        self.publish_sent = 0
+        self.parent = parent
+
+    def add_received(self, length):
+        self.bytes_received += length
+        if self.parent is not None:
+            self.parent.bytes_received += length
+
+    def add_sent(self, length):
+        self.bytes_sent += length
+        if self.parent is not None:
+            self.parent.bytes_sent += length
+
+    def packet_received(self, publish=False):
+        self.packets_received += 1
+        if self.parent is not None:
+            self.parent.packets_received += 1
+        if publish:
+            self.publish_received += 1
+            if self.parent is not None:
+                self.parent.publish_received += 1
+
+    def packet_sent(self, publish=False):
+        self.packets_sent += 1
+        if self.parent is not None:
+            self.parent.packets_sent += 1
+        if publish:
+            self.publish_sent += 1
+            if self.parent is not None:
+                self.parent.publish_sent += 1
+
+
 class ReaderAdapter:
     """
     Base class for all network protocol reader adapter.
 
-    Reader adapters are used to adapt read operations on the network depending on the protocol used
+    Reader adapters are used to adapt read operations on the network depending on the protocol used.
+    Bytes read are counted in the ``counters`` attribute, a :class:`TrafficCounters` instance.
     """
 
     @asyncio.coroutine
@@ -34,7 +83,8 @@ class WriterAdapter:
     """
     Base class for all network protocol writer adapter.
 
-    Writer adapters are used to adapt write operations on the network depending on the protocol used
+    Writer adapters are used to adapt write operations on the network depending on the protocol used.
+    Bytes written are counted in the ``counters`` attribute, a :class:`TrafficCounters` instance.
     """
 
     def write(self, data):
@@ -42,6 +92,13 @@ class WriterAdapter:
         write some data to the protocol layer
         """
 
+    def writelines(self, buffers):
+        """
+        write a list of buffers to the protocol layer, without joining them first if the protocol allows it
+        """
+        for data in buffers:
+            self.write(data)
+
     @asyncio.coroutine
     def drain(self):
         """
@@ -59,15 +116,24 @@ class WriterAdapter:
         Close the protocol connection
         """
 
+    def abort(self):
+        """
+        Close the protocol connection without flushing data waiting to be written, if the protocol allows it
+        """
+
 
 class WebSocketsReader(ReaderAdapter):
     """
     WebSockets API reader adapter
     This adapter relies on WebSocketCommonProtocol to read from a WebSocket.
     """
-    def __init__(self, protocol: WebSocketCommonProtocol):
+    def __init__(self, protocol, counters=None):
+        # websockets is only imported when a WebSocket connection is used
+        from websockets.exceptions import ConnectionClosed
+        self._connection_closed = ConnectionClosed
         self._protocol = protocol
         self._stream = io.BytesIO(b'')
+        self.counters = counters if counters is not None else TrafficCounters()
 
     @asyncio.coroutine
     def read(self, n=-1) -> bytes:
@@ -85,12 +151,13 @@ class WebSocketsReader(ReaderAdapter):
         while len(buffer) < n:
             try:
                 message = yield from self._protocol.recv()
-            except ConnectionClosed:
+            except self._connection_closed:
                 message = None
             if message is None:
                 break
             if not isinstance(message, bytes):
                 raise TypeError("message must be bytes")
+            self.counters.add_received(len(message))
             buffer.extend(message)
         self._stream = io.BytesIO(buffer)
 
@@ -100,9 +167,10 @@ class WebSocketsWriter(WriterAdapter):
     WebSockets API writer adapter
     This adapter relies on WebSocketCommonProtocol to read from a WebSocket.
     """
-    def __init__(self, protocol: WebSocketCommonProtocol):
+    def __init__(self, protocol, counters=None):
         self._protocol = protocol
         self._stream = io.BytesIO(b'')
+        self.counters = counters if counters is not None else TrafficCounters()
 
     def write(self, data):
         """
@@ -118,6 +186,7 @@ class WebSocketsWriter(WriterAdapter):
         data = self._stream.getvalue()
         if len(data):
             yield from self._protocol.send(data)
+            self.counters.add_sent(len(data))
         self._stream = io.BytesIO(b'')
 
     def get_peer_info(self):
@@ -135,8 +204,9 @@ class StreamReaderAdapter(ReaderAdapter):
     This adapter relies on StreamReader to read from a TCP socket.
     Because API is very close, this class is trivial
     """
-    def __init__(self, reader: StreamReader):
+    def __init__(self, reader: StreamReader, counters=None):
         self._reader = reader
+        self.counters = counters if counters is not None else TrafficCounters()
 
     @asyncio.coroutine
     def read(self, n=-1) -> bytes:
@@ -144,6 +214,7 @@ class StreamReaderAdapter(ReaderAdapter):
             data = yield from self._reader.read(n)
         else:
             data = yield from self._reader.readexactly(n)
+        self.counters.add_received(len(data))
         return data
 
     def feed_eof(self):
@@ -156,12 +227,18 @@ class StreamWriterAdapter(WriterAdapter):
     This adapter relies on StreamWriter to write to a TCP socket.
     Because API is very close, this class is trivial
     """
-    def __init__(self, writer: StreamWriter):
+    def __init__(self, writer: StreamWriter, counters=None):
         self.logger = logging.getLogger(__name__)
         self._writer = writer
+        self.counters = counters if counters is not None else TrafficCounters()
 
     def write(self, data):
         self._writer.write(data)
+        self.counters.add_sent(len(data))
+
+    def writelines(self, buffers):
+        self._writer.writelines(buffers)
+        self.counters.add_sent(sum(len(data) for data in buffers))
 
     @asyncio.coroutine
     def drain(self):
@@ -178,6 +255,9 @@ class StreamWriterAdapter(WriterAdapter):
             self._writer.write_eof()
         self._writer.close()
 
+    def abort(self):
+        self._writer.transport.abort()
+
 
 class BufferReader(ReaderAdapter):
     """
@@ -186,6 +266,7 @@ class BufferReader(ReaderAdapter):
     """
     def __init__(self, buffer: bytes):
         self._stream = io.BytesIO(buffer)
+        self.counters = TrafficCounters()
 
     @asyncio.coroutine
     def read(self, n=-1) -> bytes:
@@ -199,6 +280,7 @@ class BufferWriter(WriterAdapter):
     """
     def __init__(self, buffer=b''):
         self._stream = io.BytesIO(buffer)
+        self.counters = TrafficCounters()
 
     def write(self, data):
         """
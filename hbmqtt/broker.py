@@ -1,33 +1,55 @@
 # Copyright (c) 2015 Nicolas JOUANIN
 #
 # See the file license.txt for copying permission.
+import gc
 import logging
 import ssl
-import websockets
 import asyncio
 import sys
-import re
-from asyncio import CancelledError
-from collections import deque
 
+from collections import Counter, OrderedDict
 from functools import partial
 from transitions import Machine, MachineError
 from hbmqtt.session import Session
-from hbmqtt.mqtt.protocol.broker_handler import BrokerProtocolHandler
-from hbmqtt.errors import HBMQTTException, MQTTException
+from hbmqtt.mqtt.protocol.broker_handler import (
+    BrokerProtocolHandler, DEFAULT_OUTBOUND_QUEUE_SIZE, DEFAULT_OUTBOUND_QUEUE_POLICY)
+from hbmqtt.mqtt.publish import PublishFrame
+from hbmqtt.errors import HBMQTTException, MQTTException, CodecException, QueueOverflowError
+from hbmqtt.queues import OverloadQueue, POLICY_BLOCK, POLICY_DROP_OLDEST
+from hbmqtt.offline import OfflineMessageStore
+from hbmqtt.retained import RetainedMessageStore
+from hbmqtt.hashing import HashingPool
 from hbmqtt.utils import format_client_message, gen_client_id
+from hbmqtt.topics import SubscriptionTree, RetainedMessageTree, match_topic
 from hbmqtt.adapters import (
     StreamReaderAdapter,
     StreamWriterAdapter,
     ReaderAdapter,
     WriterAdapter,
     WebSocketsReader,
-    WebSocketsWriter)
+    WebSocketsWriter,
+    TrafficCounters)
 from .plugins.manager import PluginManager, BaseContext
 
 
 _defaults = {
     'timeout-disconnect-delay': 2,
+    'connect-timeout': 10,
+    'outbound-queue-size': DEFAULT_OUTBOUND_QUEUE_SIZE,
+    'outbound-queue-policy': DEFAULT_OUTBOUND_QUEUE_POLICY,
+    'broadcast-shards': 4,
+    'broadcast-queue-size': 1000,
+    'broadcast-queue-policy': POLICY_BLOCK,
+    'session-queue-size': 100,
+    'session-queue-policy': POLICY_BLOCK,
+    'offline-queue-size': 1000,
+    'offline-queue-policy': POLICY_DROP_OLDEST,
+    'offline-memory-window': 100,
+    'offline-spool-dir': None,
+    'offline-message-expiry': 0,
+    'retained-dir': None,
+    'hashing-workers': 2,
+    'hashing-max-pending': 64,
     'auth': {
         'allow-anonymous': True,
         'password-file': None
@@ -43,6 +65,10 @@ EVENT_BROKER_CLIENT_DISCONNECTED = 'broker_client_disconnected'
 EVENT_BROKER_CLIENT_SUBSCRIBED = 'broker_client_subscribed'
 EVENT_BROKER_CLIENT_UNSUBSCRIBED = 'broker_client_unsubscribed'
 EVENT_BROKER_MESSAGE_RECEIVED = 'broker_message_received'
+EVENT_BROKER_IDENTITIES_CHANGED = 'broker_identities_changed'
+
+# Bus lock serializing changes to users and ACL files between workers
+IDENTITIES_LOCK = 'identities'
 
 # username will be appended before each of these
 # config topic is to modify user properties
@@ -64,8 +90,105 @@ class RetainedApplicationMessage:
         self.qos = qos
 
 
+class BroadcastShard:
+    """
+    Partition of the broadcast stage, with its own bounded queue and consumer task.
+    Messages are assigned to a shard by topic, so messages published on a topic are broadcasted in order.
+
+    :param index: shard index
+    :param maxsize: queue size, unbounded if 0
+    :param policy: overload policy applied when the queue is full
+    :param counters: Counter shared by broker queues to count overload events
+    :param loop: asyncio loop to use
+    """
+    def __init__(self, index, maxsize=0, policy=POLICY_BLOCK, counters=None, loop=None):
+        self.index = index
+        self.queue = OverloadQueue(maxsize, policy, 'broadcast', counters, loop=loop)
+        self.task = None
+        self._latency_count = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def record_latency(self, latency):
+        """
+        Record the time a message took from being queued to being handed to all subscribers
+        :param latency: duration in seconds
+        """
+        self._latency_count += 1
+        self._latency_total += latency
+        if latency > self._latency_max:
+            self._latency_max = latency
+
+    def pop_latency(self):
+        """
+        Get latency statistics recorded since last call, and reset them
+        :return: (messages count, average latency, maximum latency) tuple, latencies in seconds
+        """
+        count, total, maximum = self._latency_count, self._latency_total, self._latency_max
+        self._latency_count = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        return count, (total / count if count else 0.0), maximum
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+    :param rate: tokens added per second
+    :param burst: bucket capacity
+    :param loop: asyncio loop used as clock
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'last', '_loop')
+
+    def __init__(self, rate, burst, loop):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self._loop = loop
+        self.last = loop.time()
+
+    def consume(self):
+        """
+        Take a token from the bucket
+        :return: True if a token was available
+        """
+        now = self._loop.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
 class Server:
-    def __init__(self, listener_name, server_instance, max_connections=-1, loop=None):
+    """
+    Listener instance and its admission control.
+
+    :param listener_name: listener name
+    :param server_instance: asyncio or websockets server instance
+    :param max_connections: maximum number of connections, unlimited if <= 0
+    :param loop: asyncio loop to use
+    :param accept_rate: connections accepted per second, unlimited if <= 0
+    :param accept_burst: connections accepted at once after an idle period
+    :param max_handshakes: connections processed concurrently until CONNACK is sent (CONNECT decoding and
+        authentication), unlimited if <= 0
+    :param handshake_queue_size: connections waiting for a handshake slot, further connections are refused.
+        Unlimited if <= 0
+    :param ip_accept_rate: connections accepted per second from the same remote address, unlimited if <= 0
+    :param ip_accept_burst: connections accepted at once from the same remote address
+    """
+
+    # Maximum number of remote addresses rate limited at the same time
+    MAX_TRACKED_ADDRESSES = 10000
+
+    def __init__(self, listener_name, server_instance, max_connections=-1, loop=None,
+                 accept_rate=0, accept_burst=0, max_handshakes=0, handshake_queue_size=0,
+                 ip_accept_rate=0, ip_accept_burst=0):
         self.logger = logging.getLogger(__name__)
         self.instance = server_instance
         self.conn_count = 0
@@ -81,6 +204,68 @@ class Server:
         else:
             self.semaphore = None
 
+        if accept_rate > 0:
+            self._accept_bucket = TokenBucket(accept_rate, accept_burst or accept_rate, self._loop)
+        else:
+            self._accept_bucket = None
+        self.ip_accept_rate = ip_accept_rate
+        self.ip_accept_burst = ip_accept_burst or ip_accept_rate
+        self._ip_buckets = OrderedDict()
+        if max_handshakes > 0:
+            self._handshake_semaphore = asyncio.Semaphore(max_handshakes, loop=self._loop)
+        else:
+            self._handshake_semaphore = None
+        self.handshake_queue_size = handshake_queue_size
+        self.handshakes_count = 0
+        self.handshakes_waiting = 0
+        self.refused_count = 0
+        # Bytes and packets of all connections accepted on this listener
+        self.traffic = TrafficCounters()
+
+    def admit(self, remote_address):
+        """
+        Check a new connection against accept rate and handshake queue limits
+        :param remote_address: remote IP address
+        :return: True if the connection can be processed, False if it must be refused
+        """
+        refused = None
+        if self._accept_bucket is not None and not self._accept_bucket.consume():
+            refused = "accept rate exceeded"
+        elif self.ip_accept_rate > 0 and not self._ip_bucket(remote_address).consume():
+            refused = "accept rate exceeded for %s" % remote_address
+        elif self._handshake_semaphore is not None and 0 < self.handshake_queue_size <= self.handshakes_waiting:
+            refused = "%d connections waiting for handshake" % self.handshakes_waiting
+        if refused is None:
+            return True
+        self.refused_count += 1
+        self.logger.debug("Listener '%s': connection refused, %s" % (self.listener_name, refused))
+        return False
+
+    def _ip_bucket(self, remote_address):
+        bucket = self._ip_buckets.pop(remote_address, None)
+        if bucket is None:
+            if len(self._ip_buckets) >= self.MAX_TRACKED_ADDRESSES:
+                self._ip_buckets.popitem(last=False)
+            bucket = TokenBucket(self.ip_accept_rate, self.ip_accept_burst, self._loop)
+        # Keep most recently seen addresses last
+        self._ip_buckets[remote_address] = bucket
+        return bucket
+
+    @asyncio.coroutine
+    def acquire_handshake(self):
+        if self._handshake_semaphore is not None:
+            self.handshakes_waiting += 1
+            try:
+                yield from self._handshake_semaphore.acquire()
+            finally:
+                self.handshakes_waiting -= 1
+        self.handshakes_count += 1
+
+    def release_handshake(self):
+        self.handshakes_count -= 1
+        if self._handshake_semaphore is not None:
+            self._handshake_semaphore.release()
+
     @asyncio.coroutine
     def acquire_connection(self):
         if self.semaphore:
@@ -133,6 +318,12 @@ class BrokerContext(BaseContext):
         for k, session in self._broker_instance._sessions.items():
             yield session[0]
 
+    @property
+    def handlers(self):
+        for k, session in self._broker_instance._sessions.items():
+            if session[1] is not None:
+                yield session[1]
+
     @property
     def retained_messages(self):
         return self._broker_instance._retained_messages
@@ -141,6 +332,22 @@ class BrokerContext(BaseContext):
     def subscriptions(self):
         return self._broker_instance._subscriptions
 
+    @property
+    def broadcast_shards(self):
+        return self._broker_instance._broadcast_shards
+
+    @property
+    def queue_counters(self):
+        return self._broker_instance._queue_counters
+
+    @property
+    def servers(self):
+        return self._broker_instance._servers
+
+    @property
+    def hashing(self):
+        return self._broker_instance._hashing
+
 
 class Broker:
     """
@@ -149,11 +356,12 @@ class Broker:
     :param config: Example Yaml config
     :param loop: asyncio loop to use. Defaults to ``asyncio.get_event_loop()`` if none is given
     :param plugin_namespace: Plugin namespace to use when loading plugin entry_points. Defaults to ``hbmqtt.broker.plugins``
+    :param bus: :class:`~hbmqtt.workers.BrokerBus` connecting this broker to other worker processes, if any
 
     """
     states = ['new', 'starting', 'started', 'not_started', 'stopping', 'stopped', 'not_stopped', 'stopped']
 
-    def __init__(self, config=None, loop=None, plugin_namespace=None):
+    def __init__(self, config=None, loop=None, plugin_namespace=None, bus=None):
         self.logger = logging.getLogger(__name__)
         self.config = _defaults
         if config is not None:
@@ -168,11 +376,30 @@ class Broker:
         self._servers = dict()
         self._init_states()
         self._sessions = dict()
-        self._subscriptions = dict()
-        self._retained_messages = dict()
-        self._broadcast_queue = asyncio.Queue(loop=self._loop)
-
-        self._broadcast_task = None
+        self._subscriptions = SubscriptionTree()
+        self._retained_messages = RetainedMessageTree()
+        # Retained messages saved between runs
+        self._retained_store = None
+        # Client IDs of persistent sessions saved by the persistence plugin
+        self._persisted_sessions = set()
+        # Subscriptions of sessions restored from the persistence plugin, by client ID, until their state is loaded
+        self._unloaded_sessions = dict()
+        # Tasks serving connected clients, by client ID
+        self._client_tasks = dict()
+        # Overload events of broker queues, keyed by (queue name, event)
+        self._queue_counters = Counter()
+        self._broadcast_shards = [
+            BroadcastShard(index,
+                           self.config.get('broadcast-queue-size', 0),
+                           self.config.get('broadcast-queue-policy', POLICY_BLOCK),
+                           self._queue_counters,
+                           self._loop)
+            for index in range(max(1, self.config.get('broadcast-shards', 1)))]
+        self._bus = bus
+        # Password hashing out of the event loop
+        self._hashing = HashingPool(self.config.get('hashing-workers', None),
+                                    self.config.get('hashing-max-pending', 0),
+                                    self._loop)
 
         # Init plugins manager
         context = BrokerContext(self)
@@ -182,6 +409,23 @@ class Broker:
         else:
             namespace = 'hbmqtt.broker.plugins'
         self.plugins_manager = PluginManager(namespace, context, self._loop)
+        # Plugins saving persistent sessions between runs
+        if self.config.get('persistence', None):
+            self._persistence_plugins = [plugin.name for plugin in self.plugins_manager.plugins
+                                         if hasattr(plugin.object, 'list_sessions')]
+        else:
+            self._persistence_plugins = []
+        # Plugins checking each connection, subscription and PUBLISH, called directly in order
+        auth_plugins = None
+        auth_config = self.config.get('auth', None)
+        if auth_config:
+            auth_plugins = auth_config.get('plugins', None)
+        self._auth_methods = self.plugins_manager.get_plugin_methods('authenticate', auth_plugins)
+        topic_plugins = None
+        topic_config = self.config.get('topic-check', None)
+        if topic_config and topic_config.get('enabled', False):
+            topic_plugins = topic_config.get('plugins', None)
+        self._topic_filtering_methods = self.plugins_manager.get_plugin_methods('topic_filtering', topic_plugins)
 
     def _build_listeners_config(self, broker_config):
         self.listeners_config = dict()
@@ -216,8 +460,10 @@ class Broker:
         """
         try:
             self._sessions = dict()
-            self._subscriptions = dict()
-            self._retained_messages = dict()
+            self._subscriptions = SubscriptionTree()
+            self._retained_messages = RetainedMessageTree()
+            self._persisted_sessions = set()
+            self._unloaded_sessions = dict()
             self.transitions.start()
             self.logger.debug("Broker starting")
         except (MachineError, ValueError) as exc:
@@ -227,6 +473,11 @@ class Broker:
 
         yield from self.plugins_manager.fire_event(EVENT_BROKER_PRE_START)
         try:
+            self._restore_retained_messages()
+            if self._bus is not None:
+                yield from self._bus.connect(self)
+            yield from self._restore_sessions()
+
             # Start network listeners
             for listener_name in self.listeners_config:
                 listener = self.listeners_config[listener_name]
@@ -271,19 +522,36 @@ class Broker:
                     except ValueError as ve:
                         raise BrokerException("Invalid port value in bind value: %s" % listener['bind'])
 
+                    # Listeners shared by worker processes
+                    server_kwargs = dict()
+                    if listener.get('reuse_port', False):
+                        server_kwargs['reuse_port'] = True
+                    # CONNECT admission control
+                    admission = dict(
+                        accept_rate=float(listener.get('accept_rate', 0)),
+                        accept_burst=int(listener.get('accept_burst', 0)),
+                        max_handshakes=int(listener.get('max_handshakes', 0)),
+                        handshake_queue_size=int(listener.get('handshake_queue_size', 0)),
+                        ip_accept_rate=float(listener.get('ip_accept_rate', 0)),
+                        ip_accept_burst=int(listener.get('ip_accept_burst', 0)))
+
                     if listener['type'] == 'tcp':
                         cb_partial = partial(self.stream_connected, listener_name=listener_name)
                         instance = yield from asyncio.start_server(cb_partial,
                                                                    address,
                                                                    port,
                                                                    ssl=sc,
-                                                                   loop=self._loop)
-                        self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop)
+                                                                   loop=self._loop,
+                                                                   **server_kwargs)
+                        self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop,
+                                                              **admission)
                     elif listener['type'] == 'ws':
+                        import websockets
                         cb_partial = partial(self.ws_connected, listener_name=listener_name)
                         instance = yield from websockets.serve(cb_partial, address, port, ssl=sc, loop=self._loop,
-                                                               subprotocols=['mqtt'])
-                        self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop)
+                                                               subprotocols=['mqtt'], **server_kwargs)
+                        self._servers[listener_name] = Server(listener_name, instance, max_connections, self._loop,
+                                                              **admission)
 
                     self.logger.info("Listener '%s' bind to %s (max_connections=%d)" %
                                      (listener_name, listener['bind'], max_connections))
@@ -291,8 +559,9 @@ class Broker:
             self.transitions.starting_success()
             yield from self.plugins_manager.fire_event(EVENT_BROKER_POST_START)
 
-            #Start broadcast loop
-            self._broadcast_task = asyncio.ensure_future(self._broadcast_loop(), loop=self._loop)
+            # Start broadcast loops
+            for shard in self._broadcast_shards:
+                shard.task = asyncio.ensure_future(self._broadcast_loop(shard), loop=self._loop)
 
             self.logger.debug("Broker started")
         except Exception as e:
@@ -307,10 +576,14 @@ class Broker:
 
             Closes all connected session, stop listening on network socket and free resources.
         """
+        yield from self._save_sessions()
         try:
+            for session, handler in self._sessions.values():
+                if isinstance(session.retained_messages, OfflineMessageStore):
+                    session.retained_messages.close()
             self._sessions = dict()
-            self._subscriptions = dict()
-            self._retained_messages = dict()
+            self._subscriptions = SubscriptionTree()
+            self._retained_messages = RetainedMessageTree()
             self.transitions.shutdown()
         except (MachineError, ValueError) as exc:
             # Backwards compat: MachineError is raised by transitions < 0.5.0.
@@ -320,15 +593,23 @@ class Broker:
         # Fire broker_shutdown event to plugins
         yield from self.plugins_manager.fire_event(EVENT_BROKER_PRE_SHUTDOWN)
 
-        # Stop broadcast loop
-        if self._broadcast_task:
-            self._broadcast_task.cancel()
-        if self._broadcast_queue.qsize() > 0:
-            self.logger.warning("%d messages not broadcasted" % self._broadcast_queue.qsize())
+        # Stop broadcast loops
+        for shard in self._broadcast_shards:
+            if shard.task:
+                shard.task.cancel()
+                shard.task = None
+            if shard.depth > 0:
+                self.logger.warning("%d messages not broadcasted by shard %d" % (shard.depth, shard.index))
 
         for listener_name in self._servers:
             server = self._servers[listener_name]
             yield from server.close_instance()
+        if self._bus is not None:
+            yield from self._bus.close()
+        yield from self._hashing.shutdown()
+        if self._retained_store is not None:
+            store, self._retained_store = self._retained_store, None
+            yield from self._loop.run_in_executor(None, store.close)
         self.logger.debug("Broker closing")
         self.logger.info("Broker closed")
         yield from self.plugins_manager.fire_event(EVENT_BROKER_POST_SHUTDOWN)
@@ -338,13 +619,52 @@ class Broker:
     def internal_message_broadcast(self, topic, data, qos=None):
         return (yield from self._broadcast_message(None, topic, data))
 
+    @asyncio.coroutine
+    def bus_message_broadcast(self, topic, data, qos=None):
+        """
+        Broadcast a message published by a client connected to another worker
+        """
+        yield from self._broadcast_message(None, topic, data, qos)
+
+    @asyncio.coroutine
+    def bus_identities_changed(self):
+        """
+        Users or ACL files have been changed by another worker
+        """
+        yield from self.plugins_manager.fire_event(EVENT_BROKER_IDENTITIES_CHANGED)
+
+    @asyncio.coroutine
+    def _lock_identities(self):
+        if self._bus is not None:
+            yield from self._bus.acquire(IDENTITIES_LOCK)
+
+    @asyncio.coroutine
+    def _unlock_identities(self, changed):
+        if self._bus is not None:
+            self._bus.release(IDENTITIES_LOCK)
+            if changed:
+                self._bus.identities_changed()
+        if changed:
+            yield from self.plugins_manager.fire_event(EVENT_BROKER_IDENTITIES_CHANGED)
+
     @asyncio.coroutine
     def ws_connected(self, websocket, uri, listener_name):
-        yield from self.client_connected(listener_name, WebSocketsReader(websocket), WebSocketsWriter(websocket))
+        counters = self._connection_counters(listener_name)
+        yield from self.client_connected(listener_name, WebSocketsReader(websocket, counters),
+                                         WebSocketsWriter(websocket, counters))
 
     @asyncio.coroutine
     def stream_connected(self, reader, writer, listener_name):
-        yield from self.client_connected(listener_name, StreamReaderAdapter(reader), StreamWriterAdapter(writer))
+        counters = self._connection_counters(listener_name)
+        yield from self.client_connected(listener_name, StreamReaderAdapter(reader, counters),
+                                         StreamWriterAdapter(writer, counters))
+
+    def _connection_counters(self, listener_name):
+        """
+        Traffic counters of a new connection, adding up to the counters of its listener
+        """
+        server = self._servers.get(listener_name, None)
+        return TrafficCounters(server.traffic if server is not None else None)
 
     @asyncio.coroutine
     def client_connected(self, listener_name, reader: ReaderAdapter, writer: WriterAdapter):
@@ -352,42 +672,81 @@ class Broker:
         server = self._servers.get(listener_name, None)
         if not server:
             raise BrokerException("Invalid listener name '%s'" % listener_name)
-        yield from server.acquire_connection()
 
         remote_address, remote_port = writer.get_peer_info()
+        # Refuse connections over listener limits before reading anything
+        if not server.admit(remote_address):
+            yield from writer.close()
+            return
+        yield from server.acquire_connection()
         self.logger.info("Connection from %s:%d on listener '%s'" % (remote_address, remote_port, listener_name))
+        try:
+            yield from self._serve_client(server, listener_name, reader, writer, remote_address, remote_port)
+        finally:
+            server.release_connection()  # Delete client from connections list
 
+    @asyncio.coroutine
+    def _client_handshake(self, listener_name, reader, writer, remote_address, remote_port):
+        """
+        Read the CONNECT packet, set up the client session, authenticate and send CONNACK
+        :return: (handler, session) tuple, None if the connection was refused and closed
+        """
         # Wait for first packet and expect a CONNECT
         try:
-            handler, client_session = yield from BrokerProtocolHandler.init_from_connect(reader, writer, self.plugins_manager, loop=self._loop)
-        except HBMQTTException as exc:
+            handler, client_session = yield from asyncio.wait_for(
+                BrokerProtocolHandler.init_from_connect(
+                    reader, writer, self.plugins_manager, loop=self._loop,
+                    outbound_queue_size=self.config.get('outbound-queue-size', DEFAULT_OUTBOUND_QUEUE_SIZE),
+                    outbound_queue_policy=self.config.get('outbound-queue-policy', DEFAULT_OUTBOUND_QUEUE_POLICY),
+                    queue_counters=self._queue_counters),
+                self.config.get('connect-timeout') or None, loop=self._loop)
+        except asyncio.TimeoutError:
+            self.logger.warning("%s: no CONNECT received within %s seconds" %
+                                (format_client_message(address=remote_address, port=remote_port),
+                                 self.config['connect-timeout']))
+            yield from self._close_writer(writer)
+            return None
+        except (HBMQTTException, CodecException, asyncio.IncompleteReadError, ConnectionError) as exc:
             self.logger.warning("[MQTT-3.1.0-1] %s: Can't read first packet an CONNECT: %s" %
                                 (format_client_message(address=remote_address, port=remote_port), exc))
-            #yield from writer.close()
-            self.logger.debug("Connection closed")
-            return
+            yield from self._close_writer(writer)
+            return None
         except MQTTException as me:
             self.logger.error('Invalid connection from %s : %s' %
                               (format_client_message(address=remote_address, port=remote_port), me))
-            yield from writer.close()
-            self.logger.debug("Connection closed")
-            return
-
+            yield from self._close_writer(writer)
+            return None
+
+        if self._bus is not None and client_session.client_id:
+            # [MQTT-3.1.4-2] Disconnect a client connected to another worker with the same client ID, and take its
+            # session over
+            handed_over = yield from self._bus.claim(client_session.client_id, client_session.clean_session)
+            if handed_over is not None:
+                self._adopt_session(client_session.client_id, *handed_over)
         if client_session.clean_session:
             # Delete existing session and create a new one
             if client_session.client_id is not None and client_session.client_id != "":
                 self.delete_session(client_session.client_id)
+                yield from self._delete_persisted_session(client_session.client_id)
             else:
                 client_session.client_id = gen_client_id()
             client_session.parent = 0
         else:
             # Get session from cache
+            if client_session.client_id in self._unloaded_sessions:
+                self._restored_session(client_session.client_id)
             if client_session.client_id in self._sessions:
                 self.logger.debug("Found old session %s" % repr(self._sessions[client_session.client_id]))
-                (client_session, h) = self._sessions[client_session.client_id]
+                (old_session, h) = self._sessions[client_session.client_id]
+                old_session.resume(client_session)
+                client_session = old_session
                 client_session.parent = 1
+                if client_session.client_id in self._unloaded_sessions:
+                    yield from self._load_session(client_session)
             else:
                 client_session.parent = 0
+        if client_session.parent == 0:
+            self._init_session_queues(client_session)
         if client_session.keep_alive > 0:
             client_session.keep_alive += self.config['timeout-disconnect-delay']
         self.logger.debug("Keep-alive timeout=%d" % client_session.keep_alive)
@@ -397,9 +756,8 @@ class Broker:
 
         authenticated = yield from self.authenticate(client_session, self.listeners_config[listener_name])
         if not authenticated:
-            yield from writer.close()
-            server.release_connection()  # Delete client from connections list
-            return
+            yield from self._close_writer(writer)
+            return None
 
         while True:
             try:
@@ -411,6 +769,33 @@ class Broker:
                 # Wait a bit may be client is reconnecting too fast
                 yield from asyncio.sleep(1, loop=self._loop)
         yield from handler.mqtt_connack_authorize(authenticated)
+        return handler, client_session
+
+    @asyncio.coroutine
+    def _close_writer(self, writer):
+        try:
+            yield from writer.close()
+        except Exception as e:
+            self.logger.debug("Error while closing connection: %s" % e)
+
+    @asyncio.coroutine
+    def _serve_client(self, server, listener_name, reader, writer, remote_address, remote_port):
+        # Limit connections processed concurrently until CONNACK is sent
+        yield from server.acquire_handshake()
+        try:
+            connected = yield from self._client_handshake(listener_name, reader, writer, remote_address, remote_port)
+        except Exception:
+            yield from self._close_writer(writer)
+            raise
+        finally:
+            server.release_handshake()
+        if connected is None:
+            self.logger.debug("Connection closed")
+            return
+        handler, client_session = connected
+        task = asyncio.Task.current_task(loop=self._loop)
+        self._client_tasks[client_session.client_id] = task
+        task.add_done_callback(partial(self._client_task_done, client_session.client_id))
 
         yield from self.plugins_manager.fire_event(EVENT_BROKER_CLIENT_CONNECTED, client_id=client_session.client_id)
 
@@ -443,7 +828,8 @@ class Broker:
                                 client_session,
                                 client_session.will_topic,
                                 client_session.will_message,
-                                client_session.will_qos)
+                                client_session.will_qos,
+                                publish_qos=client_session.will_qos)
                             if client_session.will_retain:
                                 self.retain_message(client_session,
                                                     client_session.will_topic,
@@ -451,6 +837,12 @@ class Broker:
                                                     client_session.will_qos)
                     self.logger.debug("%s Disconnecting session" % client_session.client_id)
                     yield from self._stop_handler(handler)
+                    if not client_session.clean_session:
+                        # Keep messages not written yet for the next connection
+                        for message in handler.pending_outbound_messages():
+                            yield from self._store_offline_message(client_session, RetainedApplicationMessage(
+                                None, message.topic, message.data, message.qos))
+                        yield from self._save_session(client_session)
                     client_session.transitions.disconnect()
                     yield from self.plugins_manager.fire_event(EVENT_BROKER_CLIENT_DISCONNECTED, client_id=client_session.client_id)
                     connected = False
@@ -482,7 +874,8 @@ class Broker:
                                 qos=subscription[1])
                             yield from self.publish_retained_messages_for_subscription(subscription, client_session)
                     subscribe_waiter = asyncio.Task(handler.get_next_pending_subscription(), loop=self._loop)
-                    self.logger.debug(repr(self._subscriptions))
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug(repr(self._subscriptions))
                 if wait_deliver in done:
                     if self.logger.isEnabledFor(logging.DEBUG):
                         self.logger.debug("%s handling message delivery" % client_session.client_id)
@@ -497,14 +890,19 @@ class Broker:
                         if client_session.username:
                             self.logger.error("User not anonymous. Registration is only allowed for anonymous users")
                             break
-                        registered_username, registered_device = yield from self.register(data=app_message.data)
-                        if (registered_username and registered_device):
-                            topics = dict()
-                            topics['acl_publish_all'] = self.get_default_user_topics(registered_username) + [f"{registered_username}/{registered_device}/#"]
-                            topics['acl_subscribe_all'] = []
-                            topics['acl_publish'] = {registered_device : []}
-                            topics['acl_subscribe'] = {registered_device: [f"{registered_username}/{registered_device}/#"]}
-                            yield from self.add_acl(registered_username, registered_device, topics)
+                        yield from self._lock_identities()
+                        registered_username = None
+                        try:
+                            registered_username, registered_device = yield from self.register(data=app_message.data)
+                            if (registered_username and registered_device):
+                                topics = dict()
+                                topics['acl_publish_all'] = self.get_default_user_topics(registered_username) + [f"{registered_username}/{registered_device}/#"]
+                                topics['acl_subscribe_all'] = []
+                                topics['acl_publish'] = {registered_device : []}
+                                topics['acl_subscribe'] = {registered_device: [f"{registered_username}/{registered_device}/#"]}
+                                yield from self.add_acl(registered_username, registered_device, topics)
+                        finally:
+                            yield from self._unlock_identities(bool(registered_username))
                         break
                     
                     else:
@@ -515,6 +913,8 @@ class Broker:
                         username = client_session.username.split("-")[0]
                         client_deviceid = client_session.username.split("-")[0]
                         if app_message.topic == f"{username}/config":
+                            yield from self._lock_identities()
+                            identities_changed = False
                             try:
                                 config_query = str(app_message.data, 'UTF-8').split(" ")
                                 callback = config_query[0]
@@ -530,7 +930,7 @@ class Broker:
                                         topics['acl_subscribe_all'] = []
                                         topics['acl_publish'] = {deviceid: []}
                                         topics['acl_subscribe'] = {deviceid: [f"{username}/{deviceid}/#"]}
-                                        yield from self.add_acl(username, deviceid, topics)
+                                        identities_changed = yield from self.add_acl(username, deviceid, topics)
                                 elif callback == "add_acl": # username/config add_acl publish/subscribe all/deviceid topic
                                     pubsub = args[0]
                                     deviceid = args[1]
@@ -557,17 +957,20 @@ class Broker:
                                         else:
                                             topics['acl_subscribe'][deviceid] = [topic]
 
-                                    yield from self.add_acl(username, client_deviceid, topics)
+                                    identities_changed = yield from self.add_acl(username, client_deviceid, topics)
                                 else:
                                     self.logger.info("Command not supported!")
                             except IndexError:
                                 self.logger.error("Wrong config callback format")
+                            finally:
+                                yield from self._unlock_identities(identities_changed)
                             break
 
                         yield from self.plugins_manager.fire_event(EVENT_BROKER_MESSAGE_RECEIVED,
                                                                    client_id=client_session.client_id,
                                                                    message=app_message)
-                        yield from self._broadcast_message(client_session, app_message.topic, app_message.data)
+                        yield from self._broadcast_message(
+                            client_session, app_message.topic, app_message.data, publish_qos=app_message.qos)
                         if app_message.publish_packet.retain_flag:
                             self.retain_message(client_session, app_message.topic, app_message.data, app_message.qos)
                         wait_deliver = asyncio.Task(handler.mqtt_deliver_next_message(), loop=self._loop)
@@ -580,7 +983,33 @@ class Broker:
         wait_deliver.cancel()
 
         self.logger.debug("%s Client disconnected" % client_session.client_id)
-        server.release_connection()
+
+    def _client_task_done(self, client_id, task):
+        if self._client_tasks.get(client_id) is task:
+            del self._client_tasks[client_id]
+
+    def _init_session_queues(self, session):
+        """
+        Setup bounded queues of a new session
+        """
+        offline_store = OfflineMessageStore(
+            session.client_id,
+            partial(RetainedApplicationMessage, None),
+            self.config.get('offline-queue-size', 0),
+            self.config.get('offline-queue-policy', POLICY_DROP_OLDEST),
+            self.config.get('offline-memory-window', 0),
+            self.config.get('offline-spool-dir', None),
+            self.config.get('offline-message-expiry', 0),
+            self._queue_counters,
+            loop=self._loop)
+        if session.clean_session:
+            # Messages spooled for a previous session with the same client ID
+            offline_store.discard()
+        session.init_queues(
+            self.config.get('session-queue-size', 0),
+            self.config.get('session-queue-policy', POLICY_BLOCK),
+            counters=self._queue_counters,
+            retained_messages=offline_store)
 
     def _init_handler(self, session, reader, writer):
         """
@@ -620,10 +1049,6 @@ class Broker:
                     self.logger.debug("'%s' plugin result: %s" % (plugin.name, True))
                 else:
                     self.logger.debug("Device registration failed due to '%s' plugin result: %s" % (plugin.name, False))
-        if reg_result:
-            yield from self.plugins_manager.map_plugin_coro(
-                    "write_password_file",
-                    filter_plugins='registration')
         return reg_result
 
     @asyncio.coroutine
@@ -643,12 +1068,27 @@ class Broker:
                     self.logger.debug("Registration failed due to '%s' plugin result: %s" % (plugin.name, False))
                     
 
-        if reg_result:
-            yield from self.plugins_manager.map_plugin_coro(
-                    "write_password_file",
-                    filter_plugins='registration')
         return reg_result
 
+    @asyncio.coroutine
+    def _check_plugins(self, methods, check_name, **kwargs):
+        """
+        Call plugin check methods in order, without creating tasks, until one of them denies
+        :param methods: tuple of (plugin, method) returned by PluginManager.get_plugin_methods()
+        :param check_name: check name, for logging
+        :return: False if a plugin returned False, True otherwise
+        """
+        for plugin, method in methods:
+            res = method(**kwargs)
+            if asyncio.iscoroutine(res):
+                res = yield from res
+            if res is False:
+                self.logger.debug("%s failed due to '%s' plugin result: %s" % (check_name, plugin.name, res))
+                return False
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("'%s' plugin result: %s" % (plugin.name, res))
+        return True
+
     @asyncio.coroutine
     def authenticate(self, session: Session, listener):
         """
@@ -662,23 +1102,7 @@ class Broker:
         :param listener:
         :return:
         """
-        auth_plugins = None
-        auth_config = self.config.get('auth', None)
-        if auth_config:
-            auth_plugins = auth_config.get('plugins', None)
-        returns = yield from self.plugins_manager.map_plugin_coro(
-            "authenticate",
-            session=session,
-            filter_plugins=auth_plugins)
-        auth_result = True
-        if returns:
-            for plugin in returns:
-                res = returns[plugin]
-                if res is False:
-                    auth_result = False
-                    self.logger.debug("Authentication failed due to '%s' plugin result: %s" % (plugin.name, res))
-                else:
-                    self.logger.debug("'%s' plugin result: %s" % (plugin.name, res))
+        auth_result = yield from self._check_plugins(self._auth_methods, "Authentication", session=session)
         # If all plugins returned True, authentication is success
         if auth_result:
             self.logger.info("Authentication successful")
@@ -698,25 +1122,8 @@ class Broker:
         :param topic: Topic in which the client wants to subscribe
         :return:
         """
-        topic_plugins = None
-        topic_config = self.config.get('topic-check', None)
-        if topic_config and topic_config.get('enabled', False):
-            topic_plugins = topic_config.get('plugins', None)
-        returns = yield from self.plugins_manager.map_plugin_coro(
-            "topic_filtering",
-            session=session,
-            topic=topic,
-            publish=publish,
-            filter_plugins=topic_plugins)
-        topic_result = True
-        if returns:
-            for plugin in returns:
-                res = returns[plugin]
-                if res is False:
-                    topic_result = False
-                    self.logger.debug("Topic filtering failed due to '%s' plugin result: %s" % (plugin.name, res))
-                else:
-                    self.logger.debug("'%s' plugin result: %s" % (plugin.name, res))
+        topic_result = yield from self._check_plugins(
+            self._topic_filtering_methods, "Topic filtering", session=session, topic=topic, publish=publish)
         # If all plugins returned True, acl is success
         if topic_result:
             self.logger.info(f"{topic} ACL successful")
@@ -743,16 +1150,44 @@ class Broker:
         return list(map(lambda t: f"{username}/{t}", DEFAULT_USER_TOPICS))
 
     def retain_message(self, source_session, topic_name, data, qos=None):
+        if source_session is not None and self._bus is not None:
+            # Keep retained messages consistent between workers
+            self._bus.retain(topic_name, data, qos)
         if data is not None and data != b'':
             # If retained flag set, store the message for further subscriptions
             self.logger.debug("Retaining message on topic %s" % topic_name)
+            # Retained messages outlive the received packet the payload may be a view of
+            data = bytes(data)
             retained_message = RetainedApplicationMessage(source_session, topic_name, data, qos)
-            self._retained_messages[topic_name] = retained_message
+            self._retained_messages.set(topic_name, retained_message)
+            if self._retained_store is not None:
+                self._retained_store.set(topic_name, data, qos)
         else:
             # [MQTT-3.3.1-10]
-            if topic_name in self._retained_messages:
+            if self._retained_messages.delete(topic_name):
                 self.logger.debug("Clear retained messages for topic '%s'" % topic_name)
-                del self._retained_messages[topic_name]
+                if self._retained_store is not None:
+                    self._retained_store.delete(topic_name)
+
+    def _restore_retained_messages(self):
+        """
+        Load retained messages saved by a previous run, if 'retained-dir' is configured
+        """
+        retained_dir = self.config.get('retained-dir', None)
+        if not retained_dir:
+            return
+        self._retained_store = RetainedMessageStore(retained_dir)
+        # Millions of objects may be created, none of them in reference cycles: don't let them trigger collections
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            messages = self._retained_store.load()
+            for topic, (data, qos) in messages.items():
+                self._retained_messages.set(topic, RetainedApplicationMessage(None, topic, data, qos))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.logger.info("%d retained messages restored" % len(messages))
 
     @asyncio.coroutine
     def add_subscription(self, subscription, session):
@@ -773,14 +1208,13 @@ class Broker:
             qos = subscription[1]
             if 'max-qos' in self.config and qos > self.config['max-qos']:
                 qos = self.config['max-qos']
-            if a_filter not in self._subscriptions:
-                self._subscriptions[a_filter] = []
-            already_subscribed = next(
-                (s for (s, qos) in self._subscriptions[a_filter] if s.client_id == session.client_id), None)
-            if not already_subscribed:
-                self._subscriptions[a_filter].append((session, qos))
-            else:
+            if not self._subscriptions.add(a_filter, session.client_id, qos):
                 self.logger.debug("Client %s has already subscribed to %s" % (format_client_message(session=session), a_filter))
+            else:
+                session.subscriptions.add(a_filter)
+                if self._bus is not None and self._subscriptions.subscribers_count(a_filter) == 1:
+                    # First local subscriber, add filter to this worker digest
+                    self._bus.subscribe(a_filter)
             return qos
         except KeyError:
             return 0x80
@@ -793,20 +1227,13 @@ class Broker:
         :return:
         """
         deleted = 0
-        try:
-            subscriptions = self._subscriptions[a_filter]
-            for index, (sub_session, qos) in enumerate(subscriptions):
-                if sub_session.client_id == session.client_id:
-                    self.logger.debug("Removing subscription on topic '%s' for client %s" %
-                                      (a_filter, format_client_message(session=session)))
-                    subscriptions.pop(index)
-                    deleted += 1
-                    break
-        except KeyError:
-            # Unsubscribe topic not found in current subscribed topics
-            pass
-        finally:
-            return deleted
+        session.subscriptions.discard(a_filter)
+        if self._subscriptions.remove(a_filter, session.client_id):
+            self.logger.debug("Removing subscription on topic '%s' for client %s" %
+                              (a_filter, format_client_message(session=session)))
+            deleted += 1
+            self._remove_from_digest(a_filter)
+        return deleted
 
     def _del_all_subscriptions(self, session):
         """
@@ -814,104 +1241,112 @@ class Broker:
         :param session:
         :return:
         """
-        filter_queue = deque()
-        for topic in self._subscriptions:
-            if self._del_subscription(topic, session):
-                filter_queue.append(topic)
-        for topic in filter_queue:
-            if not self._subscriptions[topic]:
-                del self._subscriptions[topic]
+        for a_filter in self._subscriptions.remove_all(session.client_id, session.subscriptions):
+            self.logger.debug("Removing subscription on topic '%s' for client %s" %
+                              (a_filter, format_client_message(session=session)))
+            self._remove_from_digest(a_filter)
+        session.subscriptions.clear()
+
+    def _remove_from_digest(self, a_filter):
+        if self._bus is not None and a_filter not in self._subscriptions:
+            # No more local subscriber, remove filter from this worker digest
+            self._bus.unsubscribe(a_filter)
 
     def matches(self, topic, a_filter):
-        if "#" not in a_filter and "+" not in a_filter:
-            # if filter doesn't contain wildcard, return exact match
-            return a_filter == topic
-        else:
-            # else use regex
-            match_pattern = re.compile(a_filter.replace('#', '.*').replace('$', '\$').replace('+', '[/\$\s\w\d]+'))
-            return match_pattern.match(topic)
+        return match_topic(topic, a_filter)
+
+    @asyncio.coroutine
+    def _broadcast_loop(self, shard):
+        while True:
+            broadcast = yield from shard.queue.get()
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("broadcasting %r" % broadcast)
+            # PUBLISH frames encoded once per QoS and shared by subscribers
+            frames = dict()
+            # [MQTT-4.7.2-1] $ topics are not matched by filters starting with + or #
+            for (client_id, qos) in self._subscriptions.match(broadcast['topic']):
+                try:
+                    target_session, handler = self._sessions[client_id]
+                except KeyError:
+                    if client_id not in self._unloaded_sessions:
+                        continue
+                    target_session, handler = self._restored_session(client_id), None
+                if 'qos' in broadcast:
+                    qos = broadcast['qos']
+                if target_session.transitions.state == 'connected':
+                    self.logger.debug("broadcasting application message from %s on topic '%s' to %s" %
+                                      (format_client_message(session=broadcast['session']),
+                                       broadcast['topic'], format_client_message(session=target_session)))
+                    frame = frames.get(qos)
+                    if frame is None:
+                        frame = PublishFrame(broadcast['topic'], broadcast['data'], qos)
+                        frames[qos] = frame
+                    # Never wait for a subscriber here, the outbound queue policy deals with slow ones
+                    if handler.mqtt_enqueue_publish_nowait(
+                            broadcast['topic'], broadcast['data'], qos, retain=False, publish_frame=frame):
+                        continue
+                self.logger.debug("retaining application message from %s on topic '%s' to client '%s'" %
+                                  (format_client_message(session=broadcast['session']),
+                                   broadcast['topic'], format_client_message(session=target_session)))
+                retained_message = RetainedApplicationMessage(
+                    broadcast['session'], broadcast['topic'], broadcast['data'], qos)
+                yield from self._store_offline_message(target_session, retained_message)
+            shard.record_latency(self._loop.time() - broadcast['time'])
 
     @asyncio.coroutine
-    def _broadcast_loop(self):
-        running_tasks = deque()
+    def _store_offline_message(self, session, message):
         try:
-            while True:
-                while running_tasks and running_tasks[0].done():
-                    running_tasks.popleft()
-                broadcast = yield from self._broadcast_queue.get()
-                if self.logger.isEnabledFor(logging.DEBUG):
-                    self.logger.debug("broadcasting %r" % broadcast)
-                for k_filter in self._subscriptions:
-                    if broadcast['topic'].startswith("$") and (k_filter.startswith("+") or k_filter.startswith("#")):
-                        self.logger.debug("[MQTT-4.7.2-1] - ignoring brodcasting $ topic to subscriptions starting with + or #")
-                    elif self.matches(broadcast['topic'], k_filter):
-                        subscriptions = self._subscriptions[k_filter]
-                        for (target_session, qos) in subscriptions:
-                            if 'qos' in broadcast:
-                                qos = broadcast['qos']
-                            if target_session.transitions.state == 'connected':
-                                self.logger.debug("broadcasting application message from %s on topic '%s' to %s" %
-                                                  (format_client_message(session=broadcast['session']),
-                                                   broadcast['topic'], format_client_message(session=target_session)))
-                                handler = self._get_handler(target_session)
-                                task = asyncio.ensure_future(
-                                    handler.mqtt_publish(broadcast['topic'], broadcast['data'], qos, retain=False),
-                                    loop=self._loop)
-                                running_tasks.append(task)
-                            else:
-                                self.logger.debug("retaining application message from %s on topic '%s' to client '%s'" %
-                                                  (format_client_message(session=broadcast['session']),
-                                                   broadcast['topic'], format_client_message(session=target_session)))
-                                retained_message = RetainedApplicationMessage(
-                                    broadcast['session'], broadcast['topic'], broadcast['data'], qos)
-                                yield from target_session.retained_messages.put(retained_message)
-        except CancelledError:
-            # Wait until current broadcasting tasks end
-            if running_tasks:
-                yield from asyncio.wait(running_tasks, loop=self._loop)
-
-    @asyncio.coroutine
-    def _broadcast_message(self, session, topic, data, force_qos=None):
+            yield from session.retained_messages.put(message, message.qos)
+        except QueueOverflowError as qoe:
+            # Client is not connected, nothing to disconnect
+            self.logger.warning("%s %s, message on topic '%s' dropped" %
+                                (format_client_message(session=session), qoe, message.topic))
+
+    @asyncio.coroutine
+    def _broadcast_message(self, session, topic, data, force_qos=None, publish_qos=None):
         broadcast = {
             'session': session,
             'topic': topic,
-            'data': data
+            'data': data,
+            'time': self._loop.time()
         }
         if force_qos:
             broadcast['qos'] = force_qos
-        yield from self._broadcast_queue.put(broadcast)
+        # Same topic, same shard: messages of a topic keep their order
+        shard = self._broadcast_shards[hash(topic) % len(self._broadcast_shards)]
+        try:
+            yield from shard.queue.put(broadcast, publish_qos)
+        except QueueOverflowError as qoe:
+            handler = self._get_handler(session) if session is not None else None
+            if handler is None:
+                self.logger.warning("Broadcast shard %d: %s, message on topic '%s' dropped" % (shard.index, qoe, topic))
+            else:
+                self.logger.warning("Broadcast shard %d: %s, disconnecting %s" %
+                                    (shard.index, qoe, format_client_message(session=session)))
+                yield from handler.handle_connection_closed()
+            return
+        if session is not None and self._bus is not None:
+            # Route messages published by clients of this worker to other workers
+            yield from self._bus.publish(topic, data, force_qos)
 
     @asyncio.coroutine
     def publish_session_retained_messages(self, session):
         self.logger.debug("Publishing %d messages retained for session %s" %
                           (session.retained_messages.qsize(), format_client_message(session=session))
                           )
-        publish_tasks = []
         handler = self._get_handler(session)
         while not session.retained_messages.empty():
             retained = yield from session.retained_messages.get()
-            publish_tasks.append(asyncio.ensure_future(
-                handler.mqtt_publish(
-                    retained.topic, retained.data, retained.qos, True), loop=self._loop))
-        if publish_tasks:
-            yield from asyncio.wait(publish_tasks, loop=self._loop)
+            yield from handler.mqtt_enqueue_publish(retained.topic, retained.data, retained.qos, True)
 
     @asyncio.coroutine
     def publish_retained_messages_for_subscription(self, subscription, session):
         self.logger.debug("Begin broadcasting messages retained due to subscription on '%s' from %s" %
                           (subscription[0], format_client_message(session=session)))
-        publish_tasks = []
         handler = self._get_handler(session)
-        for d_topic in self._retained_messages:
-            self.logger.debug("matching : %s %s" % (d_topic, subscription[0]))
-            if self.matches(d_topic, subscription[0]):
-                self.logger.debug("%s and %s match" % (d_topic, subscription[0]))
-                retained = self._retained_messages[d_topic]
-                publish_tasks.append(asyncio.Task(
-                    handler.mqtt_publish(
-                        retained.topic, retained.data, subscription[1], True), loop=self._loop))
-        if publish_tasks:
-            yield from asyncio.wait(publish_tasks, loop=self._loop)
+        for retained in self._retained_messages.match(subscription[0]):
+            self.logger.debug("%s and %s match" % (retained.topic, subscription[0]))
+            yield from handler.mqtt_enqueue_publish(retained.topic, retained.data, subscription[1], True)
         self.logger.debug("End broadcasting messages retained due to subscription on '%s' from %s" %
                           (subscription[0], format_client_message(session=session)))
 
@@ -921,6 +1356,8 @@ class Broker:
         :param client_id:
         :return:
         """
+        if client_id in self._unloaded_sessions:
+            self._restored_session(client_id)
         try:
             session = self._sessions[client_id][0]
         except KeyError:
@@ -932,9 +1369,175 @@ class Broker:
         # Delete subscriptions
         self.logger.debug("deleting session %s subscriptions" % repr(session))
         self._del_all_subscriptions(session)
+        if isinstance(session.retained_messages, OfflineMessageStore):
+            session.retained_messages.discard()
 
         self.logger.debug("deleting existing session %s" % repr(self._sessions[client_id]))
         del self._sessions[client_id]
+        self._unloaded_sessions.pop(client_id, None)
+
+    @asyncio.coroutine
+    def _call_persistence(self, coro_name, **kwargs):
+        """
+        Call a persistence plugin coroutine
+        :return: first result which isn't None, or None if persistence is disabled
+        """
+        if not self._persistence_plugins:
+            return None
+        returns = yield from self.plugins_manager.map_plugin_coro(
+            coro_name, filter_plugins=self._persistence_plugins, **kwargs)
+        for result in returns.values():
+            if result is not None:
+                return result
+        return None
+
+    @asyncio.coroutine
+    def _restore_sessions(self):
+        """
+        Restore persistent sessions saved by a previous run. Only their subscriptions are indexed: a session is
+        created by :meth:`_restored_session` when a message is stored for it or when its client reconnects, and
+        the rest of its state is loaded by :meth:`_load_session` when its client reconnects.
+        """
+        sessions = yield from self._call_persistence('list_sessions')
+        if not sessions:
+            return
+        for client_id, subscriptions in sessions:
+            for a_filter, qos in subscriptions:
+                self._subscriptions.add(a_filter, client_id, qos)
+                if self._bus is not None and self._subscriptions.subscribers_count(a_filter) == 1:
+                    self._bus.subscribe(a_filter)
+            self._persisted_sessions.add(client_id)
+            self._unloaded_sessions[client_id] = subscriptions
+            if self._bus is not None:
+                self._bus.own(client_id)
+        self.logger.info("%d persistent sessions restored" % len(sessions))
+
+    def _restored_session(self, client_id):
+        """
+        Get the session of a restored client, creating it on first use
+        """
+        try:
+            return self._sessions[client_id][0]
+        except KeyError:
+            pass
+        session = Session(loop=self._loop)
+        session.client_id = client_id
+        session.clean_session = False
+        session.transitions.disconnect()
+        self._init_session_queues(session)
+        session.subscriptions.update(a_filter for a_filter, qos in self._unloaded_sessions[client_id])
+        self._sessions[client_id] = (session, None)
+        return session
+
+    def _adopt_session(self, client_id, subscriptions, state):
+        """
+        Install a persistent session handed over by another worker, replacing the local one if any
+        :param client_id: client ID
+        :param subscriptions: list of (filter, qos) tuples
+        :param state: state returned by :meth:`hbmqtt.session.Session.persistent_state`
+        """
+        self.delete_session(client_id)
+        session = Session(loop=self._loop)
+        session.client_id = client_id
+        session.clean_session = False
+        session.transitions.disconnect()
+        self._init_session_queues(session)
+        session.restore_state(state)
+        for a_filter, qos in subscriptions:
+            self._subscriptions.add(a_filter, client_id, qos)
+            session.subscriptions.add(a_filter)
+            if self._bus is not None and self._subscriptions.subscribers_count(a_filter) == 1:
+                self._bus.subscribe(a_filter)
+        self._sessions[client_id] = (session, None)
+
+    @asyncio.coroutine
+    def bus_takeover(self, client_id, clean_session):
+        """
+        Give up a client ID claimed by a connection to another worker: disconnect the client connected here with
+        this ID [MQTT-3.1.4-2] and delete its session, which is handed over unless the new connection cleans it
+        :param client_id: client ID
+        :param clean_session: clean session flag of the new connection
+        :return: (subscriptions, state) of the persistent session, None if there is none
+        """
+        session, handler = self._sessions.get(client_id, (None, None))
+        if handler is not None and session.transitions.state == 'connected':
+            self.logger.info("Client %s connected to another worker, disconnecting" %
+                             format_client_message(session=session))
+            handler.disconnect()
+            task = self._client_tasks.get(client_id)
+            if task is not None:
+                # Wait for messages not written yet to be stored in the session
+                yield from asyncio.wait([task], loop=self._loop)
+        if client_id in self._unloaded_sessions and not clean_session:
+            yield from self._load_session(self._restored_session(client_id))
+        session = self._sessions.get(client_id, (None, None))[0]
+        if session is None:
+            return None
+        handed_over = None
+        if not clean_session and not session.clean_session:
+            state = session.persistent_state()
+            # Messages spooled to disk are handed over too
+            messages = []
+            while not session.retained_messages.empty():
+                message = session.retained_messages.get_nowait()
+                messages.append((message.topic, message.data, message.qos))
+            state['messages'] = messages
+            subscriptions = [(a_filter, self._subscriptions.qos(a_filter, client_id))
+                             for a_filter in session.subscriptions]
+            handed_over = (subscriptions, state)
+        self.delete_session(client_id)
+        yield from self._delete_persisted_session(client_id)
+        return handed_over
+
+    @asyncio.coroutine
+    def _load_session(self, session):
+        """
+        Load the state of a restored session: messages in flight and messages stored in memory by the previous run
+        """
+        self._unloaded_sessions.pop(session.client_id, None)
+        state = yield from self._call_persistence('find_session', client_id=session.client_id)
+        if state is not None:
+            session.restore_state(state)
+
+    @asyncio.coroutine
+    def _save_session(self, session):
+        if self._sessions.get(session.client_id, (None, None))[0] is not session:
+            # Deleted by a clean session connection with the same client ID
+            return
+        subscriptions = [(a_filter, self._subscriptions.qos(a_filter, session.client_id))
+                         for a_filter in session.subscriptions]
+        # Added before the write is queued, so that a deletion requested meanwhile is queued after it
+        self._persisted_sessions.add(session.client_id)
+        yield from self._call_persistence(
+            'save_session', session=session, subscriptions=subscriptions, state=session.persistent_state())
+
+    @asyncio.coroutine
+    def _save_sessions(self):
+        """
+        Save all persistent sessions, on shutdown
+        """
+        if not self._persistence_plugins:
+            return
+        saves = []
+        for session, handler in self._sessions.values():
+            if session.clean_session:
+                continue
+            if session.client_id in self._unloaded_sessions:
+                if not session.retained_messages.memory_records():
+                    # Saved state is still up to date
+                    continue
+                yield from self._load_session(session)
+            saves.append(self._save_session(session))
+        if saves:
+            # Saved concurrently, so that they are committed together
+            yield from asyncio.gather(*saves, loop=self._loop)
+            self.logger.info("%d persistent sessions saved" % len(saves))
+
+    @asyncio.coroutine
+    def _delete_persisted_session(self, client_id):
+        if client_id in self._persisted_sessions:
+            self._persisted_sessions.discard(client_id)
+            yield from self._call_persistence('del_session', client_id=client_id)
 
     def _get_handler(self, session):
         client_id = session.client_id
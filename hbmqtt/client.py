@@ -17,9 +17,6 @@ from hbmqtt.adapters import StreamReaderAdapter, StreamWriterAdapter, WebSockets
 from hbmqtt.plugins.manager import PluginManager, BaseContext
 from hbmqtt.mqtt.protocol.handler import ProtocolHandlerException
 from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
-import websockets
-from websockets.uri import InvalidURI
-from websockets.exceptions import InvalidHandshake
 from collections import deque
 
 
@@ -382,6 +379,13 @@ class MQTTClient:
                 sc.check_hostname = self.config['check_hostname']
             kwargs['ssl'] = sc
 
+        if scheme in ('ws', 'wss'):
+            # websockets is only imported when a WebSocket connection is used
+            import websockets
+            from websockets.uri import InvalidURI
+            from websockets.exceptions import InvalidHandshake
+        else:
+            InvalidURI = InvalidHandshake = ()
         try:
             reader = None
             writer = None
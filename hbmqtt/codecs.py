@@ -2,8 +2,8 @@
 #
 # See the file license.txt for copying permission.
 import asyncio
-from struct import pack, unpack
-from hbmqtt.errors import NoDataException
+from struct import pack, unpack, unpack_from
+from hbmqtt.errors import CodecException, NoDataException
 
 
 def bytes_to_hex_str(data):
@@ -110,6 +110,70 @@ def decode_packet_id(reader) -> int:
     return packet_id[0]
 
 
+class BytesDecoder:
+    """
+    Decode MQTT fields from a packet held in memory, without any copy until values are built.
+    CodecException is raised when reading past the end of the buffer.
+    :param data: bytes-like object
+    """
+
+    __slots__ = ('data', 'offset', 'end')
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.end = len(self.data)
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.offset
+
+    def read(self, n) -> memoryview:
+        """
+        Read n bytes
+        :return: memoryview of the bytes read
+        """
+        end = self.offset + n
+        if end > self.end:
+            raise CodecException("Packet truncated: %d bytes expected, %d available" % (n, self.end - self.offset))
+        data = self.data[self.offset:end]
+        self.offset = end
+        return data
+
+    def read_byte(self) -> int:
+        if self.offset >= self.end:
+            raise CodecException("Packet truncated: 1 byte expected, 0 available")
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def read_packet_id(self) -> int:
+        """
+        Read a packet ID as 2-bytes int according to MQTT specification (2.3.1)
+        """
+        if self.offset + 2 > self.end:
+            raise CodecException("Packet truncated: 2 bytes expected, %d available" % (self.end - self.offset))
+        value, = unpack_from("!H", self.data, self.offset)
+        self.offset += 2
+        return value
+
+    def read_string(self) -> str:
+        """
+        Read a string according to MQTT string specification
+        """
+        data = self.read(self.read_packet_id())
+        try:
+            return str(data, encoding='utf-8')
+        except UnicodeDecodeError:
+            return str(bytes(data))
+
+    def read_data_with_length(self) -> bytes:
+        """
+        Read data prefixed with 2 bytes length
+        """
+        return bytes(self.read(self.read_packet_id()))
+
+
 def int_to_bytes_str(value: int) -> bytes:
     """
     Converts a int value to a bytes array containing the numeric character.
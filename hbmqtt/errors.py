@@ -29,3 +29,10 @@ class NoDataException(Exception):
     Exceptions thrown by packet encode/decode functions
     """
     pass
+
+
+class QueueOverflowError(HBMQTTException):
+    """
+    Exception thrown when a full queue with the 'disconnect' overload policy is given a new item
+    """
+    pass
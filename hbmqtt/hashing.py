@@ -0,0 +1,136 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import logging
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+
+# passlib is imported on first use, it takes a noticeable part of the broker import time
+def hash_secret(secret):
+    """
+    Hash a password or device key for storage in the password file
+    """
+    from passlib.hash import sha256_crypt
+    return sha256_crypt.hash(secret)
+
+
+def verify_secret(secret, secret_hash):
+    """
+    Check a password or device key against its stored hash
+    """
+    from passlib.apps import custom_app_context as pwd_context
+    return pwd_context.verify(secret, secret_hash)
+
+
+def _init_worker():
+    # Workers are stopped by the broker on shutdown, ignore interruptions sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Import passlib before the first call
+    import passlib.apps
+
+
+def _pool_context():
+    # Workers are started from a fresh process rather than forked from the broker, which has open sockets and
+    # running threads by the time of the first call
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class HashingPool:
+    """
+    Runs password hashing and verification out of the event loop.
+
+    Hash functions are deliberately slow, running them on the event loop delays every other client of the broker.
+    Calls are run in a pool of ``workers`` processes, started on the first call unless :meth:`start` is called
+    before, so that brokers which never hash anything don't run any. At most ``max_pending`` calls are submitted to
+    the pool at a time, following ones wait for a slot so a connection storm doesn't build an unbounded backlog in
+    the executor.
+
+    Workers don't inherit the broker process, they import its main module like any ``forkserver`` or ``spawn``
+    process: scripts running a broker must start it under ``if __name__ == '__main__':``.
+
+    :param workers: number of worker processes, defaults to the number of CPUs. If 0, calls are run on the
+        event loop.
+    :param max_pending: maximum number of calls submitted to the pool, unlimited if <= 0
+    :param loop: asyncio loop to use
+    """
+
+    def __init__(self, workers=None, max_pending=0, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        if loop is not None:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        if max_pending > 0:
+            self._semaphore = asyncio.Semaphore(max_pending, loop=self._loop)
+        else:
+            self._semaphore = None
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context(),
+                                                 initializer=_init_worker)
+        return self._executor
+
+    @asyncio.coroutine
+    def start(self):
+        """
+        Start worker processes now instead of on the first call
+
+        This method is a *coroutine*.
+        """
+        if self.workers != 0:
+            yield from self._loop.run_in_executor(self._get_executor(), int)
+
+    @asyncio.coroutine
+    def _run(self, func, *args):
+        if self.workers == 0:
+            return func(*args)
+        if self._semaphore is not None:
+            yield from self._semaphore.acquire()
+        try:
+            return (yield from self._loop.run_in_executor(self._get_executor(), func, *args))
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    @asyncio.coroutine
+    def hash(self, secret):
+        """
+        Hash a secret
+
+        This method is a *coroutine*.
+        :param secret: password or device key
+        :return: hash of the secret
+        """
+        return (yield from self._run(hash_secret, secret))
+
+    @asyncio.coroutine
+    def verify(self, secret, secret_hash):
+        """
+        Check a secret against its hash
+
+        This method is a *coroutine*.
+        :param secret: password or device key
+        :param secret_hash: hash of the expected secret
+        :return: True if the secret matches
+        """
+        return (yield from self._run(verify_secret, secret, secret_hash))
+
+    @asyncio.coroutine
+    def shutdown(self):
+        """
+        Stop worker processes, calls in progress are completed
+
+        This method is a *coroutine*.
+        """
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            # Waiting for worker processes blocks, don't do it on the event loop
+            yield from self._loop.run_in_executor(None, executor.shutdown)
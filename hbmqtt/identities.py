@@ -0,0 +1,396 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Users, devices and topic ACL storage shared by the authentication, registration and topic ACL plugins.
+
+The backend is selected by the broker configuration ``identities`` section::
+
+    identities:
+      backend: sqlite   # or yaml, the default
+      file: identities.db
+
+Without this section, plugins use the YAML file of their own configuration (``auth: password-file`` and
+``topic-check: acl: file``).
+
+Existing YAML files can be imported in a SQLite database with::
+
+    python -m hbmqtt.identities users.yaml identities.db
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hbmqtt.utils import YamlFileStore, read_yaml_config
+
+
+ACL_KEYS = ('acl_publish_all', 'acl_subscribe_all', 'acl_publish', 'acl_subscribe')
+
+
+def open_identity_store(config, yaml_file):
+    """
+    Get the identity store configured in the broker configuration
+    :param config: broker configuration
+    :param yaml_file: YAML file used when no ``identities`` section is configured
+    :return: :class:`IdentityStore` instance, shared by all callers using the same file. None if no file is
+        configured.
+    """
+    identities_config = config.get('identities', None) or dict()
+    backend = identities_config.get('backend', 'yaml')
+    if backend == 'sqlite':
+        return SQLiteIdentityStore.open(identities_config['file'])
+    elif backend == 'yaml':
+        yaml_file = identities_config.get('file', yaml_file)
+        return YamlIdentityStore.open(yaml_file) if yaml_file else None
+    raise ValueError("Unknown identities backend '%s'" % backend)
+
+
+def _empty_acl():
+    return {'acl_publish_all': [], 'acl_subscribe_all': [], 'acl_publish': {}, 'acl_subscribe': {}}
+
+
+class IdentityStore:
+    """
+    Users, devices and topic ACL storage interface.
+
+    Read methods are called from the event loop and must be fast. Changes are made by *coroutines* which return once
+    they are persisted. :attr:`version` is incremented when identities change, in this process or in another one.
+
+    ACL changes are given as a dict of new topics in the YAML file layout::
+
+        {'acl_publish_all': [topic, ...], 'acl_subscribe_all': [...],
+         'acl_publish': {deviceid: [topic, ...]}, 'acl_subscribe': {deviceid: [...]}}
+    """
+    _stores = dict()
+
+    version = 0
+
+    @classmethod
+    def open(cls, path):
+        """
+        Get the store of a file, creating it on first use
+        """
+        key = (cls, os.path.realpath(path))
+        if key not in IdentityStore._stores:
+            IdentityStore._stores[key] = cls(path)
+        return IdentityStore._stores[key]
+
+    def refresh(self, check_now=False):
+        """
+        Check for changes made by other processes
+        :param check_now: check even if last check is recent
+        """
+
+    def users_count(self):
+        raise NotImplementedError
+
+    def has_user(self, username):
+        raise NotImplementedError
+
+    def has_device(self, username, deviceid):
+        raise NotImplementedError
+
+    def get_credentials(self, username, deviceid):
+        """
+        :return: (password hash, device key hash) tuple, None if the user or the device doesn't exist
+        """
+        raise NotImplementedError
+
+    def get_acl(self, username, deviceid, publish):
+        """
+        :param deviceid: device ID, None for the topics allowed to all devices of the user
+        :param publish: True for publish ACL, False for subscribe ACL
+        :return: list of allowed topics
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def add_user(self, username, password_hash, deviceid, key_hash):
+        """
+        Add a user and its first device, with an empty ACL
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def add_device(self, username, deviceid, key_hash):
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def add_acl(self, username, topics):
+        """
+        Add topics to the ACL of a user
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+
+class YamlIdentityStore(IdentityStore):
+    """
+    Identities kept in a YAML file, rewritten on every change.
+    :param path: YAML file path
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = YamlFileStore.open(path)
+        self._users = self._file.data
+
+    @property
+    def version(self):
+        return self._file.version
+
+    def refresh(self, check_now=False):
+        self._file.refresh(check_now)
+
+    def users_count(self):
+        return len(self._users)
+
+    def has_user(self, username):
+        return username in self._users
+
+    def has_device(self, username, deviceid):
+        return username in self._users and deviceid in self._users[username]['devices']
+
+    def get_credentials(self, username, deviceid):
+        if not self.has_device(username, deviceid):
+            return None
+        user = self._users[username]
+        return user['password'], user['devices'][deviceid]['key']
+
+    def get_acl(self, username, deviceid, publish):
+        user = self._users.get(username, None)
+        if user is None:
+            return []
+        if deviceid is None:
+            return user['acl_publish_all' if publish else 'acl_subscribe_all']
+        return user['acl_publish' if publish else 'acl_subscribe'].get(deviceid, [])
+
+    def _save(self):
+        backup = self.path + ".bck"
+        # save a backup of our old user database just in case
+        if os.path.isfile(backup):
+            os.remove(backup)
+        if os.path.isfile(self.path):
+            os.rename(self.path, backup)
+        self._file.write()
+
+    @asyncio.coroutine
+    def add_user(self, username, password_hash, deviceid, key_hash):
+        user = {'password': password_hash, 'devices': {deviceid: {'key': key_hash}}}
+        user.update(_empty_acl())
+        user['acl_publish'][deviceid] = []
+        user['acl_subscribe'][deviceid] = []
+        self._users[username] = user
+        self._save()
+
+    @asyncio.coroutine
+    def add_device(self, username, deviceid, key_hash):
+        user = self._users[username]
+        user['devices'][deviceid] = {'key': key_hash}
+        user['acl_publish'][deviceid] = []
+        user['acl_subscribe'][deviceid] = []
+        self._save()
+
+    @asyncio.coroutine
+    def add_acl(self, username, topics):
+        user = self._users[username]
+        user['acl_publish_all'].extend(topics.get('acl_publish_all', []))
+        user['acl_subscribe_all'].extend(topics.get('acl_subscribe_all', []))
+        for key in ('acl_publish', 'acl_subscribe'):
+            for deviceid, device_topics in topics.get(key, dict()).items():
+                user[key].setdefault(deviceid, []).extend(device_topics)
+        self._save()
+
+
+class SQLiteIdentityStore(IdentityStore):
+    """
+    Identities kept in a SQLite database.
+
+    Lookups use indexes on user and device. Changes are run as transactions in a dedicated writer thread, with their
+    own connection, so they don't block the event loop. Changes made by other connections, including other broker
+    processes, are detected with ``PRAGMA data_version``, checked at most once every ``check_interval`` seconds.
+
+    :param path: database file path
+    :param check_interval: minimum delay in seconds between two checks for changes
+    """
+    # ACL rows of topics allowed to all devices of a user
+    ALL_DEVICES = ''
+
+    def __init__(self, path, check_interval=1):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self._checked_at = 0
+        self._users_count = None
+        self._writer = None
+        self._writer_local = threading.local()
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS users("
+                               "username TEXT PRIMARY KEY, password TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS devices("
+                               "username TEXT, deviceid TEXT, key TEXT, "
+                               "PRIMARY KEY (username, deviceid)) WITHOUT ROWID")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS acl("
+                               "username TEXT, deviceid TEXT, publish INTEGER, topic TEXT, "
+                               "PRIMARY KEY (username, deviceid, publish, topic)) WITHOUT ROWID")
+        self._data_version = self._get_data_version()
+
+    def _get_data_version(self):
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _changed(self):
+        self.version += 1
+        self._users_count = None
+
+    def refresh(self, check_now=False):
+        now = time.monotonic()
+        if not check_now and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        data_version = self._get_data_version()
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._changed()
+
+    def users_count(self):
+        if self._users_count is None:
+            self._users_count = self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return self._users_count
+
+    def has_user(self, username):
+        return self._conn.execute("SELECT 1 FROM users WHERE username=?", (username,)).fetchone() is not None
+
+    def has_device(self, username, deviceid):
+        return self._conn.execute("SELECT 1 FROM devices WHERE username=? AND deviceid=?",
+                                  (username, deviceid)).fetchone() is not None
+
+    def get_credentials(self, username, deviceid):
+        row = self._conn.execute("SELECT users.password, devices.key FROM users "
+                                 "JOIN devices ON devices.username = users.username "
+                                 "WHERE users.username=? AND devices.deviceid=?", (username, deviceid)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def get_acl(self, username, deviceid, publish):
+        if deviceid is None:
+            deviceid = self.ALL_DEVICES
+        rows = self._conn.execute("SELECT topic FROM acl WHERE username=? AND deviceid=? AND publish=?",
+                                  (username, deviceid, int(publish)))
+        return [row[0] for row in rows]
+
+    def _writer_connection(self):
+        # Runs in the writer thread, which owns its connection
+        conn = getattr(self._writer_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._writer_local.conn = conn
+        return conn
+
+    def _run_transaction(self, statements):
+        conn = self._writer_connection()
+        with conn:
+            for sql, parameters in statements:
+                conn.executemany(sql, parameters)
+
+    def _close_writer_connection(self):
+        conn = getattr(self._writer_local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._writer_local.conn = None
+
+    @asyncio.coroutine
+    def _write(self, statements):
+        """
+        Run statements in a transaction of the writer thread
+        :param statements: list of (sql, list of parameters) tuples
+        """
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1)
+        yield from asyncio.get_event_loop().run_in_executor(self._writer, self._run_transaction, statements)
+        self._changed()
+
+    @asyncio.coroutine
+    def add_user(self, username, password_hash, deviceid, key_hash):
+        yield from self._write([
+            ("INSERT INTO users (username, password) VALUES (?,?)", [(username, password_hash)]),
+            ("INSERT INTO devices (username, deviceid, key) VALUES (?,?,?)", [(username, deviceid, key_hash)]),
+        ])
+
+    @asyncio.coroutine
+    def add_device(self, username, deviceid, key_hash):
+        yield from self._write([
+            ("INSERT INTO devices (username, deviceid, key) VALUES (?,?,?)", [(username, deviceid, key_hash)]),
+        ])
+
+    @staticmethod
+    def _acl_rows(username, topics):
+        rows = []
+        for key, publish in (('acl_publish_all', 1), ('acl_subscribe_all', 0)):
+            rows.extend((username, SQLiteIdentityStore.ALL_DEVICES, publish, topic) for topic in topics.get(key, []))
+        for key, publish in (('acl_publish', 1), ('acl_subscribe', 0)):
+            for deviceid, device_topics in topics.get(key, dict()).items():
+                rows.extend((username, deviceid, publish, topic) for topic in device_topics)
+        return rows
+
+    @asyncio.coroutine
+    def add_acl(self, username, topics):
+        yield from self._write([
+            ("INSERT OR IGNORE INTO acl (username, deviceid, publish, topic) VALUES (?,?,?,?)",
+             self._acl_rows(username, topics)),
+        ])
+
+    @asyncio.coroutine
+    def import_users(self, users):
+        """
+        Import users of a YAML password file in a single transaction, existing entries are replaced
+        :param users: users dict, as loaded from the YAML file
+        """
+        user_rows = []
+        device_rows = []
+        acl_rows = []
+        for username, user in users.items():
+            user_rows.append((username, user.get('password', None)))
+            for deviceid, device in (user.get('devices', None) or dict()).items():
+                device_rows.append((username, deviceid, device.get('key', None)))
+            acl_rows.extend(self._acl_rows(username, dict((key, user.get(key, None) or _empty_acl()[key])
+                                                          for key in ACL_KEYS)))
+        yield from self._write([
+            ("INSERT OR REPLACE INTO users (username, password) VALUES (?,?)", user_rows),
+            ("INSERT OR REPLACE INTO devices (username, deviceid, key) VALUES (?,?,?)", device_rows),
+            ("INSERT OR IGNORE INTO acl (username, deviceid, publish, topic) VALUES (?,?,?,?)", acl_rows),
+        ])
+
+    @asyncio.coroutine
+    def close(self):
+        """
+        Wait for pending changes and stop the writer thread
+        """
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            yield from asyncio.get_event_loop().run_in_executor(writer, self._close_writer_connection)
+            writer.shutdown()
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: python -m hbmqtt.identities <users.yaml> <identities.db>")
+        sys.exit(1)
+    users = read_yaml_config(sys.argv[1]) or dict()
+    store = SQLiteIdentityStore(sys.argv[2])
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(store.import_users(users))
+    loop.run_until_complete(store.close())
+    print("%d users imported" % store.users_count())
+
+
+if __name__ == '__main__':
+    main()
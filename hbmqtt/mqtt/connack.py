@@ -3,7 +3,7 @@
 # See the file license.txt for copying permission.
 import asyncio
 from hbmqtt.mqtt.packet import CONNACK, MQTTPacket, MQTTFixedHeader, MQTTVariableHeader
-from hbmqtt.codecs import read_or_raise, bytes_to_int
+from hbmqtt.codecs import read_or_raise, bytes_to_int, BytesDecoder
 from hbmqtt.errors import HBMQTTException
 from hbmqtt.adapters import ReaderAdapter
 
@@ -32,6 +32,12 @@ class ConnackVariableHeader(MQTTVariableHeader):
         return_code = bytes_to_int(data[1])
         return cls(session_parent, return_code)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader):
+        session_parent = decoder.read_byte() & 0x01
+        return_code = decoder.read_byte()
+        return cls(session_parent, return_code)
+
     def to_bytes(self):
         out = bytearray(2)
         # Connect acknowledge flags
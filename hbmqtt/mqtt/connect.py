@@ -3,7 +3,7 @@
 # See the file license.txt for copying permission.
 import asyncio
 
-from hbmqtt.codecs import bytes_to_int, decode_data_with_length, decode_string, encode_data_with_length, encode_string, int_to_bytes, read_or_raise
+from hbmqtt.codecs import bytes_to_int, decode_data_with_length, decode_string, encode_data_with_length, encode_string, int_to_bytes, read_or_raise, BytesDecoder
 from hbmqtt.mqtt.packet import MQTTPacket, MQTTFixedHeader, CONNECT, MQTTVariableHeader, MQTTPayload
 from hbmqtt.errors import HBMQTTException, NoDataException
 from hbmqtt.adapters import ReaderAdapter
@@ -118,6 +118,14 @@ class ConnectVariableHeader(MQTTVariableHeader):
 
         return cls(flags, keep_alive, protocol_name, protocol_level)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader):
+        protocol_name = decoder.read_string()
+        protocol_level = decoder.read_byte()
+        flags = decoder.read_byte()
+        keep_alive = decoder.read_packet_id()
+        return cls(flags, keep_alive, protocol_name, protocol_level)
+
     def to_bytes(self):
         out = bytearray()
 
@@ -198,6 +206,29 @@ class ConnectPayload(MQTTPayload):
 
         return payload
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader, variable_header: ConnectVariableHeader):
+        payload = cls()
+        # Fields missing at the end of the packet are None, as when decoding from a stream
+        #  Client identifier
+        payload.client_id = decoder.read_string() if decoder.remaining else None
+        if (payload.client_id is None or payload.client_id == ""):
+            # A Server MAY allow a Client to supply a ClientId that has a length of zero bytes
+            # [MQTT-3.1.3-6]
+            payload.client_id = gen_client_id()
+            # indicator to trow exception in case CLEAN_SESSION_FLAG is set to False
+            payload.client_id_is_random = True
+
+        # Read will topic, username and password
+        if variable_header.will_flag and decoder.remaining:
+            payload.will_topic = decoder.read_string()
+            payload.will_message = decoder.read_data_with_length()
+        if variable_header.username_flag and decoder.remaining:
+            payload.username = decoder.read_string()
+        if variable_header.password_flag and decoder.remaining:
+            payload.password = decoder.read_string()
+        return payload
+
     def to_bytes(self, fixed_header: MQTTFixedHeader, variable_header: ConnectVariableHeader):
         out = bytearray()
         # Client identifier
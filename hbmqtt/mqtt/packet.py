@@ -3,11 +3,10 @@
 # See the file license.txt for copying permission.
 import asyncio
 
-from hbmqtt.codecs import bytes_to_hex_str, decode_packet_id, int_to_bytes, read_or_raise
+from hbmqtt.codecs import bytes_to_hex_str, decode_packet_id, int_to_bytes, read_or_raise, BytesDecoder
 from hbmqtt.errors import CodecException, MQTTException, NoDataException
 from hbmqtt.adapters import ReaderAdapter, WriterAdapter
 from datetime import datetime
-from struct import unpack
 
 
 RESERVED_0 = 0x00
@@ -76,40 +75,68 @@ class MQTTFixedHeader:
     def from_stream(cls, reader: ReaderAdapter):
         """
         Read and decode MQTT message fixed header from stream
+        The first two bytes are read at once, following bytes only if the remaining length needs them.
         :return: FixedHeader instance
         """
-        @asyncio.coroutine
-        def decode_remaining_length():
-            """
-            Decode message length according to MQTT specifications
-            :return:
-            """
-            multiplier = 1
-            value = 0
-            buffer = bytearray()
+        try:
+            data = yield from read_or_raise(reader, 2)
+        except NoDataException:
+            return None
+        if len(data) < 2:
+            return None
+        msg_type = data[0] >> 4
+        flags = data[0] & 0x0f
+        value = data[1] & 0x7f
+        if data[1] & 0x80:
+            buffer = bytearray(data[1:])
+            multiplier = 128
             while True:
-                encoded_byte = yield from reader.read(1)
-                int_byte = unpack('!B', encoded_byte)
-                buffer.append(int_byte[0])
-                value += (int_byte[0] & 0x7f) * multiplier
-                if (int_byte[0] & 0x80) == 0:
+                try:
+                    encoded_byte = yield from read_or_raise(reader, 1)
+                except NoDataException:
+                    return None
+                buffer.append(encoded_byte[0])
+                value += (encoded_byte[0] & 0x7f) * multiplier
+                if (encoded_byte[0] & 0x80) == 0:
                     break
-                else:
-                    multiplier *= 128
-                    if multiplier > 128 * 128 * 128:
-                        raise MQTTException("Invalid remaining length bytes:%s, packet_type=%d" % (bytes_to_hex_str(buffer), msg_type))
-            return value
+                multiplier *= 128
+                if multiplier > 128 * 128 * 128:
+                    raise MQTTException("Invalid remaining length bytes:%s, packet_type=%d" %
+                                        (bytes_to_hex_str(buffer), msg_type))
+        return cls(msg_type, flags, value)
 
-        try:
-            byte1 = yield from read_or_raise(reader, 1)
-            int1 = unpack('!B', byte1)
-            msg_type = (int1[0] & 0xf0) >> 4
-            flags = int1[0] & 0x0f
-            remain_length = yield from decode_remaining_length()
+    @classmethod
+    def decode(cls, decoder: BytesDecoder):
+        """
+        Decode MQTT message fixed header from a buffer
+        :return: FixedHeader instance
+        """
+        data, offset = decoder.data, decoder.offset
+        if decoder.end - offset >= 2 and not data[offset + 1] & 0x80:
+            # Remaining length < 128, encoded in a single byte
+            decoder.offset += 2
+            return cls(data[offset] >> 4, data[offset] & 0x0f, data[offset + 1])
+        byte1 = decoder.read_byte()
+        multiplier = 1
+        value = 0
+        while True:
+            encoded_byte = decoder.read_byte()
+            value += (encoded_byte & 0x7f) * multiplier
+            if (encoded_byte & 0x80) == 0:
+                break
+            multiplier *= 128
+            if multiplier > 128 * 128 * 128:
+                raise MQTTException("Invalid remaining length, packet_type=%d" % (byte1 >> 4))
+        return cls(byte1 >> 4, byte1 & 0x0f, value)
 
-            return cls(msg_type, flags, remain_length)
-        except NoDataException:
-            return None
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Decode MQTT message fixed header from the beginning of a buffer
+        :param data: bytes-like object
+        :return: FixedHeader instance
+        """
+        return cls.decode(BytesDecoder(data))
 
     def __repr__(self):
         return type(self).__name__ + '(length={0}, flags={1})'.\
@@ -140,6 +167,10 @@ class MQTTVariableHeader:
     def from_stream(cls, reader: asyncio.StreamReader, fixed_header: MQTTFixedHeader):
         pass
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader):
+        pass
+
 
 class PacketIdVariableHeader(MQTTVariableHeader):
 
@@ -160,6 +191,10 @@ class PacketIdVariableHeader(MQTTVariableHeader):
         packet_id = yield from decode_packet_id(reader)
         return cls(packet_id)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader):
+        return cls(decoder.read_packet_id())
+
     def __repr__(self):
         return type(self).__name__ + '(packet_id={0})'.format(self.packet_id)
 
@@ -182,6 +217,10 @@ class MQTTPayload:
                     variable_header: MQTTVariableHeader):
         pass
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader, variable_header: MQTTVariableHeader):
+        pass
+
 
 class MQTTPacket:
 
@@ -221,18 +260,63 @@ class MQTTPacket:
     @classmethod
     @asyncio.coroutine
     def from_stream(cls, reader: ReaderAdapter, fixed_header=None, variable_header=None):
+        """
+        Read a packet from a stream: the fixed header, then the rest of the packet at once
+        :param reader: reader adapter
+        :param fixed_header: fixed header, if already read
+        :param variable_header: variable header, if already read (the rest of the packet is then decoded field by
+            field from the stream)
+        :return: packet instance
+        """
         if fixed_header is None:
             fixed_header = yield from cls.FIXED_HEADER.from_stream(reader)
+            if fixed_header is None:
+                raise NoDataException("No more data")
+        if variable_header is not None:
+            return (yield from cls._from_stream_fields(reader, fixed_header, variable_header))
+        if fixed_header.remaining_length:
+            data = yield from read_or_raise(reader, fixed_header.remaining_length)
+        else:
+            data = b''
+        return cls.from_bytes(data, fixed_header)
+
+    @classmethod
+    @asyncio.coroutine
+    def _from_stream_fields(cls, reader: ReaderAdapter, fixed_header, variable_header):
+        if cls.PAYLOAD:
+            payload = yield from cls.PAYLOAD.from_stream(reader, fixed_header, variable_header)
+        else:
+            payload = None
+        return cls._build(fixed_header, variable_header, payload)
+
+    @classmethod
+    def from_bytes(cls, data, fixed_header=None):
+        """
+        Decode a packet held in memory
+        :param data: bytes-like object, holding the whole packet, or only its variable header and payload if
+            fixed_header is given
+        :param fixed_header: fixed header, if already decoded
+        :return: packet instance
+        """
+        decoder = BytesDecoder(data)
+        if fixed_header is None:
+            fixed_header = cls.FIXED_HEADER.decode(decoder)
+        if decoder.remaining < fixed_header.remaining_length:
+            raise CodecException("Packet truncated: %d bytes expected, %d available" %
+                                 (fixed_header.remaining_length, decoder.remaining))
+        decoder.end = decoder.offset + fixed_header.remaining_length
         if cls.VARIABLE_HEADER:
-            if variable_header is None:
-                variable_header = yield from cls.VARIABLE_HEADER.from_stream(reader, fixed_header)
+            variable_header = cls.VARIABLE_HEADER.decode(decoder, fixed_header)
         else:
             variable_header = None
         if cls.PAYLOAD:
-            payload = yield from cls.PAYLOAD.from_stream(reader, fixed_header, variable_header)
+            payload = cls.PAYLOAD.decode(decoder, fixed_header, variable_header)
         else:
             payload = None
+        return cls._build(fixed_header, variable_header, payload)
 
+    @classmethod
+    def _build(cls, fixed_header, variable_header, payload):
         if fixed_header and not variable_header and not payload:
             instance = cls(fixed_header)
         elif fixed_header and not payload:
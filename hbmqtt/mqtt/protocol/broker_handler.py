@@ -3,6 +3,8 @@
 # See the file license.txt for copying permission.
 import asyncio
 from asyncio import futures, Queue
+from collections import deque
+from functools import partial
 from hbmqtt.mqtt.protocol.handler import ProtocolHandler
 from hbmqtt.mqtt.connack import (
     CONNECTION_ACCEPTED, UNACCEPTABLE_PROTOCOL_VERSION, IDENTIFIER_REJECTED,
@@ -14,37 +16,252 @@ from hbmqtt.mqtt.subscribe import SubscribePacket
 from hbmqtt.mqtt.suback import SubackPacket
 from hbmqtt.mqtt.unsubscribe import UnsubscribePacket
 from hbmqtt.mqtt.unsuback import UnsubackPacket
+from hbmqtt.mqtt.pubrel import PubrelPacket
+from hbmqtt.mqtt.constants import QOS_1, QOS_2
 from hbmqtt.utils import format_client_message
-from hbmqtt.session import Session
+from hbmqtt.session import Session, OutgoingApplicationMessage
 from hbmqtt.plugins.manager import PluginManager
 from hbmqtt.adapters import ReaderAdapter, WriterAdapter
-from hbmqtt.errors import MQTTException
+from hbmqtt.errors import MQTTException, QueueOverflowError
+from hbmqtt.queues import OverloadQueue, POLICY_DROP_QOS0
 from .handler import EVENT_MQTT_PACKET_RECEIVED, EVENT_MQTT_PACKET_SENT
 
 
+DEFAULT_OUTBOUND_QUEUE_SIZE = 1000
+DEFAULT_OUTBOUND_QUEUE_POLICY = POLICY_DROP_QOS0
+OUTBOUND_BATCH_SIZE = 64
+
+
 class BrokerProtocolHandler(ProtocolHandler):
-    def __init__(self, plugins_manager: PluginManager, session: Session=None, loop=None):
+    def __init__(self, plugins_manager: PluginManager, session: Session=None, loop=None,
+                 outbound_queue_size=DEFAULT_OUTBOUND_QUEUE_SIZE, outbound_queue_policy=DEFAULT_OUTBOUND_QUEUE_POLICY,
+                 queue_counters=None):
         super().__init__(plugins_manager, session, loop)
         self._disconnect_waiter = None
         self._pending_subscriptions = Queue(loop=self._loop)
         self._pending_unsubscriptions = Queue(loop=self._loop)
 
+        # PUBLISH messages waiting to be written by the outbound writer task, and PUBREL packets which never wait
+        # for room nor get dropped
+        self._outbound_queue = OverloadQueue(outbound_queue_size, outbound_queue_policy, 'outbound', queue_counters,
+                                             loop=self._loop)
+        self._outbound_packets = deque()
+        # Messages taken from the queue but not written when the writer failed, and messages queued once the
+        # handler is closed, returned with the queue content by pending_outbound_messages()
+        self._outbound_unsent = []
+        self._outbound_held = []
+        self._outbound_ready = asyncio.Event(loop=self._loop)
+        self._outbound_room = asyncio.Event(loop=self._loop)
+        self._outbound_task = None
+        self._outbound_closed = False
+        self._outbound_overflowed = False
+        self._outbound_detached = False
+
     @asyncio.coroutine
     def start(self):
         yield from super().start()
         if self._disconnect_waiter is None:
             self._disconnect_waiter = futures.Future(loop=self._loop)
+            # Stop queueing messages once the client is disconnecting
+            self._disconnect_waiter.add_done_callback(lambda waiter: self._close_outbound())
+        if self._outbound_task is None:
+            self._outbound_task = asyncio.ensure_future(self._outbound_loop(), loop=self._loop)
+
+    def _close_outbound(self):
+        self._outbound_closed = True
+        # Wake up publishers waiting for room, they will find the handler closed
+        self._outbound_room.set()
 
     @asyncio.coroutine
     def stop(self):
+        self._close_outbound()
+        if self._outbound_overflowed:
+            # Client doesn't read what is written to it, closing would wait for the write buffer to be flushed
+            self.writer.abort()
+        if self._outbound_task is not None and not self._outbound_task.done():
+            self._outbound_task.cancel()
         yield from super().stop()
         if self._disconnect_waiter is not None and not self._disconnect_waiter.done():
             self._disconnect_waiter.set_result(None)
 
+    @property
+    def outbound_queue_depth(self):
+        return self._outbound_queue.qsize()
+
+    @asyncio.coroutine
+    def mqtt_enqueue_publish(self, topic, data, qos, retain):
+        """
+        Queue a PUBLISH message to be sent by the handler writer task, waiting while the outbound queue is full.
+        Used for messages sent to this client only, such as retained and offline messages.
+        :param topic: MQTT topic to publish
+        :param data: data to send on topic
+        :param qos: quality of service to use for message flow. Can be QOS_0, QOS_1 or QOS_2
+        :param retain: retain message flag
+        :return: False if the message has not been queued nor held since the handler is closed
+        """
+        while self._outbound_queue.full() and not self._outbound_closed:
+            self._outbound_room.clear()
+            yield from self._outbound_room.wait()
+        return self.mqtt_enqueue_publish_nowait(topic, data, qos, retain)
+
+    def mqtt_enqueue_publish_nowait(self, topic, data, qos, retain, publish_frame=None):
+        """
+        Queue a PUBLISH message to be sent by the handler writer task, without waiting for the message to be sent
+        or acknowledged. If the outbound queue is full, its overload policy applies: the message or the oldest one
+        is dropped, or the client is disconnected. Once the handler is closed, up to the outbound queue size of
+        messages are held until :meth:`pending_outbound_messages` is called, so that they follow the messages still
+        queued.
+        :param topic: MQTT topic to publish
+        :param data: data to send on topic
+        :param qos: quality of service to use for message flow. Can be QOS_0, QOS_1 or QOS_2
+        :param retain: retain message flag
+        :param publish_frame: PublishFrame already encoded for topic, data and qos, shared with other sessions
+        :return: False if the message has not been queued nor held since the handler is closed
+        """
+        if self._outbound_detached:
+            return False
+        # Packet ID is given when the message is written
+        message = OutgoingApplicationMessage(None, topic, qos, data, retain, publish_frame)
+        if self._outbound_closed:
+            if 0 < self._outbound_queue.maxsize <= len(self._outbound_held):
+                return False
+            self._outbound_held.append(message)
+            return True
+        try:
+            self._outbound_queue.offer(message, qos)
+        except QueueOverflowError as qoe:
+            self.logger.warning("%s %s, disconnecting slow client" % (format_client_message(self.session), qoe))
+            self._outbound_held.append(message)
+            self._outbound_overflowed = True
+            self._close_outbound()
+            if self._disconnect_waiter is not None and not self._disconnect_waiter.done():
+                self._disconnect_waiter.set_result(None)
+            return True
+        self._outbound_ready.set()
+        return True
+
+    def pending_outbound_messages(self):
+        """
+        Remove messages which have not been written yet from a stopped handler, which doesn't take messages anymore
+        :return: list of OutgoingApplicationMessage
+        """
+        self._outbound_detached = True
+        messages = self._outbound_unsent
+        self._outbound_unsent = []
+        while not self._outbound_queue.empty():
+            messages.append(self._outbound_queue.get_nowait())
+        messages.extend(self._outbound_held)
+        self._outbound_held = []
+        return messages
+
+    @asyncio.coroutine
+    def _outbound_loop(self):
+        """
+        Writer task: write queued messages in batches, with a single drain per batch.
+        QOS_1/QOS_2 acknowledgments are followed with waiter callbacks, so no task is created per message.
+        """
+        try:
+            while True:
+                if self._outbound_queue.empty() and not self._outbound_packets:
+                    self._outbound_ready.clear()
+                    yield from self._outbound_ready.wait()
+                items = list(self._outbound_packets)
+                self._outbound_packets.clear()
+                while not self._outbound_queue.empty() and len(items) < OUTBOUND_BATCH_SIZE:
+                    items.append(self._outbound_queue.get_nowait())
+                self._outbound_room.set()
+                for index, item in enumerate(items):
+                    try:
+                        self._write_outbound(item)
+                    except BaseException:
+                        # Messages after the failing one are kept for pending_outbound_messages()
+                        self._outbound_unsent.extend(
+                            unsent for unsent in items[index + 1:] if isinstance(unsent, OutgoingApplicationMessage))
+                        raise
+                yield from self.writer.drain()
+                if self._keepalive_task:
+                    self._keepalive_task.cancel()
+                    self._keepalive_task = self._loop.call_later(self.keepalive_timeout, self.handle_write_timeout)
+                if self.plugins_manager.has_event_handlers(EVENT_MQTT_PACKET_SENT):
+                    # PUBLISH packets written from a frame are only built for plugins
+                    for item in items:
+                        if isinstance(item, OutgoingApplicationMessage):
+                            item = item.publish_packet
+                        yield from self.plugins_manager.fire_event(
+                            EVENT_MQTT_PACKET_SENT, packet=item, session=self.session)
+        except asyncio.CancelledError:
+            pass
+        except BaseException as e:
+            self.logger.warning("Outbound writer stopped: %r" % e)
+            yield from self.handle_connection_closed()
+
+    def _write_outbound(self, item):
+        if not isinstance(item, OutgoingApplicationMessage):
+            # PUBREL packet
+            self.writer.write(item.to_bytes())
+            self.writer.counters.packet_sent()
+            return
+
+        message = item
+        if message.qos in (QOS_1, QOS_2):
+            message.packet_id = self.session.next_packet_id
+            self.session.inflight_out[message.packet_id] = message
+        if message.publish_frame is not None:
+            self.writer.writelines(message.publish_frame.to_buffers(message.packet_id, retain=message.retain))
+            message.frame_sent()
+        else:
+            packet = message.build_publish_packet()
+            message.publish_packet = packet
+            self.writer.write(packet.to_bytes())
+        self.writer.counters.packet_sent(True)
+
+        if message.qos == QOS_1:
+            waiter = futures.Future(loop=self._loop)
+            waiter.add_done_callback(partial(self._outbound_puback_received, message))
+            self._puback_waiters[message.packet_id] = waiter
+        elif message.qos == QOS_2:
+            waiter = futures.Future(loop=self._loop)
+            waiter.add_done_callback(partial(self._outbound_pubrec_received, message))
+            self._pubrec_waiters[message.packet_id] = waiter
+
+    def _outbound_puback_received(self, message, waiter):
+        self._puback_waiters.pop(message.packet_id, None)
+        if waiter.cancelled():
+            # Handler stopped, message stays inflight and will be retried on reconnection
+            return
+        message.puback_packet = waiter.result()
+        self.session.inflight_out.pop(message.packet_id, None)
+
+    def _outbound_pubrec_received(self, message, waiter):
+        self._pubrec_waiters.pop(message.packet_id, None)
+        if waiter.cancelled():
+            return
+        message.pubrec_packet = waiter.result()
+        message.pubrel_packet = PubrelPacket.build(message.packet_id)
+        waiter = futures.Future(loop=self._loop)
+        waiter.add_done_callback(partial(self._outbound_pubcomp_received, message))
+        self._pubcomp_waiters[message.packet_id] = waiter
+        self._outbound_packets.append(message.pubrel_packet)
+        self._outbound_ready.set()
+
+    def _outbound_pubcomp_received(self, message, waiter):
+        self._pubcomp_waiters.pop(message.packet_id, None)
+        if waiter.cancelled():
+            return
+        message.pubcomp_packet = waiter.result()
+        self.session.inflight_out.pop(message.packet_id, None)
+
     @asyncio.coroutine
     def wait_disconnect(self):
         return (yield from self._disconnect_waiter)
 
+    def disconnect(self):
+        """
+        Disconnect the client as if its connection was lost, when another connection takes its client ID over
+        """
+        if self._disconnect_waiter is not None and not self._disconnect_waiter.done():
+            self._disconnect_waiter.set_result(None)
+
     def handle_write_timeout(self):
         pass
 
@@ -116,17 +333,23 @@ class BrokerProtocolHandler(ProtocolHandler):
 
     @classmethod
     @asyncio.coroutine
-    def init_from_connect(cls, reader: ReaderAdapter, writer: WriterAdapter, plugins_manager, loop=None):
+    def init_from_connect(cls, reader: ReaderAdapter, writer: WriterAdapter, plugins_manager, loop=None,
+                          outbound_queue_size=DEFAULT_OUTBOUND_QUEUE_SIZE,
+                          outbound_queue_policy=DEFAULT_OUTBOUND_QUEUE_POLICY, queue_counters=None):
         """
 
         :param reader:
         :param writer:
         :param plugins_manager:
         :param loop:
+        :param outbound_queue_size: maximum number of PUBLISH messages waiting to be written to the client
+        :param outbound_queue_policy: overload policy applied when the outbound queue is full
+        :param queue_counters: Counter shared by broker queues to count overload events
         :return:
         """
         remote_address, remote_port = writer.get_peer_info()
         connect = yield from ConnectPacket.from_stream(reader)
+        reader.counters.packet_received()
         yield from plugins_manager.fire_event(EVENT_MQTT_PACKET_RECEIVED, packet=connect)
         #this shouldn't be required anymore since broker generates for each client a random client_id if not provided
         #[MQTT-3.1.3-6]
@@ -167,6 +390,7 @@ class BrokerProtocolHandler(ProtocolHandler):
         if connack is not None:
             yield from plugins_manager.fire_event(EVENT_MQTT_PACKET_SENT, packet=connack)
             yield from connack.to_stream(writer)
+            writer.counters.packet_sent()
             yield from writer.close()
             raise MQTTException(error_msg)
 
@@ -185,5 +409,6 @@ class BrokerProtocolHandler(ProtocolHandler):
         else:
             incoming_session.keep_alive = 0
 
-        handler = cls(plugins_manager, loop=loop)
+        handler = cls(plugins_manager, loop=loop, outbound_queue_size=outbound_queue_size,
+                      outbound_queue_policy=outbound_queue_policy, queue_counters=queue_counters)
         return handler, incoming_session
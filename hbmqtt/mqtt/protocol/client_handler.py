@@ -82,6 +82,7 @@ class ClientProtocolHandler(ProtocolHandler):
         connect_packet = self._build_connect_packet()
         yield from self._send_packet(connect_packet)
         connack = yield from ConnackPacket.from_stream(self.reader)
+        self.reader.counters.packet_received()
         yield from self.plugins_manager.fire_event(EVENT_MQTT_PACKET_RECEIVED, packet=connack, session=self.session)
         return connack.return_code
 
@@ -115,6 +116,12 @@ class ClientProtocolHandler(ProtocolHandler):
         del self._subscriptions_waiter[subscribe.variable_header.packet_id]
         return return_codes
 
+    @asyncio.coroutine
+    def handle_publish(self, publish_packet):
+        # Payload is decoded as a view of the received packet, applications get bytes
+        publish_packet.data = bytes(publish_packet.data)
+        yield from super().handle_publish(publish_packet)
+
     @asyncio.coroutine
     def handle_suback(self, suback: SubackPacket):
         packet_id = suback.variable_header.packet_id
@@ -31,7 +31,7 @@ from hbmqtt.adapters import ReaderAdapter, WriterAdapter
 from hbmqtt.session import Session, OutgoingApplicationMessage, IncomingApplicationMessage, INCOMING, OUTGOING
 from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
 from hbmqtt.plugins.manager import PluginManager
-from hbmqtt.errors import HBMQTTException, MQTTException, NoDataException
+from hbmqtt.errors import HBMQTTException, MQTTException, NoDataException, QueueOverflowError
 
 
 EVENT_MQTT_PACKET_SENT = 'mqtt_packet_sent'
@@ -223,9 +223,8 @@ class ProtocolHandler:
                 self.logger.warning("[MQTT-3.3.1-2] DUP flag must set to 0 for QOS 0 message. Message ignored: %s" %
                                     repr(app_message.publish_packet))
             else:
-                try:
-                    self.session.delivered_message_queue.put_nowait(app_message)
-                except:
+                queued = yield from self.session.delivered_message_queue.put(app_message, QOS_0)
+                if not queued:
                     self.logger.warning("delivered messages queue full. QOS_0 message discarded")
 
     @asyncio.coroutine
@@ -265,7 +264,7 @@ class ProtocolHandler:
         elif app_message.direction == INCOMING:
             # Initiate delivery
             self.logger.debug("Add message to delivery")
-            yield from self.session.delivered_message_queue.put(app_message)
+            yield from self.session.delivered_message_queue.put(app_message, QOS_1)
             # Send PUBACK
             puback = PubackPacket.build(app_message.packet_id)
             yield from self._send_packet(puback)
@@ -343,7 +342,7 @@ class ProtocolHandler:
                 del self._pubrel_waiters[app_message.packet_id]
                 app_message.pubrel_packet = waiter.result()
                 # Initiate delivery and discard message
-                yield from self.session.delivered_message_queue.put(app_message)
+                yield from self.session.delivered_message_queue.put(app_message, QOS_2)
                 del self.session.inflight_in[app_message.packet_id]
                 # Send pubcomp
                 pubcomp_packet = PubcompPacket.build(app_message.packet_id)
@@ -366,6 +365,8 @@ class ProtocolHandler:
                     running_tasks.popleft()
                 if len(running_tasks) > 1:
                     self.logger.debug("handler running tasks: %d" % len(running_tasks))
+                # Stop reading while messages received can't be delivered
+                yield from self.session.delivered_message_queue.wait_not_full()
 
                 fixed_header = yield from asyncio.wait_for(
                     MQTTFixedHeader.from_stream(self.reader),
@@ -378,6 +379,7 @@ class ProtocolHandler:
                     else:
                         cls = packet_class(fixed_header)
                         packet = yield from cls.from_stream(self.reader, fixed_header=fixed_header)
+                        self.reader.counters.packet_received(fixed_header.packet_type == PUBLISH)
                         yield from self.plugins_manager.fire_event(
                             EVENT_MQTT_PACKET_RECEIVED, packet=packet, session=self.session)
                         task = None
@@ -441,6 +443,7 @@ class ProtocolHandler:
     def _send_packet(self, packet):
         try:
             yield from packet.to_stream(self.writer)
+            self.writer.counters.packet_sent(packet.fixed_header.packet_type == PUBLISH)
             if self._keepalive_task:
                 self._keepalive_task.cancel()
                 self._keepalive_task = self._loop.call_later(self.keepalive_timeout, self.handle_write_timeout)
@@ -562,5 +565,10 @@ class ProtocolHandler:
 
         incoming_message = IncomingApplicationMessage(packet_id, publish_packet.topic_name, qos, publish_packet.data, publish_packet.retain_flag)
         incoming_message.publish_packet = publish_packet
-        yield from self._handle_message_flow(incoming_message)
+        try:
+            yield from self._handle_message_flow(incoming_message)
+        except QueueOverflowError as qoe:
+            self.logger.warning("%s %s, closing connection" % (self.session.client_id, qoe))
+            yield from self.handle_connection_closed()
+            return
         self.logger.debug("Message queue size: %d" % self.session.delivered_message_queue.qsize())
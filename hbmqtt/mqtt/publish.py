@@ -5,12 +5,13 @@ import asyncio
 
 from hbmqtt.mqtt.packet import MQTTPacket, MQTTFixedHeader, PUBLISH, MQTTVariableHeader, MQTTPayload
 from hbmqtt.errors import HBMQTTException, MQTTException
-from hbmqtt.codecs import decode_packet_id, decode_string, encode_string, int_to_bytes
+from hbmqtt.codecs import decode_packet_id, decode_data_with_length, encode_string, int_to_bytes, read_or_raise, \
+    BytesDecoder
 
 
 class PublishVariableHeader(MQTTVariableHeader):
 
-    __slots__ = ('topic_name', 'packet_id')
+    __slots__ = ('topic_name', 'packet_id', 'decoded_length')
 
     def __init__(self, topic_name: str, packet_id: int=None):
         super().__init__()
@@ -18,6 +19,8 @@ class PublishVariableHeader(MQTTVariableHeader):
             raise MQTTException("[MQTT-3.3.2-2] Topic name in the PUBLISH Packet MUST NOT contain wildcard characters.")
         self.topic_name = topic_name
         self.packet_id = packet_id
+        # Number of bytes the header was decoded from, None if it was built
+        self.decoded_length = None
 
     def __repr__(self):
         return type(self).__name__ + '(topic={0}, packet_id={1})'.format(self.topic_name, self.packet_id)
@@ -32,13 +35,33 @@ class PublishVariableHeader(MQTTVariableHeader):
     @classmethod
     @asyncio.coroutine
     def from_stream(cls, reader: asyncio.StreamReader, fixed_header: MQTTFixedHeader):
-        topic_name = yield from decode_string(reader)
+        topic_bytes = yield from decode_data_with_length(reader)
+        try:
+            topic_name = topic_bytes.decode(encoding='utf-8')
+        except UnicodeDecodeError:
+            topic_name = str(topic_bytes)
+        length = 2 + len(topic_bytes)
         has_qos = (fixed_header.flags >> 1) & 0x03
         if has_qos:
             packet_id = yield from decode_packet_id(reader)
+            length += 2
         else:
             packet_id = None
-        return cls(topic_name, packet_id)
+        header = cls(topic_name, packet_id)
+        header.decoded_length = length
+        return header
+
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader):
+        start = decoder.offset
+        topic_name = decoder.read_string()
+        if (fixed_header.flags >> 1) & 0x03:
+            packet_id = decoder.read_packet_id()
+        else:
+            packet_id = None
+        header = cls(topic_name, packet_id)
+        header.decoded_length = decoder.offset - start
+        return header
 
 
 class PublishPayload(MQTTPayload):
@@ -56,17 +79,23 @@ class PublishPayload(MQTTPayload):
     @asyncio.coroutine
     def from_stream(cls, reader: asyncio.StreamReader, fixed_header: MQTTFixedHeader,
                     variable_header: MQTTVariableHeader):
-        data = bytearray()
-        data_length = fixed_header.remaining_length - variable_header.bytes_length
-        length_read = 0
-        while length_read < data_length:
-            buffer = yield from reader.read(data_length - length_read)
-            data.extend(buffer)
-            length_read = len(data)
+        if variable_header.decoded_length is not None:
+            data_length = fixed_header.remaining_length - variable_header.decoded_length
+        else:
+            data_length = fixed_header.remaining_length - variable_header.bytes_length
+        if data_length > 0:
+            data = yield from read_or_raise(reader, data_length)
+        else:
+            data = b''
         return cls(data)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader, variable_header: MQTTVariableHeader):
+        # Payload is the rest of the packet, kept as a view of the received frame (bytes, so read-only)
+        return cls(decoder.read(decoder.remaining))
+
     def __repr__(self):
-        return type(self).__name__ + '(data={0!r})'.format(repr(self.data))
+        return type(self).__name__ + '(data={0!r})'.format(repr(bytes(self.data) if self.data is not None else None))
 
 
 class PublishPacket(MQTTPacket):
@@ -164,3 +193,48 @@ class PublishPacket(MQTTPacket):
         packet.retain_flag = retain
         packet.qos = qos
         return packet
+
+
+class PublishFrame:
+    """
+    PUBLISH packet encoded once and shared by all the sessions a message is sent to with the same QoS.
+
+    Remaining length, topic name and payload are serialized once. Sending the frame to a session only patches the
+    fixed header flags and the packet ID; the payload is written as a memoryview and never copied.
+    """
+
+    __slots__ = ('topic', 'data', 'qos', '_header', '_payload')
+
+    def __init__(self, topic: str, data: bytes, qos):
+        self.topic = topic
+        self.data = data
+        self.qos = qos
+        topic_bytes = encode_string(topic)
+        remaining_length = len(topic_bytes) + len(data)
+        if qos:
+            remaining_length += 2
+        fixed_header = MQTTFixedHeader(PUBLISH, 0x00, remaining_length).to_bytes()
+        # Remaining length and topic, the first byte holding flags is built on each send
+        self._header = bytes(fixed_header[1:]) + topic_bytes
+        self._payload = memoryview(data)
+
+    def to_buffers(self, packet_id: int=None, dup_flag=False, retain=False):
+        """
+        Get the buffers to write for a given session
+        :param packet_id: packet ID given by the session (QOS_1 and QOS_2 only)
+        :param dup_flag: DUP flag
+        :param retain: RETAIN flag
+        :return: list of buffers, to be written with ``writelines()``
+        """
+        flags = (PUBLISH << 4) | (self.qos << 1)
+        if dup_flag:
+            flags |= PublishPacket.DUP_FLAG
+        if retain:
+            flags |= PublishPacket.RETAIN_FLAG
+        if self.qos:
+            return [bytes((flags,)), self._header, int_to_bytes(packet_id, 2), self._payload]
+        return [bytes((flags,)), self._header, self._payload]
+
+    @property
+    def bytes_length(self):
+        return 1 + len(self._header) + (2 if self.qos else 0) + len(self._payload)
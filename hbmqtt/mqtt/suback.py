@@ -6,7 +6,7 @@ import asyncio
 from hbmqtt.mqtt.packet import MQTTPacket, MQTTFixedHeader, SUBACK, PacketIdVariableHeader, MQTTPayload, MQTTVariableHeader
 from hbmqtt.errors import HBMQTTException, NoDataException
 from hbmqtt.adapters import ReaderAdapter
-from hbmqtt.codecs import bytes_to_int, int_to_bytes, read_or_raise
+from hbmqtt.codecs import bytes_to_int, int_to_bytes, read_or_raise, BytesDecoder
 
 
 class SubackPayload(MQTTPayload):
@@ -46,6 +46,10 @@ class SubackPayload(MQTTPayload):
                 break
         return cls(return_codes)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader, variable_header: MQTTVariableHeader):
+        return cls(list(decoder.read(decoder.remaining)))
+
 
 class SubackPacket(MQTTPacket):
     VARIABLE_HEADER = PacketIdVariableHeader
@@ -5,7 +5,7 @@ import asyncio
 
 from hbmqtt.mqtt.packet import MQTTPacket, MQTTFixedHeader, SUBSCRIBE, PacketIdVariableHeader, MQTTPayload, MQTTVariableHeader
 from hbmqtt.errors import HBMQTTException, NoDataException
-from hbmqtt.codecs import bytes_to_int, decode_string, encode_string, int_to_bytes, read_or_raise
+from hbmqtt.codecs import bytes_to_int, decode_string, encode_string, int_to_bytes, read_or_raise, BytesDecoder
 
 
 class SubscribePayload(MQTTPayload):
@@ -41,6 +41,15 @@ class SubscribePayload(MQTTPayload):
                 break
         return cls(topics)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader, variable_header: MQTTVariableHeader):
+        topics = []
+        while decoder.remaining:
+            topic = decoder.read_string()
+            qos = decoder.read_byte()
+            topics.append((topic, qos))
+        return cls(topics)
+
     def __repr__(self):
         return type(self).__name__ + '(topics={0!r})'.format(self.topics)
 
@@ -5,7 +5,7 @@ import asyncio
 
 from hbmqtt.mqtt.packet import MQTTPacket, MQTTFixedHeader, UNSUBSCRIBE, PacketIdVariableHeader, MQTTPayload, MQTTVariableHeader
 from hbmqtt.errors import HBMQTTException, NoDataException
-from hbmqtt.codecs import decode_string, encode_string
+from hbmqtt.codecs import decode_string, encode_string, BytesDecoder
 
 
 class UnubscribePayload(MQTTPayload):
@@ -38,6 +38,13 @@ class UnubscribePayload(MQTTPayload):
                 break
         return cls(topics)
 
+    @classmethod
+    def decode(cls, decoder: BytesDecoder, fixed_header: MQTTFixedHeader, variable_header: MQTTVariableHeader):
+        topics = []
+        while decoder.remaining:
+            topics.append(decoder.read_string())
+        return cls(topics)
+
 
 class UnsubscribePacket(MQTTPacket):
     VARIABLE_HEADER = PacketIdVariableHeader
@@ -0,0 +1,303 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import collections
+import logging
+import os
+import shutil
+import struct
+import time
+from urllib.parse import quote
+
+from hbmqtt.queues import OverloadQueue, POLICY_DROP_OLDEST
+
+EVENT_EXPIRED = 'expired'
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+# Buffer size of segment files
+_BUFFER_SIZE = 64 * 1024
+
+# expiry timestamp (0 if none), QoS (255 if none), topic length, data length
+_record_header = struct.Struct('!dBHI')
+_NO_QOS = 255
+
+
+class OfflineMessageStore(OverloadQueue):
+    """
+    Messages stored for a persistent session while its client is offline.
+
+    The first ``memory_window`` messages are kept in memory. Once the window is full, following messages are
+    appended to segment files in ``<spool_dir>/<client id>/`` and read back one at a time by :meth:`get`, so
+    replaying a long backlog only holds one message from disk in memory and follows the pace of the consumer.
+    Fully read segments are deleted. Without ``spool_dir``, all messages are kept in memory.
+
+    Segment files are written and read from the event loop through buffers of 64 KiB: spooling or replaying a
+    message only copies it from or to a buffer, and file system calls are made once per 64 KiB of messages, when
+    a segment is started, and when a fully read segment is deleted.
+
+    Messages older than ``expiry`` seconds are discarded when they reach the head of the store.
+
+    The store is an :class:`~hbmqtt.queues.OverloadQueue`: ``maxsize`` bounds the total number of messages, in
+    memory and on disk, and ``policy`` applies when it is reached.
+
+    :param client_id: client ID of the session
+    :param message_factory: callable building a message from (topic, data, qos) when reading it from disk
+    :param maxsize: maximum number of messages stored, unbounded if 0
+    :param policy: overload policy
+    :param memory_window: number of messages kept in memory before spilling to disk
+    :param spool_dir: directory of segment files, or None to keep all messages in memory
+    :param expiry: message expiry delay in seconds, 0 for no expiry
+    :param counters: Counter shared by broker queues to count overload events
+    :param segment_size: size in bytes after which a new segment file is started
+    :param loop: asyncio loop to use
+    """
+
+    def __init__(self, client_id, message_factory, maxsize=0, policy=POLICY_DROP_OLDEST, memory_window=1000,
+                 spool_dir=None, expiry=0, counters=None, segment_size=DEFAULT_SEGMENT_SIZE, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self.client_id = client_id
+        self.memory_window = memory_window
+        self.expiry = expiry
+        self.segment_size = segment_size
+        self._message_factory = message_factory
+        if spool_dir:
+            self._directory = os.path.join(spool_dir, quote(client_id, safe=''))
+        else:
+            self._directory = None
+        super().__init__(maxsize, policy, 'offline', counters, loop=loop)
+
+    def _init(self, maxsize):
+        # In memory messages, as (expires_at, message) tuples
+        self._queue = collections.deque()
+        # Segment sequence numbers, oldest first
+        self._segments = collections.deque()
+        self._disk_count = 0
+        self._writer = None
+        self._reader = None
+        # Offset of the first unread record in the oldest segment, when it is opened
+        self._start_offset = 0
+        # Next record read from disk, not returned yet, and its offset
+        self._next = None
+        self._next_offset = 0
+        if self._directory is not None:
+            self._recover()
+
+    def _segment_path(self, sequence):
+        return os.path.join(self._directory, '%010d.seg' % sequence)
+
+    def _head_path(self):
+        return os.path.join(self._directory, 'head')
+
+    def _recover(self):
+        """
+        Count messages left on disk by a previous run
+        """
+        if not os.path.isdir(self._directory):
+            return
+        sequences = sorted(int(name[:-4]) for name in os.listdir(self._directory) if name.endswith('.seg'))
+        try:
+            with open(self._head_path(), 'r') as head:
+                head_sequence, head_offset = (int(value) for value in head.read().split())
+            if sequences and sequences[0] == head_sequence:
+                self._start_offset = head_offset
+        except (FileNotFoundError, ValueError):
+            pass
+        for sequence in sequences:
+            path = self._segment_path(sequence)
+            size = os.path.getsize(path)
+            offset = self._start_offset if sequence == sequences[0] else 0
+            with open(path, 'rb', buffering=_BUFFER_SIZE) as segment:
+                segment.seek(offset)
+                while offset < size:
+                    header = segment.read(_record_header.size)
+                    if len(header) < _record_header.size:
+                        break
+                    expires_at, qos, topic_length, data_length = _record_header.unpack(header)
+                    end = offset + _record_header.size + topic_length + data_length
+                    if end > size:
+                        break
+                    segment.seek(end)
+                    offset = end
+                    self._disk_count += 1
+            if offset < size:
+                # Record cut off by a crash while it was written
+                self.logger.warning("Truncating incomplete offline message at offset %d of %s" % (offset, path))
+                os.truncate(path, offset)
+            self._segments.append(sequence)
+        if self._disk_count:
+            self.logger.debug("Recovered %d offline messages of %s" % (self._disk_count, self.client_id))
+
+    @property
+    def spooled_count(self):
+        """
+        Number of messages stored on disk
+        """
+        return self._disk_count
+
+    def qsize(self):
+        return len(self._queue) + self._disk_count
+
+    def empty(self):
+        self._discard_expired()
+        return not self._queue and not self._disk_count
+
+    def _expires_at(self):
+        if self.expiry:
+            return time.time() + self.expiry
+        return 0
+
+    def _discard_expired(self):
+        if not self.expiry:
+            return
+        now = time.time()
+        while self._queue and self._queue[0][0] <= now:
+            self._queue.popleft()
+            self.count(EVENT_EXPIRED)
+        if not self._queue:
+            while self._disk_count:
+                if self._next is None:
+                    self._next = self._read_record()
+                if self._next[0] == 0 or self._next[0] > now:
+                    break
+                self._next = None
+                self._disk_count -= 1
+                self.count(EVENT_EXPIRED)
+            if not self._disk_count:
+                self._clear_segments()
+
+    def _put(self, item):
+        if self._directory is not None and (self._disk_count or len(self._queue) >= self.memory_window):
+            self._append_record(self._expires_at(), item)
+        else:
+            self._queue.append((self._expires_at(), item))
+        if self.full():
+            self._not_full.clear()
+
+    def _get(self):
+        if self._queue:
+            item = self._queue.popleft()[1]
+        else:
+            if self._next is None:
+                self._next = self._read_record()
+            item = self._next[1]
+            self._next = None
+            self._disk_count -= 1
+            if not self._disk_count:
+                self._clear_segments()
+        self._not_full.set()
+        return item
+
+    def _append_record(self, expires_at, message):
+        if self._writer is None or self._writer.tell() >= self.segment_size:
+            if self._writer is not None:
+                self._writer.close()
+            os.makedirs(self._directory, exist_ok=True)
+            sequence = self._segments[-1] + 1 if self._segments else 0
+            self._writer = open(self._segment_path(sequence), 'ab', buffering=_BUFFER_SIZE)
+            self._segments.append(sequence)
+        topic = message.topic.encode('utf-8')
+        data = message.data if message.data is not None else b''
+        qos = message.qos if message.qos is not None else _NO_QOS
+        self._writer.write(_record_header.pack(expires_at, qos, len(topic), len(data)))
+        self._writer.write(topic)
+        self._writer.write(data)
+        self._disk_count += 1
+
+    def _read_record(self):
+        while True:
+            if self._reader is None:
+                self._reader = open(self._segment_path(self._segments[0]), 'rb', buffering=_BUFFER_SIZE)
+                self._reader.seek(self._start_offset)
+                self._start_offset = 0
+            self._next_offset = self._reader.tell()
+            record = self._read_next()
+            if record is None and self._writer is not None and len(self._segments) == 1:
+                # Reading the segment being written, following messages may still be in the write buffer
+                self._writer.flush()
+                self._reader.seek(self._next_offset)
+                record = self._read_next()
+            if record is not None:
+                return record
+            # End of segment, continue with next one
+            self._reader.close()
+            self._reader = None
+            os.remove(self._segment_path(self._segments.popleft()))
+
+    def _read_next(self):
+        """
+        Read the record at the current position of the reader
+        :return: (expires_at, message) tuple, None if the record is not complete in the segment
+        """
+        header = self._reader.read(_record_header.size)
+        if len(header) < _record_header.size:
+            return None
+        expires_at, qos, topic_length, data_length = _record_header.unpack(header)
+        topic = self._reader.read(topic_length)
+        data = self._reader.read(data_length)
+        if len(topic) < topic_length or len(data) < data_length:
+            return None
+        if qos == _NO_QOS:
+            qos = None
+        return expires_at, self._message_factory(topic.decode('utf-8'), data, qos)
+
+    def _close_files(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _clear_segments(self):
+        self._close_files()
+        while self._segments:
+            try:
+                os.remove(self._segment_path(self._segments.popleft()))
+            except FileNotFoundError:
+                pass
+        if self._directory is not None:
+            try:
+                os.remove(self._head_path())
+            except FileNotFoundError:
+                pass
+        self._next = None
+        self._start_offset = 0
+
+    def memory_records(self):
+        """
+        Messages kept in memory, which are lost when the store is closed unless saved elsewhere
+        :return: list of (topic, data, qos) tuples, oldest first
+        """
+        return [(message.topic, message.data, message.qos) for expires_at, message in self._queue]
+
+    def restore_records(self, records):
+        """
+        Put back messages saved from :meth:`memory_records` by a previous run, before the messages stored since.
+        Their expiry delay starts again and they are not counted against ``maxsize``.
+        :param records: list of (topic, data, qos) tuples, oldest first
+        """
+        expires_at = self._expires_at()
+        self._queue.extendleft((expires_at, self._message_factory(topic, data, qos))
+                               for topic, data, qos in reversed(records))
+        self._wakeup_next(self._getters)
+
+    def close(self):
+        """
+        Close segment files, messages on disk are kept and read again by a store created for the same session
+        """
+        if self._reader is not None:
+            # Save read position in the oldest segment
+            offset = self._next_offset if self._next is not None else self._reader.tell()
+            with open(self._head_path(), 'w') as head:
+                head.write('%d %d' % (self._segments[0], offset))
+        self._close_files()
+        self._next = None
+
+    def discard(self):
+        """
+        Delete all stored messages and the session spool directory
+        """
+        self._queue.clear()
+        self._disk_count = 0
+        self._clear_segments()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
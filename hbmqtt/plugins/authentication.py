@@ -3,8 +3,11 @@
 # See the file license.txt for copying permission.
 import logging
 import asyncio
-from passlib.apps import custom_app_context as pwd_context
-from hbmqtt.utils import read_yaml_config, write_yaml_config
+import hashlib
+import hmac
+import os
+from hbmqtt.utils import LRUCache
+from hbmqtt.identities import open_identity_store
 
 class BaseAuthPlugin:
     def __init__(self, context):
@@ -52,25 +55,23 @@ class AnonymousAuthPlugin(BaseAuthPlugin):
 class FileAuthPlugin(BaseAuthPlugin):
     def __init__(self, context):
         super().__init__(context)
-        self._users = dict()
+        self._identities = None
         self._read_password_file()
+        # Successful verifications, keyed by a keyed hash of the presented credentials so the cache never holds
+        # them in clear. Values are the stored hashes verified against, changed hashes don't match anymore.
+        self._cache_key = os.urandom(32)
+        self._cache = LRUCache(self.auth_config.get('cache-size', 10000), self.auth_config.get('cache-ttl', 300))
 
     def _read_password_file(self):
-        try:
-            password_file = self.auth_config.get('password-file', None)
-            if password_file:
-                self._users = read_yaml_config(password_file)
-            else:
-                self.context.logger.debug("Configuration parameter 'password_file' not found")
-        except FileNotFoundError:
-            pass
+        # Identities shared with the registration plugin
+        self._identities = open_identity_store(self.context.config, self.auth_config.get('password-file', None))
+        if self._identities is None:
+            self.context.logger.debug("Configuration parameter 'password_file' not found")
 
     @asyncio.coroutine
     def authenticate(self, *args, **kwargs):
-        try:
-            self._read_password_file()
-        except:
-            self.context.logger.warning("Password file not found")
+        if self._identities is not None:
+            self._identities.refresh()
         authenticated = super().authenticate(*args, **kwargs)
         if authenticated:
             session = kwargs.get('session', None)
@@ -84,19 +85,44 @@ class FileAuthPlugin(BaseAuthPlugin):
                     self.context.logger.error("Authentication failed: Credentials not in proper format")
                     return False
 
-                authenticated_user = False
-                pwd_hash = self._users[username]['password']
+                credentials = None
+                if self._identities is not None:
+                    credentials = self._identities.get_credentials(username, deviceid)
+                if credentials is None:
+                    self.context.logger.error("Authentication failed: unknown user '%s' or device '%s'" %
+                                              (username, deviceid))
+                    return False
+                pwd_hash, key_hash = credentials
                 if not pwd_hash:
                     self.context.logger.error("No hash found for user '%s'" % username)
-                else:
-                    authenticated_user = pwd_context.verify(password, pwd_hash)
-
-                authenticated_device = False
-                key_hash = self._users[username]['devices'][deviceid]['key']
+                    return False
                 if not key_hash:
                     self.context.logger.error("No key found for device '%s'" % deviceid)
-                else:
-                    authenticated_device = pwd_context.verify(devicekey, key_hash)
+                    return False
+
+                cache_key = self._credentials_digest(username, deviceid, password, devicekey)
+                if self._cache.get(cache_key) == (pwd_hash, key_hash):
+                    self.context.logger.debug("Authentication success: cached credentials of '%s'" % session.username)
+                    return True
+
+                # Both checks run in the hashing pool at the same time
+                authenticated_user, authenticated_device = yield from asyncio.gather(
+                    self.context.hashing.verify(password, pwd_hash),
+                    self.context.hashing.verify(devicekey, key_hash),
+                    loop=self.context.loop)
+                if authenticated_user and authenticated_device:
+                    self._cache.put(cache_key, (pwd_hash, key_hash))
             else:
                 return None
         return authenticated_user and authenticated_device
+
+    def _credentials_digest(self, *credentials):
+        message = b'\0'.join(credential.encode('utf-8') for credential in credentials)
+        return hmac.new(self._cache_key, message, hashlib.sha256).digest()
+
+    @asyncio.coroutine
+    def on_broker_identities_changed(self, *args, **kwargs):
+        # Users or devices registered or changed, here or by another worker
+        self._cache.clear()
+        if self._identities is not None:
+            self._identities.refresh(check_now=True)
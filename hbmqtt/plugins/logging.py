@@ -22,25 +22,28 @@ class EventLoggerPlugin:
 
 
 class PacketLoggerPlugin:
+    """
+    Log packets received and sent at DEBUG level.
+    Packet events are not listened to if DEBUG level isn't enabled when the plugin is loaded.
+    """
     def __init__(self, context):
         self.context = context
+        if not self.context.logger.isEnabledFor(logging.DEBUG):
+            self.on_mqtt_packet_received = None
+            self.on_mqtt_packet_sent = None
 
-    @asyncio.coroutine
     def on_mqtt_packet_received(self, *args, **kwargs):
         packet = kwargs.get('packet')
         session = kwargs.get('session', None)
-        if self.context.logger.isEnabledFor(logging.DEBUG):
-            if session:
-                self.context.logger.debug("%s <-in-- %s" % (session.client_id, repr(packet)))
-            else:
-                self.context.logger.debug("<-in-- %s" % repr(packet))
+        if session:
+            self.context.logger.debug("%s <-in-- %s" % (session.client_id, repr(packet)))
+        else:
+            self.context.logger.debug("<-in-- %s" % repr(packet))
 
-    @asyncio.coroutine
     def on_mqtt_packet_sent(self, *args, **kwargs):
         packet = kwargs.get('packet')
         session = kwargs.get('session', None)
-        if self.context.logger.isEnabledFor(logging.DEBUG):
-            if session:
-                self.context.logger.debug("%s -out-> %s" % (session.client_id, repr(packet)))
-            else:
-                self.context.logger.debug("-out-> %s" % repr(packet))
+        if session:
+            self.context.logger.debug("%s -out-> %s" % (session.client_id, repr(packet)))
+        else:
+            self.context.logger.debug("-out-> %s" % repr(packet))
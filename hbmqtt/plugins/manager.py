@@ -4,11 +4,11 @@
 
 __all__ = ['get_plugin_manager', 'BaseContext', 'PluginManager']
 
-import pkg_resources
 import logging
 import asyncio
 import copy
 import sys
+from asyncio import futures
 
 from collections import namedtuple
 
@@ -17,6 +17,51 @@ Plugin = namedtuple('Plugin', ['name', 'ep', 'object'])
 
 plugins_manager = dict()
 
+# namespace -> tuple of entry points, discovered once per process
+_entry_points = dict()
+# Errors raised by plugins whose dependencies are missing
+_plugin_load_errors = (ImportError,)
+
+
+def get_entry_points(namespace):
+    """
+    Get the entry points of a namespace (group) declared by installed distributions.
+    Installed distributions are scanned on the first call for a namespace only.
+    :param namespace: entry points group
+    :return: tuple of entry points, without duplicate names
+    """
+    global _plugin_load_errors
+    entry_points = _entry_points.get(namespace, None)
+    if entry_points is None:
+        try:
+            from importlib import metadata as importlib_metadata
+        except ImportError:
+            try:
+                import importlib_metadata
+            except ImportError:
+                # Python < 3.8 without the backport
+                importlib_metadata = None
+        if importlib_metadata is not None:
+            entry_points = importlib_metadata.entry_points()
+            if hasattr(entry_points, 'select'):
+                entry_points = entry_points.select(group=namespace)
+            else:
+                entry_points = entry_points.get(namespace, ())
+        else:
+            import pkg_resources
+            _plugin_load_errors = (ImportError, pkg_resources.UnknownExtra)
+            entry_points = pkg_resources.iter_entry_points(group=namespace)
+        names = set()
+        unique_entry_points = []
+        for ep in entry_points:
+            # A distribution found twice on the path declares its entry points twice
+            if ep.name not in names:
+                names.add(ep.name)
+                unique_entry_points.append(ep)
+        entry_points = tuple(unique_entry_points)
+        _entry_points[namespace] = entry_points
+    return entry_points
+
 
 def get_plugin_manager(namespace):
     global plugins_manager
@@ -31,9 +76,13 @@ class BaseContext:
 
 class PluginManager:
     """
-    Wraps setuptools Entry point mechanism to provide a basic plugin system.
+    Wraps setuptools Entry point mechanism to provide a basic plugin system, entry points are read with
+    importlib.metadata.
     Plugins are loaded for a given namespace (group).
     This plugin manager uses coroutines to run plugin call asynchronously in an event queue
+
+    Event methods of plugins are looked up once per event, the first time it is fired. Methods returning a
+    coroutine are scheduled in a task, plain methods are synchronous hooks run inline.
     """
     def __init__(self, namespace, context, loop=None):
         global plugins_manager
@@ -50,7 +99,12 @@ class PluginManager:
         self.context.loop = self._loop
         self._plugins = []
         self._load_plugins(namespace)
-        self._fired_events = []
+        self._fired_events = set()
+        # event name -> tuple of (plugin, event method)
+        self._event_handlers = dict()
+        # Returned by fire_event when there is nothing to wait for
+        self._no_wait = futures.Future(loop=self._loop)
+        self._no_wait.set_result(None)
         plugins_manager[namespace] = self
 
     @property
@@ -59,24 +113,23 @@ class PluginManager:
 
     def _load_plugins(self, namespace):
         self.logger.debug("Loading plugins for namespace %s" % namespace)
-        for ep in pkg_resources.iter_entry_points(group=namespace):
+        for ep in get_entry_points(namespace):
             plugin = self._load_plugin(ep)
-            self._plugins.append(plugin)
-            self.logger.debug(" Plugin %s ready" % plugin.ep.name)
+            if plugin is not None:
+                self._plugins.append(plugin)
+                self.logger.debug(" Plugin %s ready" % plugin.ep.name)
 
-    def _load_plugin(self, ep: pkg_resources.EntryPoint):
+    def _load_plugin(self, ep):
         try:
-            self.logger.debug(" Loading plugin %s" % ep)
-            plugin = ep.load(require=True)
-            self.logger.debug(" Initializing plugin %s" % ep)
+            self.logger.debug(" Loading plugin %r" % (ep,))
+            plugin = ep.load()
+            self.logger.debug(" Initializing plugin %r" % (ep,))
             plugin_context = copy.copy(self.app_context)
             plugin_context.logger = self.logger.getChild(ep.name)
             obj = plugin(plugin_context)
             return Plugin(ep.name, ep, obj)
-        except ImportError as ie:
-            self.logger.warning("Plugin %r import failed: %s" % (ep, ie))
-        except pkg_resources.UnknownExtra as ue:
-            self.logger.warning("Plugin %r dependencies resolution failed: %s" % (ep, ue))
+        except _plugin_load_errors as e:
+            self.logger.warning("Plugin %r import failed: %s" % (ep, e))
 
     def get_plugin(self, name):
         """
@@ -97,7 +150,7 @@ class PluginManager:
         :return:
         """
         yield from self.map_plugin_coro("close")
-        for task in self._fired_events:
+        for task in list(self._fired_events):
             task.cancel()
 
     @property
@@ -111,44 +164,62 @@ class PluginManager:
     def _schedule_coro(self, coro):
         return asyncio.ensure_future(coro, loop=self._loop)
 
-    @asyncio.coroutine
+    def _get_event_handlers(self, event_name):
+        event_method_name = "on_" + event_name
+        handlers = []
+        for plugin in self._plugins:
+            event_method = getattr(plugin.object, event_method_name, None)
+            if event_method:
+                handlers.append((plugin, event_method))
+        handlers = tuple(handlers)
+        self._event_handlers[event_name] = handlers
+        return handlers
+
+    def has_event_handlers(self, event_name):
+        """
+        Check if plugins have methods for an event, so that costly event arguments are only built when needed
+        :param event_name:
+        :return: True if fire_event() calls plugin methods for this event
+        """
+        handlers = self._event_handlers.get(event_name)
+        if handlers is None:
+            handlers = self._get_event_handlers(event_name)
+        return bool(handlers)
+
     def fire_event(self, event_name, wait=False, *args, **kwargs):
         """
         Fire an event to plugins.
-        PluginManager schedule @asyncio.coroutinecalls for each plugin on method called "on_" + event_name
+        PluginManager calls for each plugin the method called "on_" + event_name
         For example, on_connect will be called on event 'connect'
-        Method calls are schedule in the asyn loop. wait parameter must be set to true to wait until all
-        mehtods are completed.
+        Coroutine methods calls are scheduled in the async loop, synchronous methods are called before returning.
+        wait parameter must be set to true to wait until all coroutine methods are completed.
+        Events without plugin methods cost a dict lookup.
         :param event_name:
         :param args:
         :param kwargs:
         :param wait: indicates if fire_event should wait for plugin calls completion (True), or not
-        :return:
+        :return: awaitable, to be used with ``yield from``
         """
+        handlers = self._event_handlers.get(event_name)
+        if handlers is None:
+            handlers = self._get_event_handlers(event_name)
+        if not handlers:
+            return self._no_wait
         tasks = []
-        event_method_name = "on_" + event_name
-        for plugin in self._plugins:
-            event_method = getattr(plugin.object, event_method_name, None)
-            if event_method:
-                try:
-                    task = self._schedule_coro(event_method(*args, **kwargs))
-                    tasks.append(task)
-
-                    def clean_fired_events(future):
-                        try:
-                            self._fired_events.remove(task)
-                        except (KeyError, ValueError):
-                            pass
-
-                    task.add_done_callback(clean_fired_events)
-                except AssertionError:
-                    self.logger.error("Method '%s' on plugin '%s' is not a coroutine" %
-                                      (event_method_name, plugin.name))
-
-        self._fired_events.extend(tasks)
-        if wait:
-            if tasks:
-                yield from asyncio.wait(tasks, loop=self._loop)
+        for plugin, event_method in handlers:
+            try:
+                ret = event_method(*args, **kwargs)
+            except Exception as e:
+                self.logger.error("Method 'on_%s' on plugin '%s' failed: %r" % (event_name, plugin.name, e))
+                continue
+            if ret is not None and asyncio.iscoroutine(ret):
+                task = self._schedule_coro(ret)
+                task.add_done_callback(self._fired_events.discard)
+                self._fired_events.add(task)
+                tasks.append(task)
+        if wait and tasks:
+            return asyncio.wait(tasks, loop=self._loop)
+        return self._no_wait
 
     @asyncio.coroutine
     def map(self, coro, *args, **kwargs):
@@ -185,6 +256,24 @@ class PluginManager:
             ret_dict = {}
         return ret_dict
 
+    def get_plugin_methods(self, method_name, filter_plugins=None):
+        """
+        Get the methods of plugins implementing a given method, to call them directly instead of through
+        :meth:`map_plugin_coro`
+        :param method_name: plugin method name
+        :param filter_plugins: list of plugin names to filter, as given to :meth:`map`
+        :return: tuple of (plugin, bound method), in plugins order
+        """
+        if filter_plugins is None:
+            filter_plugins = [p.name for p in self.plugins]
+        methods = []
+        for plugin in self._plugins:
+            if plugin.name in filter_plugins:
+                method = getattr(plugin.object, method_name, None)
+                if method:
+                    methods.append((plugin, method))
+        return tuple(methods)
+
     @staticmethod
     @asyncio.coroutine
     def _call_coro(plugin, coro_name, *args, **kwargs):
@@ -2,15 +2,141 @@
 #
 # See the file license.txt for copying permission.
 import asyncio
+import queue
 import sqlite3
-import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hbmqtt.errors import CodecException
+from hbmqtt.session_codec import encode_state, decode_state, encode_subscriptions, decode_subscriptions
+
+
+def _resolve(future, exception=None):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(None)
+
+
+def _notify(operation, exception=None):
+    sql, parameters, future, loop = operation
+    try:
+        loop.call_soon_threadsafe(_resolve, future, exception)
+    except RuntimeError:
+        # Loop of the caller is closed, nobody waits for the future anymore
+        pass
+
+
+class SQLiteWriter:
+    """
+    Group commit writer for a SQLite database.
+
+    Statements are queued and executed by a dedicated thread, which commits them in batches: once a statement is
+    queued, the writer waits up to ``flush_interval`` seconds for more statements, then commits up to
+    ``batch_size`` statements in a single transaction. Statements queued while a transaction is committed are part
+    of the next batch, so under load many writes share each commit.
+
+    :param db_file: database file path
+    :param batch_size: maximum number of statements per transaction
+    :param flush_interval: maximum delay in seconds waiting for more statements before committing
+    """
+
+    def __init__(self, db_file, batch_size=100, flush_interval=0):
+        self.db_file = db_file
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='hbmqtt-sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def execute(self, sql, parameters=(), loop=None):
+        """
+        Queue a statement
+        :param sql: SQL statement
+        :param parameters: statement parameters
+        :param loop: asyncio loop of the returned future
+        :return: future resolved once the transaction including the statement is committed
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.put((sql, parameters, future, loop))
+        return future
+
+    def close(self):
+        """
+        Commit queued statements and stop the writer thread. This method blocks until the thread ends.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """
+        :return: list of operations to commit together, and True if the writer must stop after them
+        """
+        operation = self._queue.get()
+        if operation is None:
+            return [], True
+        batch = [operation]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    operation = self._queue.get(timeout=timeout)
+                else:
+                    operation = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if operation is None:
+                return batch, True
+            batch.append(operation)
+        return batch, False
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            stop = False
+            while not stop:
+                batch, stop = self._next_batch()
+                if batch:
+                    try:
+                        self._commit(conn, batch)
+                    except Exception as e:
+                        # Keep the writer running, statements queued afterwards would never complete
+                        for operation in batch:
+                            _notify(operation, e)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        try:
+            with conn:
+                for sql, parameters, future, loop in batch:
+                    conn.execute(sql, parameters)
+        except Exception as e:
+            if len(batch) > 1:
+                # Run statements one per transaction, so only the failing one reports an error
+                for operation in batch:
+                    self._commit(conn, [operation])
+                return
+            _notify(batch[0], e)
+            return
+        for operation in batch:
+            _notify(operation)
 
 
 class SQLitePlugin:
     def __init__(self, context):
         self.context = context
-        self.conn = None
-        self.cursor = None
+        self.writer = None
+        self.readers = None
+        self._reader_local = threading.local()
+        # Connections opened by reader threads, closed once the readers are stopped
+        self._reader_connections = []
         self.db_file = None
         try:
             self.persistence_config = self.context.config['persistence']
@@ -24,42 +150,106 @@ class SQLitePlugin:
             self.context.logger.warning("'file' persistence parameter not found")
         else:
             try:
-                self.conn = sqlite3.connect(self.db_file)
-                self.cursor = self.conn.cursor()
+                conn = sqlite3.connect(self.db_file)
+                # Readers don't block the writer and the other way around
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS session(client_id TEXT PRIMARY KEY, data BLOB)")
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(session)")]
+                if 'subscriptions' not in columns:
+                    conn.execute("ALTER TABLE session ADD COLUMN subscriptions BLOB")
+                conn.commit()
+                conn.close()
+                self.writer = SQLiteWriter(self.db_file,
+                                           self.persistence_config.get('batch-size', 100),
+                                           self.persistence_config.get('flush-interval', 0))
+                self.readers = ThreadPoolExecutor(max_workers=self.persistence_config.get('readers', 2))
                 self.context.logger.info("Database file '%s' opened" % self.db_file)
             except Exception as e:
                 self.context.logger.error("Error while initializing database '%s' : %s" % (self.db_file, e))
-        if self.cursor:
-            self.cursor.execute("CREATE TABLE IF NOT EXISTS session(client_id TEXT PRIMARY KEY, data BLOB)")
+
+    def _reader_connection(self):
+        # Runs in a reader thread, each one has its own connection
+        conn = getattr(self._reader_local, 'conn', None)
+        if conn is None:
+            # Only used by this thread until the readers are stopped, then closed by on_broker_post_shutdown
+            conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._reader_local.conn = conn
+            self._reader_connections.append(conn)
+        return conn
+
+    def _find_session(self, client_id):
+        row = self._reader_connection().execute("SELECT data FROM session where client_id=?", (client_id,)).fetchone()
+        if row:
+            try:
+                return decode_state(row[0])
+            except CodecException as ce:
+                self.context.logger.warning("Invalid state of saved session '%s': %s" % (client_id, ce))
+        return None
+
+    def _list_sessions(self):
+        rows = self._reader_connection().execute(
+            "SELECT client_id, subscriptions FROM session WHERE subscriptions IS NOT NULL")
+        sessions = []
+        for client_id, subscriptions in rows:
+            try:
+                sessions.append((client_id, decode_subscriptions(subscriptions)))
+            except CodecException as ce:
+                self.context.logger.warning("Invalid subscriptions of saved session '%s': %s" % (client_id, ce))
+        return sessions
 
     @asyncio.coroutine
-    def save_session(self, session):
-        if self.cursor:
-            dump = pickle.dumps(session)
+    def save_session(self, session, subscriptions, state):
+        """
+        Save a persistent session
+        :param session: session to save
+        :param subscriptions: list of (filter, qos) tuples
+        :param state: session state, see :meth:`hbmqtt.session.Session.persistent_state`
+        :return: True once saved
+        """
+        if self.writer:
             try:
-                self.cursor.execute(
-                    "INSERT OR REPLACE INTO session (client_id, data) VALUES (?,?)", (session.client_id, dump))
-                self.conn.commit()
+                yield from self.writer.execute(
+                    "INSERT OR REPLACE INTO session (client_id, data, subscriptions) VALUES (?,?,?)",
+                    (session.client_id, encode_state(state), encode_subscriptions(subscriptions)),
+                    loop=self.context.loop)
+                return True
             except Exception as e:
                 self.context.logger.error("Failed saving session '%s': %s" % (session, e))
+        return False
 
     @asyncio.coroutine
     def find_session(self, client_id):
-        if self.cursor:
-            row = self.cursor.execute("SELECT data FROM session where client_id=?", (client_id,)).fetchone()
-            if row:
-                return pickle.loads(row[0])
-            else:
-                return None
+        """
+        Get the state of a saved session
+        :return: session state, or None if the session wasn't saved
+        """
+        if self.readers:
+            return (yield from self.context.loop.run_in_executor(self.readers, self._find_session, client_id))
+
+    @asyncio.coroutine
+    def list_sessions(self):
+        """
+        Get subscriptions of all saved sessions, without their state
+        :return: list of (client_id, list of (filter, qos) tuples) tuples
+        """
+        if self.readers:
+            return (yield from self.context.loop.run_in_executor(self.readers, self._list_sessions))
 
     @asyncio.coroutine
     def del_session(self, client_id):
-        if self.cursor:
-            self.cursor.execute("DELETE FROM session where client_id=?", (client_id,))
-            self.conn.commit()
+        if self.writer:
+            yield from self.writer.execute("DELETE FROM session where client_id=?", (client_id,),
+                                           loop=self.context.loop)
 
     @asyncio.coroutine
-    def on_broker_post_shutdown(self):
-        if self.conn:
-            self.conn.close()
+    def on_broker_post_shutdown(self, *args, **kwargs):
+        if self.writer:
+            writer, self.writer = self.writer, None
+            yield from self.context.loop.run_in_executor(None, writer.close)
+            readers, self.readers = self.readers, None
+            # Wait for reader threads to end before closing their connections
+            yield from self.context.loop.run_in_executor(None, readers.shutdown)
+            for conn in self._reader_connections:
+                conn.close()
+            self._reader_connections.clear()
             self.context.logger.info("Database file '%s' closed" % self.db_file)
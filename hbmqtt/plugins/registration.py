@@ -1,13 +1,11 @@
 import logging
 import asyncio
-from passlib.hash import sha256_crypt
 import os
-from hbmqtt.utils import read_yaml_config, write_yaml_config
+from hbmqtt.identities import open_identity_store
 
 class RegistrationPlugin:
     def __init__(self, context):
         self.context = context
-        self._users = dict()
         try:
             self.auth_config = self.context.config['auth']
         except KeyError:
@@ -23,22 +21,8 @@ class RegistrationPlugin:
 
 
     def _read_password_file(self):
-        try:
-            self._users = read_yaml_config(self.password_file)
-        except:
-            pass
-
-    @asyncio.coroutine
-    def write_password_file(self, *args, **kwargs):
-        self.context.logger.debug("Registration user persistence: starting")
-        password_file_backup = self.password_file + ".bck"
-        # save a backup of our old user database just in case
-        if (os.path.isfile(password_file_backup)):
-            os.remove(password_file_backup)
-        if (os.path.isfile(self.password_file)):
-            os.rename(self.password_file, password_file_backup)
-        write_yaml_config(self._users, self.password_file)
-        self.context.logger.debug("Registration user persistence: success")
+        # Shared with the authentication plugin, changes are persisted by the store
+        self._identities = open_identity_store(self.context.config, self.password_file)
 
     @asyncio.coroutine
     def register(self, *args, **kwargs):
@@ -56,21 +40,22 @@ class RegistrationPlugin:
         except IndexError:
             self.context.logger.error("Registration failed: invalid registration format")
             return None, None
-        if username in self._users:
+
+        # Other broker workers may have registered users since last read
+        self._identities.refresh(check_now=True)
+        if self._identities.has_user(username):
             self.context.logger.error("Registration failed: user already exists")
             return None, None
 
-        self._read_password_file()
-
-        pwd_hash = sha256_crypt.hash(password)
-        self._users[username] = {'password': pwd_hash}
-
-        key_hash = sha256_crypt.hash(devicekey)
-        self._users[username]['devices'] = {deviceid : {'key' : key_hash}}
-        self._users[username]['acl_publish_all'] = []
-        self._users[username]['acl_subscribe_all'] = []
-        self._users[username]['acl_publish'] =  {deviceid : []}
-        self._users[username]['acl_subscribe'] = {deviceid : []}
+        pwd_hash, key_hash = yield from asyncio.gather(
+            self.context.hashing.hash(password),
+            self.context.hashing.hash(devicekey),
+            loop=self.context.loop)
+        # Users may have been registered by another client while hashing
+        if self._identities.has_user(username):
+            self.context.logger.error("Registration failed: user already exists")
+            return None, None
+        yield from self._identities.add_user(username, pwd_hash, deviceid, key_hash)
         self.context.logger.info(f"Registered user {username}")
         return username, deviceid
 
@@ -80,19 +65,20 @@ class RegistrationPlugin:
         deviceid = kwargs['deviceid']
         devicekey = kwargs['devicekey']
 
-        self._read_password_file()
-        
-        if deviceid in self._users[username]['devices']:
+        self._identities.refresh(check_now=True)
+
+        if self._identities.has_device(username, deviceid):
             self.context.logger.error("Device registration failed: device already exists")
             return None, None
 
-        key_hash = sha256_crypt.hash(devicekey)
-        self._users[username]['devices'][deviceid] = {'key' : key_hash}
-        self._users[username]['acl_publish'][deviceid] = []
-        self._users[username]['acl_subscribe'][deviceid] = []
+        key_hash = yield from self.context.hashing.hash(devicekey)
+        if self._identities.has_device(username, deviceid):
+            self.context.logger.error("Device registration failed: device already exists")
+            return None, None
+        yield from self._identities.add_device(username, deviceid, key_hash)
         self.context.logger.info(f"Registed device {deviceid}")
         return username, deviceid
 
     @asyncio.coroutine
     def on_broker_post_shutdown(self, *args, **kwargs):
-        yield from self.write_password_file()
+        yield from self._identities.close()
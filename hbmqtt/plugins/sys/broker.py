@@ -2,20 +2,15 @@
 #
 # See the file license.txt for copying permission.
 from datetime import datetime
-from hbmqtt.mqtt.packet import PUBLISH
 from hbmqtt.codecs import int_to_bytes_str
+from hbmqtt.queues import OVERLOAD_EVENTS
+from hbmqtt.offline import EVENT_EXPIRED
 import asyncio
 import sys
 from collections import deque
 
 
 DOLLAR_SYS_ROOT = '$SYS/broker/'
-STAT_BYTES_SENT = 'bytes_sent'
-STAT_BYTES_RECEIVED = 'bytes_received'
-STAT_MSG_SENT = 'messages_sent'
-STAT_MSG_RECEIVED = 'messages_received'
-STAT_PUBLISH_SENT = 'publish_sent'
-STAT_PUBLISH_RECEIVED = 'publish_received'
 STAT_START_TIME = 'start_time'
 STAT_CLIENTS_MAXIMUM = 'clients_maximum'
 STAT_CLIENTS_CONNECTED = 'clients_connected'
@@ -33,15 +28,9 @@ class BrokerSysPlugin:
         """
         Initializes broker statistics data structures
         """
-        for stat in (STAT_BYTES_RECEIVED,
-                     STAT_BYTES_SENT,
-                     STAT_MSG_RECEIVED,
-                     STAT_MSG_SENT,
-                     STAT_CLIENTS_MAXIMUM,
+        for stat in (STAT_CLIENTS_MAXIMUM,
                      STAT_CLIENTS_CONNECTED,
-                     STAT_CLIENTS_DISCONNECTED,
-                     STAT_PUBLISH_RECEIVED,
-                     STAT_PUBLISH_SENT):
+                     STAT_CLIENTS_DISCONNECTED):
             self._stats[stat] = 0
 
     @asyncio.coroutine
@@ -96,21 +85,33 @@ class BrokerSysPlugin:
         inflight_in = 0
         inflight_out = 0
         messages_stored = 0
+        messages_spooled = 0
         for session in self.context.sessions:
             inflight_in += session.inflight_in_count
             inflight_out += session.inflight_out_count
             messages_stored += session.retained_messages_count
+            messages_spooled += getattr(session.retained_messages, 'spooled_count', 0)
         messages_stored += len(self.context.retained_messages)
-        subscriptions_count = 0
-        for topic in self.context.subscriptions:
-            subscriptions_count += len(self.context.subscriptions[topic])
+        messages_queued = 0
+        for handler in self.context.handlers:
+            messages_queued += handler.outbound_queue_depth
+        subscriptions_count = len(self.context.subscriptions)
+        # Bytes and packets are counted by the listeners connections
+        bytes_received = bytes_sent = packets_received = packets_sent = publish_received = publish_sent = 0
+        for server in self.context.servers.values():
+            bytes_received += server.traffic.bytes_received
+            bytes_sent += server.traffic.bytes_sent
+            packets_received += server.traffic.packets_received
+            packets_sent += server.traffic.packets_sent
+            publish_received += server.traffic.publish_received
+            publish_sent += server.traffic.publish_sent
 
         # Broadcast updates
         tasks = deque()
-        tasks.append(self.schedule_broadcast_sys_topic('load/bytes/received', int_to_bytes_str(self._stats[STAT_BYTES_RECEIVED])))
-        tasks.append(self.schedule_broadcast_sys_topic('load/bytes/sent', int_to_bytes_str(self._stats[STAT_BYTES_SENT])))
-        tasks.append(self.schedule_broadcast_sys_topic('messages/received', int_to_bytes_str(self._stats[STAT_MSG_RECEIVED])))
-        tasks.append(self.schedule_broadcast_sys_topic('messages/sent', int_to_bytes_str(self._stats[STAT_MSG_SENT])))
+        tasks.append(self.schedule_broadcast_sys_topic('load/bytes/received', int_to_bytes_str(bytes_received)))
+        tasks.append(self.schedule_broadcast_sys_topic('load/bytes/sent', int_to_bytes_str(bytes_sent)))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/received', int_to_bytes_str(packets_received)))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/sent', int_to_bytes_str(packets_sent)))
         tasks.append(self.schedule_broadcast_sys_topic('time', str(datetime.now()).encode('utf-8')))
         tasks.append(self.schedule_broadcast_sys_topic('uptime', int_to_bytes_str(int(uptime.total_seconds()))))
         tasks.append(self.schedule_broadcast_sys_topic('uptime/formated', str(uptime).encode('utf-8')))
@@ -122,10 +123,37 @@ class BrokerSysPlugin:
         tasks.append(self.schedule_broadcast_sys_topic('messages/inflight/in', int_to_bytes_str(inflight_in)))
         tasks.append(self.schedule_broadcast_sys_topic('messages/inflight/out', int_to_bytes_str(inflight_out)))
         tasks.append(self.schedule_broadcast_sys_topic('messages/inflight/stored', int_to_bytes_str(messages_stored)))
-        tasks.append(self.schedule_broadcast_sys_topic('messages/publish/received', int_to_bytes_str(self._stats[STAT_PUBLISH_RECEIVED])))
-        tasks.append(self.schedule_broadcast_sys_topic('messages/publish/sent', int_to_bytes_str(self._stats[STAT_PUBLISH_SENT])))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/inflight/spooled', int_to_bytes_str(messages_spooled)))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/outbound/queued', int_to_bytes_str(messages_queued)))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/publish/received', int_to_bytes_str(publish_received)))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/publish/sent', int_to_bytes_str(publish_sent)))
         tasks.append(self.schedule_broadcast_sys_topic('messages/retained/count', int_to_bytes_str(len(self.context.retained_messages))))
+        tasks.append(self.schedule_broadcast_sys_topic('messages/retained/bytes', int_to_bytes_str(self.context.retained_messages.stored_bytes)))
         tasks.append(self.schedule_broadcast_sys_topic('messages/subscriptions/count', int_to_bytes_str(subscriptions_count)))
+        for shard in self.context.broadcast_shards:
+            count, latency_avg, latency_max = shard.pop_latency()
+            shard_topic = 'broadcast/shards/%d/' % shard.index
+            tasks.append(self.schedule_broadcast_sys_topic(shard_topic + 'queued', int_to_bytes_str(shard.depth)))
+            tasks.append(self.schedule_broadcast_sys_topic(shard_topic + 'messages', int_to_bytes_str(count)))
+            tasks.append(self.schedule_broadcast_sys_topic(shard_topic + 'latency/avg_us', int_to_bytes_str(int(latency_avg * 1e6))))
+            tasks.append(self.schedule_broadcast_sys_topic(shard_topic + 'latency/max_us', int_to_bytes_str(int(latency_max * 1e6))))
+        queue_counters = self.context.queue_counters
+        for queue_name in ('broadcast', 'session', 'outbound', 'offline'):
+            for event in OVERLOAD_EVENTS:
+                tasks.append(self.schedule_broadcast_sys_topic(
+                    'queues/%s/%s' % (queue_name, event), int_to_bytes_str(queue_counters[(queue_name, event)])))
+        tasks.append(self.schedule_broadcast_sys_topic(
+            'queues/offline/%s' % EVENT_EXPIRED, int_to_bytes_str(queue_counters[('offline', EVENT_EXPIRED)])))
+        for listener_name, server in self.context.servers.items():
+            listener_topic = 'listeners/%s/' % listener_name
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'connections', int_to_bytes_str(server.conn_count)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'handshakes', int_to_bytes_str(server.handshakes_count)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'handshakes/waiting', int_to_bytes_str(server.handshakes_waiting)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'refused', int_to_bytes_str(server.refused_count)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'bytes/received', int_to_bytes_str(server.traffic.bytes_received)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'bytes/sent', int_to_bytes_str(server.traffic.bytes_sent)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'messages/received', int_to_bytes_str(server.traffic.packets_received)))
+            tasks.append(self.schedule_broadcast_sys_topic(listener_topic + 'messages/sent', int_to_bytes_str(server.traffic.packets_sent)))
 
         # Wait until broadcasting tasks end
         while tasks and tasks[0].done():
@@ -135,26 +163,6 @@ class BrokerSysPlugin:
         self.context.logger.debug("Broadcasting $SYS topics")
         self.sys_handle = self.context.loop.call_later(sys_interval, self.broadcast_dollar_sys_topics)
 
-    @asyncio.coroutine
-    def on_mqtt_packet_received(self, *args, **kwargs):
-        packet = kwargs.get('packet')
-        if packet:
-            packet_size = packet.bytes_length
-            self._stats[STAT_BYTES_RECEIVED] += packet_size
-            self._stats[STAT_MSG_RECEIVED] += 1
-            if packet.fixed_header.packet_type == PUBLISH:
-                self._stats[STAT_PUBLISH_RECEIVED] += 1
-
-    @asyncio.coroutine
-    def on_mqtt_packet_sent(self, *args, **kwargs):
-        packet = kwargs.get('packet')
-        if packet:
-            packet_size = packet.bytes_length
-            self._stats[STAT_BYTES_SENT] += packet_size
-            self._stats[STAT_MSG_SENT] += 1
-            if packet.fixed_header.packet_type == PUBLISH:
-                self._stats[STAT_PUBLISH_SENT] += 1
-
     @asyncio.coroutine
     def on_broker_client_connected(self, *args, **kwargs):
         self._stats[STAT_CLIENTS_CONNECTED] += 1
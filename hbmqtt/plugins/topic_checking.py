@@ -1,5 +1,6 @@
 import asyncio
-from hbmqtt.utils import read_yaml_config, write_yaml_config
+from hbmqtt.utils import LRUCache
+from hbmqtt.identities import open_identity_store
 import os
 
 class BaseTopicPlugin:
@@ -43,6 +44,38 @@ class TopicTabooPlugin(BaseTopicPlugin):
         else:
             return True
 
+class TopicMatcher:
+    """
+    Topics allowed to an identity, compiled in a tree of topic levels.
+
+    Matching follows :meth:`TopicAccessControlListPlugin.topic_ac`: '+' matches one level, '#' matches one or
+    more levels.
+    :param allowed_topics: allowed topic filters
+    """
+    def __init__(self, allowed_topics):
+        self._root = dict()
+        for allowed_topic in allowed_topics:
+            node = self._root
+            for level in allowed_topic.split('/'):
+                node = node.setdefault(level, dict())
+            # Filter end marker, levels are strings
+            node[None] = True
+
+    def allows(self, topic):
+        return self._match(self._root, topic.split('/'), 0)
+
+    def _match(self, node, levels, index):
+        if index == len(levels):
+            return None in node
+        if '#' in node:
+            return True
+        child = node.get(levels[index])
+        if child is not None and self._match(child, levels, index + 1):
+            return True
+        child = node.get('+')
+        return child is not None and self._match(child, levels, index + 1)
+
+
 class TopicAccessControlListPlugin(BaseTopicPlugin):
     def __init__(self, context):
         super().__init__(context)
@@ -51,27 +84,19 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
             os.exit(1)
 
         self.acl_file = self.topic_config['acl']['file']
-        self._users = dict()
+        self._identities = None
+        # Matchers of (username, deviceid, publish) and decisions of (username, deviceid, publish, topic), valid
+        # for one version of the ACL file
+        cache_size = self.topic_config['acl'].get('cache-size', 10000)
+        self._matchers = LRUCache(cache_size)
+        self._decisions = LRUCache(cache_size)
+        self._acl_version = None
 
         self._read_acl_file()
 
     def _read_acl_file(self):
-        try:
-            self._users = read_yaml_config(self.acl_file)
-        except FileNotFoundError:
-            pass
-
-    @asyncio.coroutine
-    def write_acl_file(self):
-        if not self.acl_file:
-            self.context.logger.warning("'file' acl parameter not found")
-            return
-
-        if len(self._users.keys()) == 0:
-            return
-
-        self.context.logger.debug("ACL plugin: writing ACL")
-        write_yaml_config(self._users, self.acl_file)
+        # Shared with other plugins using the same identities, changes are persisted by the store
+        self._identities = open_identity_store(self.context.config, self.acl_file)
 
     @staticmethod
     def topic_ac(topic_requested, topic_allowed):
@@ -94,19 +119,37 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
                 break
         return ret
 
+    def _check_acl_version(self):
+        if self._identities.version != self._acl_version:
+            self._matchers.clear()
+            self._decisions.clear()
+            self._acl_version = self._identities.version
+
+    def _get_matcher(self, username, deviceid, publish):
+        key = (username, deviceid, publish)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            allowed_topics = self._identities.get_acl(username, None, publish) + \
+                self._identities.get_acl(username, deviceid, publish)
+            matcher = TopicMatcher(allowed_topics)
+            self._matchers.put(key, matcher)
+        return matcher
+
     @asyncio.coroutine
     def topic_filtering(self, *args, **kwargs):
-        self._read_acl_file()
-        if len(self._users) == 0:
+        self._identities.refresh()
+        self._check_acl_version()
+        if self._identities.users_count() == 0:
             return True
         filter_result = super().topic_filtering(*args, **kwargs)
         if filter_result:
             session = kwargs.get('session', None)
             req_topic = kwargs.get('topic', None)
-            publish = kwargs.get('publish', None)
+            publish = bool(kwargs.get('publish', None))
             if req_topic:
                 if session.username is None:
                     username = 'anonymous'
+                    deviceid = None
                 else:
                     try:
                         username = session.username.split('-')[0]
@@ -115,17 +158,12 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
                         self.context.logger.error("topic_check failed: invalid username-deviceid format")
                         return False
                 self.context.logger.debug(f"topic_check: checking ACL for topic {req_topic} for user {username}")
-                if publish:
-                    allowed_topics = self._users[username]['acl_publish_all'] + self._users[username]['acl_publish'][deviceid]
-                else:
-                    allowed_topics = self._users[username]['acl_subscribe_all'] + self._users[username]['acl_subscribe'][deviceid]
-                if allowed_topics:
-                    for allowed_topic in allowed_topics:
-                        if self.topic_ac(req_topic, allowed_topic):
-                            return True
-                    return False
-                else:
-                    return False
+                decision_key = (username, deviceid, publish, req_topic)
+                allowed = self._decisions.get(decision_key)
+                if allowed is None:
+                    allowed = self._get_matcher(username, deviceid, publish).allows(req_topic)
+                    self._decisions.put(decision_key, allowed)
+                return allowed
             else:
                 return False
         else:
@@ -133,8 +171,8 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
 
     @asyncio.coroutine
     def add_user_acl(self, *args, **kwargs):
-        self._read_acl_file()
-        if len(self._users) == 0:
+        self._identities.refresh(check_now=True)
+        if self._identities.users_count() == 0:
             return False
         username = kwargs.get('username', "")
         device = kwargs.get('device', "")
@@ -149,7 +187,7 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
         topics_pub_to_add = {}
         topics_sub_to_add = {}
 
-        if username not in self._users:
+        if not self._identities.has_user(username):
             self.context.logger.error(f"topic_check: user {username} not found")
             return False
         else:
@@ -159,20 +197,20 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
             topics_sub = topics['acl_subscribe']
 
             for topic in topics_pub_all:
-                if topic in self._users[username]['acl_publish_all']:
+                if topic in self._identities.get_acl(username, None, True):
                     self.context.logger.error(f"topic_check: topic {topic} already exists for user {username}")
                     return False
                 else:
                     topics_pub_all_to_add.append(topic)
             for topic in topics_sub_all:
-                if topic in self._users[username]['acl_subscribe_all']:
+                if topic in self._identities.get_acl(username, None, False):
                     self.context.logger.error(f"topic_check: topic {topic} already exists for user {username}")
                     return False
                 else:
                     topics_sub_all_to_add.append(topic)
             for device, topics in topics_pub.items():
                 for topic in topics:
-                    if topic in self._users[username]['acl_publish'][device]:
+                    if topic in self._identities.get_acl(username, device, True):
                         self.context.logger.error(f"topic_check: topic {topic} already exists for device {device}")
                         return False
                     else:
@@ -182,7 +220,7 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
                             topics_pub_to_add[device] = [topic]
             for device, topics in topics_sub.items():
                 for topic in topics:
-                    if topic in self._users[username]['acl_subscribe'][device]:
+                    if topic in self._identities.get_acl(username, device, False):
                         self.context.logger.error(f"topic_check: topic {topic} already exists for device {device}")
                         return False
                     else:
@@ -191,21 +229,22 @@ class TopicAccessControlListPlugin(BaseTopicPlugin):
                         else:
                             topics_sub_to_add[device] = [topic]
 
-            self._users[username]['acl_publish_all'].extend(topics_pub_all_to_add)
-            self._users[username]['acl_subscribe_all'].extend(topics_sub_all_to_add)
-
-            for device, topics in topics_pub_to_add.items():
-                self._users[username]['acl_publish'][device].extend(topics)
-
-            for device, topics in topics_sub_to_add.items():
-                self._users[username]['acl_subscribe'][device].extend(topics)
-
-        yield from self.write_acl_file()
+            yield from self._identities.add_acl(username, {
+                'acl_publish_all': topics_pub_all_to_add,
+                'acl_subscribe_all': topics_sub_all_to_add,
+                'acl_publish': topics_pub_to_add,
+                'acl_subscribe': topics_sub_to_add,
+            })
 
         self.context.logger.info(f"topic_check: added ACL for topics {topics} for user {username}")
 
         return True
 
+    @asyncio.coroutine
+    def on_broker_identities_changed(self, *args, **kwargs):
+        # ACL may have been changed by another worker
+        self._identities.refresh(check_now=True)
+
     @asyncio.coroutine
     def on_broker_post_shutdown(self, *args, **kwargs):
-        yield from self.write_acl_file()
+        yield from self._identities.close()
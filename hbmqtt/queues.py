@@ -0,0 +1,113 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+
+from hbmqtt.mqtt.constants import QOS_0
+from hbmqtt.errors import QueueOverflowError
+
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_QOS0 = 'drop_qos0'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DISCONNECT = 'disconnect'
+
+OVERLOAD_POLICIES = (POLICY_BLOCK, POLICY_DROP_QOS0, POLICY_DROP_OLDEST, POLICY_DISCONNECT)
+
+# Overload events counted
+EVENT_DROPPED = 'dropped'
+EVENT_BLOCKED = 'blocked'
+EVENT_DISCONNECTED = 'disconnected'
+
+OVERLOAD_EVENTS = (EVENT_DROPPED, EVENT_BLOCKED, EVENT_DISCONNECTED)
+
+
+class OverloadQueue(asyncio.Queue):
+    """
+    asyncio Queue applying an overload policy when an item is put in the queue while it is full:
+
+     - ``block``: wait for a free slot
+     - ``drop_qos0``: drop the new item if it has been published with QOS_0, otherwise wait for a free slot
+     - ``drop_oldest``: drop the item at the head of the queue to make room for the new item
+     - ``disconnect``: raise :class:`~hbmqtt.errors.QueueOverflowError`, the caller is expected to disconnect the
+       client feeding the queue
+
+    Each drop, wait or overflow is counted in ``counters[(name, event)]``.
+
+    :param maxsize: queue size, unbounded if 0
+    :param policy: overload policy
+    :param name: queue name used as counters key
+    :param counters: :class:`collections.Counter` shared by broker queues, or None
+    :param loop: asyncio loop to use
+    """
+
+    def __init__(self, maxsize=0, policy=POLICY_BLOCK, name=None, counters=None, loop=None):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError("Invalid overload policy '%s', expected one of %s" % (policy, ', '.join(OVERLOAD_POLICIES)))
+        super().__init__(maxsize=maxsize, loop=loop)
+        self.policy = policy
+        self.name = name
+        self.counters = counters
+        self._not_full = asyncio.Event(loop=loop)
+        self._not_full.set()
+
+    def _put(self, item):
+        super()._put(item)
+        if self.full():
+            self._not_full.clear()
+
+    def _get(self):
+        item = super()._get()
+        self._not_full.set()
+        return item
+
+    def count(self, event):
+        if self.counters is not None:
+            self.counters[(self.name, event)] += 1
+
+    @asyncio.coroutine
+    def put(self, item, qos=None):
+        """
+        Put an item in the queue, applying the overload policy if the queue is full
+        :param item: item to queue
+        :param qos: QoS the item has been published with, used by the ``drop_qos0`` policy
+        :return: True if the item has been queued, False if it has been dropped
+        """
+        if self.full() and (self.policy == POLICY_BLOCK or (self.policy == POLICY_DROP_QOS0 and qos != QOS_0)):
+            self.count(EVENT_BLOCKED)
+            yield from super().put(item)
+            return True
+        return self.offer(item, qos)
+
+    def offer(self, item, qos=None):
+        """
+        Put an item in the queue without waiting, applying the overload policy if the queue is full. Items the
+        ``block`` and ``drop_qos0`` policies would wait for raise :class:`~hbmqtt.errors.QueueOverflowError`, as with
+        the ``disconnect`` policy.
+        :param item: item to queue
+        :param qos: QoS the item has been published with, used by the ``drop_qos0`` policy
+        :return: True if the item has been queued, False if it has been dropped
+        """
+        if not self.full():
+            self.put_nowait(item)
+            return True
+        if self.policy == POLICY_DROP_OLDEST:
+            self.get_nowait()
+            self.count(EVENT_DROPPED)
+            self.put_nowait(item)
+            return True
+        if self.policy == POLICY_DROP_QOS0 and qos == QOS_0:
+            self.count(EVENT_DROPPED)
+            return False
+        self.count(EVENT_DISCONNECTED)
+        raise QueueOverflowError("Queue '%s' full (%d items)" % (self.name, self.maxsize))
+
+    @asyncio.coroutine
+    def wait_not_full(self):
+        """
+        Wait until the queue has a free slot, if its policy is ``block``. Used to stop reading from a client while
+        the queue it feeds is full.
+        """
+        if self.policy == POLICY_BLOCK and self.full():
+            self.count(EVENT_BLOCKED)
+            yield from self._not_full.wait()
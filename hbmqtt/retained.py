@@ -0,0 +1,201 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import logging
+import mmap
+import os
+import struct
+import threading
+
+DEFAULT_COMPACT_MIN_RECORDS = 10000
+
+# Snapshot file magic and sequence number of the last log it includes
+_snapshot_header = struct.Struct('!8sQ')
+_SNAPSHOT_MAGIC = b'HBMQTTR1'
+# record kind, QoS (255 if none), topic length, data length
+_record_header = struct.Struct('!BBHI')
+_SET = 1
+_DELETE = 2
+_NO_QOS = 255
+
+
+class RetainedMessageStore:
+    """
+    Retained messages saved in a directory, so that they survive broker restarts.
+
+    Each change is appended to a log file, which costs one write whatever the number of retained messages. Once
+    the number of records logged since the last snapshot exceeds the number of messages in the snapshot (and
+    ``compact_min_records``), a new log file is started and a thread writes a new snapshot from the previous one
+    and the logs closed so far, then deletes these logs. Snapshot writing is thus paid once per as many changes as
+    there are retained messages, and doesn't block the event loop.
+
+    :meth:`load` memory maps the snapshot and replays it, then the logs written after it. Records truncated by a
+    crash at the end of a log are ignored.
+
+    :param directory: directory of snapshot and log files
+    :param compact_min_records: minimum number of records logged before a snapshot is written
+    """
+
+    def __init__(self, directory, compact_min_records=DEFAULT_COMPACT_MIN_RECORDS):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.compact_min_records = compact_min_records
+        self._log = None
+        self._sequence = 0
+        self._log_records = 0
+        self._snapshot_records = 0
+        self._compaction = None
+
+    def _snapshot_path(self):
+        return os.path.join(self.directory, 'snapshot')
+
+    def _log_path(self, sequence):
+        return os.path.join(self.directory, '%010d.log' % sequence)
+
+    def _log_sequences(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+
+    @staticmethod
+    def _replay(buffer, offset, messages):
+        """
+        Apply records to a dict of topic -> (data, qos)
+        :return: number of records read
+        """
+        count = 0
+        end = len(buffer)
+        header_size = _record_header.size
+        unpack_from = _record_header.unpack_from
+        while offset + header_size <= end:
+            kind, qos, topic_length, data_length = unpack_from(buffer, offset)
+            start = offset + header_size
+            offset = start + topic_length + data_length
+            if offset > end:
+                # Truncated by a crash while being written
+                break
+            topic = str(buffer[start:start + topic_length], 'utf-8')
+            if kind == _SET:
+                messages[topic] = (buffer[start + topic_length:offset], qos if qos != _NO_QOS else None)
+            else:
+                messages.pop(topic, None)
+            count += 1
+        return count
+
+    def _read_file(self, path, messages, header=None):
+        """
+        Replay a snapshot or log file
+        :return: snapshot sequence if header is given, otherwise number of records read
+        """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            offset = header.size if header is not None else 0
+            if size <= offset:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                if header is None:
+                    return self._replay(view, 0, messages)
+                magic, sequence = header.unpack_from(view, 0)
+                if magic != _SNAPSHOT_MAGIC:
+                    self.logger.warning("Invalid retained messages snapshot '%s', ignored" % path)
+                    return 0
+                self._replay(view, offset, messages)
+                return sequence
+
+    def load(self):
+        """
+        Read retained messages saved by a previous run and start a new log
+        :return: dict of topic -> (data, qos)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        messages = dict()
+        snapshot_sequence = self._read_file(self._snapshot_path(), messages, _snapshot_header)
+        self._snapshot_records = len(messages)
+        self._log_records = 0
+        sequences = self._log_sequences()
+        for sequence in sequences:
+            if sequence <= snapshot_sequence:
+                # Already in the snapshot, left by a compaction interrupted before deleting it
+                os.remove(self._log_path(sequence))
+            else:
+                self._log_records += self._read_file(self._log_path(sequence), messages)
+        self._sequence = max(sequences + [snapshot_sequence]) + 1
+        self._log = open(self._log_path(self._sequence), 'ab')
+        return messages
+
+    def set(self, topic, data, qos=None):
+        """
+        Log the retained message of a topic
+        """
+        self._append(_SET, topic, data, qos)
+
+    def delete(self, topic):
+        """
+        Log the deletion of the retained message of a topic
+        """
+        self._append(_DELETE, topic, b'', None)
+
+    def _append(self, kind, topic, data, qos):
+        topic = topic.encode('utf-8')
+        self._log.write(_record_header.pack(kind, qos if qos is not None else _NO_QOS, len(topic), len(data)))
+        self._log.write(topic)
+        self._log.write(data)
+        self._log.flush()
+        self._log_records += 1
+        if self._log_records >= max(self.compact_min_records, self._snapshot_records) and \
+                (self._compaction is None or not self._compaction.is_alive()):
+            self._compact()
+
+    def _compact(self):
+        """
+        Start a new log, and write a new snapshot including the previous logs in a thread
+        """
+        self._log.close()
+        last_sequence = self._sequence
+        self._sequence += 1
+        self._log = open(self._log_path(self._sequence), 'ab')
+        self._snapshot_records += self._log_records
+        self._log_records = 0
+        self._compaction = threading.Thread(target=self._write_snapshot, args=(last_sequence,),
+                                            name='hbmqtt-retained-compaction', daemon=True)
+        self._compaction.start()
+
+    def _write_snapshot(self, last_sequence):
+        try:
+            messages = dict()
+            snapshot_sequence = self._read_file(self._snapshot_path(), messages, _snapshot_header)
+            sequences = [sequence for sequence in self._log_sequences()
+                         if snapshot_sequence < sequence <= last_sequence]
+            for sequence in sequences:
+                self._read_file(self._log_path(sequence), messages)
+            path = self._snapshot_path()
+            with open(path + '.tmp', 'wb') as snapshot:
+                snapshot.write(_snapshot_header.pack(_SNAPSHOT_MAGIC, last_sequence))
+                for topic, (data, qos) in messages.items():
+                    topic = topic.encode('utf-8')
+                    snapshot.write(_record_header.pack(
+                        _SET, qos if qos is not None else _NO_QOS, len(topic), len(data)))
+                    snapshot.write(topic)
+                    snapshot.write(data)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(path + '.tmp', path)
+            for sequence in sequences:
+                os.remove(self._log_path(sequence))
+            self._snapshot_records = len(messages)
+            self.logger.debug("Retained messages snapshot written, %d messages" % len(messages))
+        except Exception as e:
+            self.logger.error("Failed writing retained messages snapshot: %s" % e)
+
+    def close(self):
+        """
+        Wait for a running compaction and close the log. This method blocks until the compaction ends.
+        """
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
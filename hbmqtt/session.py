@@ -3,10 +3,13 @@
 # See the file license.txt for copying permission.
 import asyncio
 from transitions import Machine
-from asyncio import Queue
 from collections import OrderedDict
 from hbmqtt.mqtt.publish import PublishPacket
+from hbmqtt.mqtt.pubrec import PubrecPacket
+from hbmqtt.mqtt.pubrel import PubrelPacket
 from hbmqtt.errors import HBMQTTException
+from hbmqtt.queues import OverloadQueue, POLICY_BLOCK, POLICY_DROP_OLDEST
+from hbmqtt.offline import OfflineMessageStore
 
 OUTGOING = 0
 INCOMING = 1
@@ -34,7 +37,7 @@ class ApplicationMessage:
         """ Publish message Quality of Service"""
 
         self.data = data
-        """ Publish message payload data"""
+        """ Publish message payload data. Messages received by the broker hold a read-only memoryview of the received PUBLISH packet, sent to subscribers without copy."""
 
         self.retain = retain
         """ Publish message retain flag"""
@@ -86,12 +89,38 @@ class OutgoingApplicationMessage(ApplicationMessage):
         Outgoing :class:`~hbmqtt.session.ApplicationMessage`.
     """
 
-    __slots__ = ('direction',)
+    __slots__ = ('direction', 'publish_frame', '_publish_packet', '_frame_sent')
 
-    def __init__(self, packet_id, topic, qos, data, retain):
+    def __init__(self, packet_id, topic, qos, data, retain, publish_frame=None):
+        self._frame_sent = False
         super().__init__(packet_id, topic, qos, data, retain)
         self.direction = OUTGOING
 
+        self.publish_frame = publish_frame
+        """ :class:`hbmqtt.mqtt.publish.PublishFrame` shared with other sessions the message is sent to, or ``None``"""
+
+    @property
+    def publish_packet(self):
+        """ :class:`hbmqtt.mqtt.publish.PublishPacket` sent for the message, ``None`` if it has not been sent. When the message was written with its ``publish_frame``, the packet is only built when first read."""
+        if self._publish_packet is None and self._frame_sent:
+            self._publish_packet = self.build_publish_packet()
+        return self._publish_packet
+
+    @publish_packet.setter
+    def publish_packet(self, packet):
+        self._publish_packet = packet
+
+    @property
+    def sent(self):
+        """ ``True`` once the PUBLISH packet of the message has been written"""
+        return self._frame_sent or self._publish_packet is not None
+
+    def frame_sent(self):
+        """
+        Record the message was written with its ``publish_frame``, without building its PUBLISH packet
+        """
+        self._frame_sent = True
+
 
 class Session:
     states = ['new', 'connected', 'disconnected']
@@ -128,11 +157,92 @@ class Session:
         # Used to store incoming ApplicationMessage while publish protocol flows
         self.inflight_in = OrderedDict()
 
+        # Filters the session is subscribed to on broker side
+        self.subscriptions = set()
+
         # Stores messages retained for this session
-        self.retained_messages = Queue(loop=self._loop)
+        self.retained_messages = OverloadQueue(loop=self._loop)
 
         # Stores PUBLISH messages ID received in order and ready for application process
-        self.delivered_message_queue = Queue(loop=self._loop)
+        self.delivered_message_queue = OverloadQueue(loop=self._loop)
+
+    def init_queues(self, delivered_size=0, delivered_policy=POLICY_BLOCK,
+                    retained_size=0, retained_policy=POLICY_DROP_OLDEST, counters=None, retained_messages=None):
+        """
+        Replace session queues with bounded queues. Must be called before the session is used.
+        :param delivered_size: size of the queue of messages received from the client
+        :param delivered_policy: overload policy of the queue of messages received from the client
+        :param retained_size: size of the queue of messages stored while the client is offline
+        :param retained_policy: overload policy of the queue of messages stored while the client is offline
+        :param counters: Counter shared by broker queues to count overload events
+        :param retained_messages: queue of messages stored while the client is offline, such as an
+            :class:`~hbmqtt.offline.OfflineMessageStore`. Built from retained_size and retained_policy if None
+        """
+        self.delivered_message_queue = OverloadQueue(
+            delivered_size, delivered_policy, 'session', counters, loop=self._loop)
+        if retained_messages is None:
+            retained_messages = OverloadQueue(retained_size, retained_policy, 'offline', counters, loop=self._loop)
+        self.retained_messages = retained_messages
+
+    def resume(self, session):
+        """
+        Take the properties of a new connection resuming this session: credentials, will message and keep alive
+        :param session: session built from the CONNECT packet of the new connection
+        """
+        self.username = session.username
+        self.password = session.password
+        self.will_flag = session.will_flag
+        self.will_retain = session.will_retain
+        self.will_qos = session.will_qos
+        self.will_topic = session.will_topic
+        self.will_message = session.will_message
+        self.keep_alive = session.keep_alive
+
+    def persistent_state(self):
+        """
+        State of a persistent session saved by the broker between runs, except subscriptions: identity, packet ID
+        counter, messages in flight and messages stored in memory while the client is offline. Messages spooled to
+        disk stay in the segment files of the offline store. See :mod:`hbmqtt.session_codec` for its encoding.
+        :return: dict of plain values
+        """
+        if isinstance(self.retained_messages, OfflineMessageStore):
+            messages = self.retained_messages.memory_records()
+        else:
+            messages = []
+        return {
+            'client_id': self.client_id,
+            'username': self.username,
+            'packet_id': self._packet_id,
+            'inflight_out': [(message.packet_id, message.topic, message.qos, message.data, message.retain,
+                              message.sent, message.pubrel_packet is not None)
+                             for message in self.inflight_out.values()],
+            'inflight_in': [(message.packet_id, message.topic, message.qos, message.data, message.retain)
+                            for message in self.inflight_in.values()],
+            'messages': messages,
+        }
+
+    def restore_state(self, state):
+        """
+        Restore state returned by :meth:`persistent_state`. In flight messages are retried when the client connects.
+        :param state: saved state
+        """
+        self._packet_id = state['packet_id']
+        for packet_id, topic, qos, data, retain, published, released in state['inflight_out']:
+            message = OutgoingApplicationMessage(packet_id, topic, qos, data, retain)
+            if published:
+                # Retried with DUP flag set
+                message.publish_packet = message.build_publish_packet()
+            if released:
+                # PUBREC already received, retry sends PUBREL
+                message.pubrec_packet = PubrecPacket.build(packet_id)
+                message.pubrel_packet = PubrelPacket.build(packet_id)
+            self.inflight_out[packet_id] = message
+        for packet_id, topic, qos, data, retain in state['inflight_in']:
+            message = IncomingApplicationMessage(packet_id, topic, qos, data, retain)
+            message.publish_packet = PublishPacket.build(topic, data, packet_id, False, qos, retain)
+            self.inflight_in[packet_id] = message
+        if state['messages'] and isinstance(self.retained_messages, OfflineMessageStore):
+            self.retained_messages.restore_records(state['messages'])
 
     def _init_states(self):
         self.transitions = Machine(states=Session.states, initial='new')
@@ -173,14 +283,16 @@ class Session:
         state = self.__dict__.copy()
         # Remove the unpicklable entries.
         # del state['transitions']
+        del state['_loop']
         del state['retained_messages']
         del state['delivered_message_queue']
         return state
 
-    def __setstate(self, state):
+    def __setstate__(self, state):
         self.__dict__.update(state)
-        self.retained_messages = Queue()
-        self.delivered_message_queue = Queue()
+        self._loop = asyncio.get_event_loop()
+        self.retained_messages = OverloadQueue(loop=self._loop)
+        self.delivered_message_queue = OverloadQueue(loop=self._loop)
 
     def __eq__(self, other):
         return self.client_id == other.client_id
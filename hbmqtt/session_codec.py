@@ -0,0 +1,223 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Binary encoding of persistent session state saved between broker runs.
+
+Unlike pickle, the encoding only holds plain values and doesn't depend on the classes of the session objects. Each
+record starts with a version byte, so that records written by a previous version can still be read.
+
+State record (version 1), integers in network byte order::
+
+    version (B) | packet ID counter (H) | client ID (str) | username (str)
+    topics count (I) | topics (str)
+    payloads count (I) | payloads: length (I), bytes
+    outgoing in flight count (H) | messages: packet ID (H), flags (B), topic index (I), payload index (I)
+    incoming in flight count (H) | messages: packet ID (H), flags (B), topic index (I), payload index (I)
+    offline messages count (I) | messages: QoS (B, 255 if none), topic index (I), payload index (I)
+
+Strings are UTF-8 encoded, prefixed with their length (H), 0xFFFF for None. Topics and payloads are stored once
+and referenced by index from messages, whose records have a fixed size. Message flags hold the QoS in bits 0-1, the
+retain flag in bit 2, and for outgoing messages whether the PUBLISH has been sent in bit 3 and whether the PUBREC
+has been received in bit 4.
+
+Subscriptions record (version 1)::
+
+    version (B) | subscriptions count (I) | subscriptions: QoS (B), filter (str)
+"""
+from struct import Struct
+
+from hbmqtt.errors import CodecException
+
+VERSION = 1
+
+_NONE_LENGTH = 0xFFFF
+_NO_QOS = 255
+
+_FLAG_RETAIN = 0x04
+_FLAG_PUBLISHED = 0x08
+_FLAG_RELEASED = 0x10
+
+_header = Struct('!BH')
+_byte = Struct('!B')
+_short = Struct('!H')
+_long = Struct('!I')
+_inflight = Struct('!HBII')
+_offline = Struct('!BII')
+
+
+def _pack_string(parts, value):
+    if value is None:
+        parts.append(_short.pack(_NONE_LENGTH))
+    else:
+        encoded = value.encode('utf-8')
+        parts.append(_short.pack(len(encoded)))
+        parts.append(encoded)
+
+
+class _Reader:
+    """
+    Decoding cursor with bounds checks
+    """
+    __slots__ = ('data', 'offset')
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt):
+        end = self.offset + fmt.size
+        if end > len(self.data):
+            raise CodecException("Truncated session record")
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset = end
+        return values
+
+    def read(self, length):
+        end = self.offset + length
+        if end > len(self.data):
+            raise CodecException("Truncated session record")
+        value = self.data[self.offset:end]
+        self.offset = end
+        return value
+
+    def records(self, fmt, count):
+        return fmt.iter_unpack(self.read(fmt.size * count))
+
+    def string(self):
+        length, = self.unpack(_short)
+        if length == _NONE_LENGTH:
+            return None
+        try:
+            return str(self.read(length), 'utf-8')
+        except UnicodeDecodeError:
+            raise CodecException("Invalid UTF-8 string in session record")
+
+    def version(self):
+        version, = self.unpack(_byte)
+        if version != VERSION:
+            raise CodecException("Unsupported session record version %d" % version)
+
+
+def _payload(data):
+    if type(data) is bytes:
+        return data
+    return bytes(data) if data is not None else b''
+
+
+class _Table(dict):
+    """
+    Values stored once in a record, by index
+    """
+
+    def index(self, value):
+        index = self.get(value)
+        if index is None:
+            index = len(self)
+            self[value] = index
+        return index
+
+
+def encode_state(state):
+    """
+    Encode session state
+    :param state: state returned by :meth:`hbmqtt.session.Session.persistent_state`
+    :return: bytes
+    """
+    topics = _Table()
+    payloads = _Table()
+    message_parts = [_short.pack(len(state['inflight_out']))]
+    for packet_id, topic, qos, data, retain, published, released in state['inflight_out']:
+        flags = qos | (_FLAG_RETAIN if retain else 0) | (_FLAG_PUBLISHED if published else 0) | \
+            (_FLAG_RELEASED if released else 0)
+        message_parts.append(_inflight.pack(packet_id, flags, topics.index(topic), payloads.index(_payload(data))))
+    message_parts.append(_short.pack(len(state['inflight_in'])))
+    for packet_id, topic, qos, data, retain in state['inflight_in']:
+        message_parts.append(_inflight.pack(packet_id, qos | (_FLAG_RETAIN if retain else 0),
+                                            topics.index(topic), payloads.index(_payload(data))))
+    message_parts.append(_long.pack(len(state['messages'])))
+    for topic, data, qos in state['messages']:
+        message_parts.append(_offline.pack(qos if qos is not None else _NO_QOS,
+                                           topics.index(topic), payloads.index(_payload(data))))
+
+    parts = [_header.pack(VERSION, state['packet_id'])]
+    _pack_string(parts, state['client_id'])
+    _pack_string(parts, state['username'])
+    parts.append(_long.pack(len(topics)))
+    for topic in topics:
+        _pack_string(parts, topic)
+    parts.append(_long.pack(len(payloads)))
+    for data in payloads:
+        parts.append(_long.pack(len(data)))
+        parts.append(data)
+    parts.extend(message_parts)
+    return b''.join(parts)
+
+
+def decode_state(data):
+    """
+    Decode session state encoded by :func:`encode_state`
+    :param data: bytes-like object
+    :return: state, as returned by :meth:`hbmqtt.session.Session.persistent_state`
+    """
+    reader = _Reader(data)
+    reader.version()
+    packet_id, = reader.unpack(_short)
+    state = {
+        'packet_id': packet_id,
+        'client_id': reader.string(),
+        'username': reader.string(),
+    }
+    count, = reader.unpack(_long)
+    topics = [reader.string() for i in range(count)]
+    count, = reader.unpack(_long)
+    payloads = []
+    for i in range(count):
+        length, = reader.unpack(_long)
+        payloads.append(bytes(reader.read(length)))
+    try:
+        count, = reader.unpack(_short)
+        state['inflight_out'] = [
+            (packet_id, topics[topic], flags & 0x03, payloads[payload], bool(flags & _FLAG_RETAIN),
+             bool(flags & _FLAG_PUBLISHED), bool(flags & _FLAG_RELEASED))
+            for packet_id, flags, topic, payload in reader.records(_inflight, count)]
+        count, = reader.unpack(_short)
+        state['inflight_in'] = [
+            (packet_id, topics[topic], flags & 0x03, payloads[payload], bool(flags & _FLAG_RETAIN))
+            for packet_id, flags, topic, payload in reader.records(_inflight, count)]
+        count, = reader.unpack(_long)
+        state['messages'] = [
+            (topics[topic], payloads[payload], qos if qos != _NO_QOS else None)
+            for qos, topic, payload in reader.records(_offline, count)]
+    except IndexError:
+        raise CodecException("Invalid topic or payload index in session record")
+    return state
+
+
+def encode_subscriptions(subscriptions):
+    """
+    Encode session subscriptions
+    :param subscriptions: list of (filter, qos) tuples
+    :return: bytes
+    """
+    parts = [_byte.pack(VERSION), _long.pack(len(subscriptions))]
+    for a_filter, qos in subscriptions:
+        parts.append(_byte.pack(qos))
+        _pack_string(parts, a_filter)
+    return b''.join(parts)
+
+
+def decode_subscriptions(data):
+    """
+    Decode session subscriptions encoded by :func:`encode_subscriptions`
+    :param data: bytes-like object
+    :return: list of (filter, qos) tuples
+    """
+    reader = _Reader(data)
+    reader.version()
+    count, = reader.unpack(_long)
+    subscriptions = []
+    for i in range(count):
+        qos, = reader.unpack(_byte)
+        subscriptions.append((reader.string(), qos))
+    return subscriptions
@@ -0,0 +1,372 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+
+SINGLE_LEVEL_WILDCARD = '+'
+MULTI_LEVEL_WILDCARD = '#'
+
+
+def match_topic(topic, a_filter):
+    """
+    Check if a topic name matches a subscription filter, level by level, according to MQTT 3.1.1 (4.7)
+    :param topic: topic name
+    :param a_filter: topic filter, possibly containing '+' and '#' wildcards
+    :return: True if topic matches filter
+    """
+    if MULTI_LEVEL_WILDCARD not in a_filter and SINGLE_LEVEL_WILDCARD not in a_filter:
+        return a_filter == topic
+    if topic.startswith('$') and a_filter[0] in (SINGLE_LEVEL_WILDCARD, MULTI_LEVEL_WILDCARD):
+        # [MQTT-4.7.2-1]
+        return False
+    topic_levels = topic.split('/')
+    filter_levels = a_filter.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == MULTI_LEVEL_WILDCARD:
+            # '#' also matches the parent level
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != SINGLE_LEVEL_WILDCARD and level != topic_levels[index]:
+            return False
+    return len(topic_levels) == len(filter_levels)
+
+
+class _SubscriptionNode:
+
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = dict()
+        # client ID -> QoS
+        self.subscribers = dict()
+
+
+class SubscriptionTree:
+    """
+    Topic trie indexing subscriptions level by level.
+
+    Each node maps the client IDs subscribed to the filter ending at this node to their subscription QoS. Matching a
+    topic only follows the exact, '+' and '#' branches of each level, so its cost depends on the topic depth and on
+    the number of matching subscriptions, not on the total number of filters.
+
+    The tree doesn't index filters by client: callers keep the filters of each client (see ``Session.subscriptions``)
+    so that removing all subscriptions of a client only visits its own filters.
+    """
+
+    def __init__(self):
+        self._root = _SubscriptionNode()
+        self._count = 0
+
+    def _find_node(self, a_filter):
+        node = self._root
+        for level in a_filter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node
+
+    def add(self, a_filter, client_id, qos):
+        """
+        Add a subscription, or update the QoS of an existing one
+        :param a_filter: subscription filter
+        :param client_id: client ID of the subscribing session
+        :param qos: subscription QoS
+        :return: True if the subscription has been added, False if the client was already subscribed to the filter
+        """
+        node = self._root
+        for level in a_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = _SubscriptionNode()
+                node.children[level] = child
+            node = child
+        added = client_id not in node.subscribers
+        node.subscribers[client_id] = qos
+        if added:
+            self._count += 1
+        return added
+
+    def remove(self, a_filter, client_id):
+        """
+        Remove a subscription and prune the branch left empty
+        :param a_filter: subscription filter
+        :param client_id: client ID of the subscribed session
+        :return: True if a subscription has been removed
+        """
+        path = []
+        node = self._root
+        for level in a_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+        if client_id not in node.subscribers:
+            return False
+        del node.subscribers[client_id]
+        self._count -= 1
+        while path and not node.subscribers and not node.children:
+            parent, level = path.pop()
+            del parent.children[level]
+            node = parent
+        return True
+
+    def remove_all(self, client_id, filters):
+        """
+        Remove subscriptions of a client
+        :param client_id: client ID of the subscribed session
+        :param filters: filters the client has subscribed to
+        :return: list of filters removed
+        """
+        return [a_filter for a_filter in list(filters) if self.remove(a_filter, client_id)]
+
+    def match(self, topic):
+        """
+        Get subscriptions matching a topic name.
+        A client subscribed with several matching filters appears once per filter.
+        :param topic: published topic name
+        :return: list of (client_id, qos) tuples
+        """
+        matched = []
+        # [MQTT-4.7.2-1] wildcards at first level don't match topics starting with '$'
+        dollar_topic = topic.startswith('$')
+        nodes = [self._root]
+        for level in topic.split('/'):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if not (dollar_topic and node is self._root):
+                    wildcard = children.get(MULTI_LEVEL_WILDCARD)
+                    if wildcard is not None:
+                        matched.extend(wildcard.subscribers.items())
+                    child = children.get(SINGLE_LEVEL_WILDCARD)
+                    if child is not None:
+                        next_nodes.append(child)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                return matched
+            nodes = next_nodes
+        for node in nodes:
+            matched.extend(node.subscribers.items())
+            # '#' also matches the parent level
+            wildcard = node.children.get(MULTI_LEVEL_WILDCARD)
+            if wildcard is not None:
+                matched.extend(wildcard.subscribers.items())
+        return matched
+
+    def subscribers(self, a_filter):
+        """
+        Get subscriptions registered on a given filter
+        :param a_filter: subscription filter
+        :return: dict of client_id -> qos
+        """
+        node = self._find_node(a_filter)
+        if node is None:
+            return dict()
+        return dict(node.subscribers)
+
+    def qos(self, a_filter, client_id):
+        """
+        Get the QoS of a client subscription
+        :param a_filter: subscription filter
+        :param client_id: client ID of the subscribed session
+        :return: subscription QoS, or None if the client isn't subscribed to the filter
+        """
+        node = self._find_node(a_filter)
+        if node is None:
+            return None
+        return node.subscribers.get(client_id)
+
+    def subscribers_count(self, a_filter):
+        """
+        Get the number of clients subscribed to a given filter
+        """
+        node = self._find_node(a_filter)
+        if node is None:
+            return 0
+        return len(node.subscribers)
+
+    def _iter_nodes(self):
+        stack = [(None, self._root)]
+        while stack:
+            a_filter, node = stack.pop()
+            if node.subscribers:
+                yield a_filter, node
+            for level, child in node.children.items():
+                stack.append((level if a_filter is None else a_filter + '/' + level, child))
+
+    def items(self):
+        """
+        Iterate over subscribed filters
+        :return: generator of (filter, dict of client_id -> qos) tuples
+        """
+        for a_filter, node in self._iter_nodes():
+            yield a_filter, dict(node.subscribers)
+
+    def __iter__(self):
+        for a_filter, node in self._iter_nodes():
+            yield a_filter
+
+    def __contains__(self, a_filter):
+        node = self._find_node(a_filter)
+        return node is not None and bool(node.subscribers)
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return type(self).__name__ + '(%s)' % ', '.join(
+            '%s=%r' % (a_filter, subscriptions) for a_filter, subscriptions in self.items())
+
+
+class _RetainedNode:
+
+    __slots__ = ('children', 'message')
+
+    def __init__(self):
+        self.children = dict()
+        self.message = None
+
+
+class RetainedMessageTree:
+    """
+    Topic trie storing the last retained message of each topic.
+
+    Looking up a subscription filter only visits the subtree matching the filter, instead of every retained topic.
+    Messages stored are expected to expose the retained payload as a ``data`` attribute.
+    """
+
+    def __init__(self):
+        self._root = _RetainedNode()
+        self._count = 0
+        self._bytes = 0
+
+    def set(self, topic, message):
+        """
+        Store the retained message of a topic, replacing the previous one
+        :param topic: topic name
+        :param message: retained message
+        """
+        node = self._root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = _RetainedNode()
+                node.children[level] = child
+            node = child
+        if node.message is None:
+            self._count += 1
+        else:
+            self._bytes -= len(node.message.data)
+        node.message = message
+        self._bytes += len(message.data)
+
+    def get(self, topic):
+        """
+        Get the retained message of a topic
+        :param topic: topic name
+        :return: retained message or None
+        """
+        node = self._root
+        for level in topic.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node.message
+
+    def delete(self, topic):
+        """
+        Clear the retained message of a topic and prune the branch left empty
+        :param topic: topic name
+        :return: True if a retained message has been deleted
+        """
+        path = []
+        node = self._root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+        if node.message is None:
+            return False
+        self._count -= 1
+        self._bytes -= len(node.message.data)
+        node.message = None
+        while path and node.message is None and not node.children:
+            parent, level = path.pop()
+            del parent.children[level]
+            node = parent
+        return True
+
+    def _children(self, node):
+        if node is self._root:
+            # [MQTT-4.7.2-1] wildcards at first level don't match topics starting with '$'
+            return [child for level, child in node.children.items() if not level.startswith('$')]
+        return list(node.children.values())
+
+    @staticmethod
+    def _subtree_messages(node, messages):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.message is not None:
+                messages.append(node.message)
+            stack.extend(node.children.values())
+
+    def match(self, a_filter):
+        """
+        Get retained messages whose topic matches a subscription filter
+        :param a_filter: subscription filter, possibly containing '+' and '#' wildcards
+        :return: list of retained messages
+        """
+        messages = []
+        nodes = [self._root]
+        for level in a_filter.split('/'):
+            if level == MULTI_LEVEL_WILDCARD:
+                for node in nodes:
+                    # '#' also matches the parent level
+                    if node.message is not None:
+                        messages.append(node.message)
+                    for child in self._children(node):
+                        self._subtree_messages(child, messages)
+                return messages
+            next_nodes = []
+            for node in nodes:
+                if level == SINGLE_LEVEL_WILDCARD:
+                    next_nodes.extend(self._children(node))
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            if not next_nodes:
+                return messages
+            nodes = next_nodes
+        for node in nodes:
+            if node.message is not None:
+                messages.append(node.message)
+        return messages
+
+    @property
+    def stored_bytes(self):
+        """
+        Total payload size of retained messages
+        """
+        return self._bytes
+
+    def __iter__(self):
+        stack = [(None, self._root)]
+        while stack:
+            topic, node = stack.pop()
+            if node.message is not None:
+                yield topic
+            for level, child in node.children.items():
+                stack.append((level if topic is None else topic + '/' + level, child))
+
+    def __contains__(self, topic):
+        return self.get(topic) is not None
+
+    def __len__(self):
+        return self._count
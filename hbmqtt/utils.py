@@ -2,6 +2,9 @@
 #
 # See the file license.txt for copying permission.
 import logging
+import os
+import time
+from collections import OrderedDict
 
 import yaml
 
@@ -44,6 +47,49 @@ def gen_client_id():
     return gen_id
 
 
+class LRUCache:
+    """
+    Bounded mapping evicting least recently used entries, with an optional time to live
+    :param maxsize: maximum number of entries
+    :param ttl: entries lifetime in seconds, entries don't expire if 0
+    """
+
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires_at, value = self._entries[key]
+        except KeyError:
+            return default
+        if expires_at and expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 def read_yaml_config(config_file):
     config = None
     try:
@@ -59,3 +105,91 @@ def write_yaml_config(data, config_file):
             yaml.dump(data, stream, default_flow_style=False)
     except yaml.YAMLError as exc:
         logger.error("Error writing YAML to %s: %s" % (config_file, exc))
+
+
+class YamlFileStore:
+    """
+    Parsed content of a YAML file, shared by all plugins using the same file.
+
+    Plugins read and change :attr:`data` in memory and call :meth:`write` to save it. :meth:`refresh` reloads the
+    file only if it was changed by another process, which is detected by comparing its inode, modification time
+    and size with the ones of the last read or write. Unless forced, these are checked at most once every
+    ``check_interval`` seconds. :attr:`version` is incremented each time the file is read or written, so
+    structures derived from data can be rebuilt when it changed.
+
+    :param path: YAML file path
+    :param check_interval: minimum delay in seconds between two file checks
+    """
+    _stores = dict()
+
+    def __init__(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.data = dict()
+        self.version = 0
+        self._stat = None
+        self._checked_at = 0
+        self.reload()
+
+    @classmethod
+    def open(cls, path, check_interval=1):
+        """
+        Get the store of a file, creating it on first use
+        """
+        key = os.path.realpath(path)
+        if key not in cls._stores:
+            cls._stores[key] = cls(path, check_interval)
+        return cls._stores[key]
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self, check_now=False):
+        """
+        Reload the file if it changed since last read or write
+        :param check_now: check the file even if it was checked less than ``check_interval`` seconds ago
+        :return: True if the file was reloaded
+        """
+        now = time.monotonic()
+        if not check_now and now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        if self._file_stat() == self._stat:
+            return False
+        return self.reload()
+
+    def reload(self):
+        """
+        Read the file again
+        :return: True if the file was read
+        """
+        stat = self._file_stat()
+        if stat is None or stat[2] == 0:
+            content = dict()
+        else:
+            try:
+                content = read_yaml_config(self.path)
+            except FileNotFoundError:
+                content = dict()
+            if content is None:
+                # Unreadable, maybe being written: keep current data and try again on next check
+                self._stat = None
+                return False
+        self._stat = stat
+        # Update data in place, plugins may hold references to it
+        self.data.clear()
+        self.data.update(content)
+        self.version += 1
+        return True
+
+    def write(self):
+        """
+        Save data to the file
+        """
+        write_yaml_config(self.data, self.path)
+        self._stat = self._file_stat()
+        self.version += 1
@@ -0,0 +1,608 @@
+# Copyright (c) 2015 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Multi-process broker.
+
+The master process forks worker processes, each running a :class:`~hbmqtt.broker.Broker` on its own event loop.
+Workers bind the configured listeners with SO_REUSEPORT so the kernel spreads incoming connections among them.
+
+Workers are connected to a routing bus served by the master process on a Unix socket. Each worker publishes a
+digest of its subscriptions (the filters having at least one local subscriber), and the bus only forwards a
+PUBLISH to the workers whose digest matches the topic. Retained messages are replicated to every worker, and
+changes made to the users and ACL files by the ``registration`` flow are serialized with a lock held on the bus.
+
+Sessions are local to workers, and the kernel may send a client reconnecting to any worker. The hub keeps track of
+the worker owning each client ID: a worker accepting a CONNECT claims its client ID on the bus, and the hub asks the
+previous owner to disconnect the client if it is still connected [MQTT-3.1.4-2] and to hand its persistent session
+over. The session, its subscriptions, messages in flight and offline messages move to the worker of the new
+connection before CONNACK is sent.
+
+The hub doesn't wait for slow workers: once more than ``workers-bus-buffer`` bytes are waiting to be written to a
+worker, PUBLISH messages forwarded to it are dropped until it catches up. Workers losing the bus reconnect to it,
+and stop if the hub is gone.
+
+Frames are unpickled, so the bus socket is only accessible to the user running the broker: it is created with mode
+0600, by default in a private temporary directory.
+"""
+import asyncio
+import copy
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+from collections import deque
+
+from hbmqtt.session_codec import encode_state, decode_state, encode_subscriptions, decode_subscriptions
+from hbmqtt.topics import SubscriptionTree
+
+
+BUS_HELLO = 'hello'
+BUS_SUBSCRIBE = 'subscribe'
+BUS_UNSUBSCRIBE = 'unsubscribe'
+BUS_PUBLISH = 'publish'
+BUS_RETAIN = 'retain'
+BUS_IDENTITIES = 'identities'
+BUS_ACQUIRE = 'acquire'
+BUS_GRANTED = 'granted'
+BUS_RELEASE = 'release'
+BUS_CLAIM = 'claim'
+BUS_CLAIMED = 'claimed'
+BUS_OWN = 'own'
+BUS_TAKEOVER = 'takeover'
+BUS_HANDOVER = 'handover'
+
+DEFAULT_BUS_BUFFER = 4 * 1024 * 1024
+DEFAULT_CLAIM_TIMEOUT = 10
+
+_frame_header = struct.Struct('!I')
+
+
+def _payload(data):
+    # Payloads received by the broker are memoryviews, which can't be pickled
+    if data is None or type(data) is bytes:
+        return data
+    return bytes(data)
+
+
+def _encode_message(message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return _frame_header.pack(len(data)) + data
+
+
+@asyncio.coroutine
+def _read_frame(reader):
+    header = yield from reader.readexactly(_frame_header.size)
+    return (yield from reader.readexactly(_frame_header.unpack(header)[0]))
+
+
+class _BusPeer:
+    """
+    Worker connected to the bus hub. ``client_id`` is the worker ID so that worker digests can be stored in a
+    :class:`~hbmqtt.topics.SubscriptionTree`, ``filters`` is the worker digest. ``dropped`` counts PUBLISH messages
+    not forwarded to the worker since its write buffer is full.
+    """
+
+    __slots__ = ('client_id', 'writer', 'filters', 'dropped')
+
+    def __init__(self, client_id, writer):
+        self.client_id = client_id
+        self.writer = writer
+        self.filters = set()
+        self.dropped = 0
+
+
+class BusHub:
+    """
+    Routing bus run by the master process
+
+    :param path: Unix socket path
+    :param max_buffer: bytes waiting to be written to a worker above which PUBLISH messages forwarded to it are
+        dropped, unlimited if <= 0
+    :param loop: asyncio loop to use. Defaults to ``asyncio.get_event_loop()`` if none is given
+    """
+
+    def __init__(self, path, max_buffer=DEFAULT_BUS_BUFFER, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self._max_buffer = max_buffer
+        if loop is not None:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self._server = None
+        self._peers = dict()
+        self._peer_tasks = set()
+        self._digests = SubscriptionTree()
+        # Lock name -> peers waiting for the lock, the first one holds it
+        self._locks = dict()
+        # Client ID -> ID of the worker owning its session
+        self._owners = dict()
+        # Client ID -> (claiming worker ID, owning worker ID) while the session is handed over
+        self._claims = dict()
+
+    @asyncio.coroutine
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            # Restricted before listening, connections can't be accepted before
+            os.chmod(self.path, 0o600)
+        except OSError:
+            sock.close()
+            raise
+        self._server = yield from asyncio.start_unix_server(self._peer_connected, sock=sock, loop=self._loop)
+        self.logger.debug("Bus listening on %s" % self.path)
+
+    @asyncio.coroutine
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            yield from self._server.wait_closed()
+        for task in self._peer_tasks:
+            task.cancel()
+        if self._peer_tasks:
+            yield from asyncio.wait(self._peer_tasks, loop=self._loop)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    @asyncio.coroutine
+    def _peer_connected(self, reader, writer):
+        try:
+            hello = pickle.loads((yield from _read_frame(reader)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        peer = _BusPeer(hello['worker'], writer)
+        previous = self._peers.get(peer.client_id)
+        if previous is not None:
+            # Worker reconnected before its previous connection was found closed
+            self._remove_peer(previous)
+        self._peers[peer.client_id] = peer
+        task = asyncio.Task.current_task(loop=self._loop)
+        self._peer_tasks.add(task)
+        self.logger.info("Worker %s connected to bus" % peer.client_id)
+        try:
+            while True:
+                frame = yield from _read_frame(reader)
+                self._dispatch(peer, frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.logger.info("Worker %s disconnected from bus" % peer.client_id)
+        finally:
+            self._peer_tasks.discard(task)
+            if self._peers.get(peer.client_id) is peer:
+                self._remove_peer(peer)
+
+    def _remove_peer(self, peer):
+        del self._peers[peer.client_id]
+        self._digests.remove_all(peer.client_id, peer.filters)
+        for name in list(self._locks):
+            self._release(peer, name)
+        for client_id, (claimer, owner) in list(self._claims.items()):
+            if owner == peer.client_id:
+                # The session is lost with the worker connection, the claiming worker creates a new one
+                self._hand_over(client_id, None)
+        peer.writer.close()
+
+    def _dispatch(self, peer, frame):
+        message = pickle.loads(frame)
+        kind = message['type']
+        if kind == BUS_PUBLISH:
+            # Only forward to workers having at least one matching subscription
+            targets = set(self._peers[client_id] for (client_id, qos) in self._digests.match(message['topic'])
+                          if client_id != peer.client_id)
+            self._forward(frame, targets, droppable=True)
+        elif kind == BUS_SUBSCRIBE:
+            self._digests.add(message['filter'], peer.client_id, 0)
+            peer.filters.add(message['filter'])
+        elif kind == BUS_UNSUBSCRIBE:
+            self._digests.remove(message['filter'], peer.client_id)
+            peer.filters.discard(message['filter'])
+        elif kind in (BUS_RETAIN, BUS_IDENTITIES):
+            self._forward(frame, [target for target in self._peers.values() if target is not peer])
+        elif kind == BUS_ACQUIRE:
+            waiters = self._locks.setdefault(message['name'], deque())
+            waiters.append(peer)
+            if len(waiters) == 1:
+                peer.writer.write(_encode_message({'type': BUS_GRANTED, 'name': message['name']}))
+        elif kind == BUS_RELEASE:
+            self._release(peer, message['name'])
+        elif kind == BUS_CLAIM:
+            self._claim(peer, message['client_id'], message['clean'])
+        elif kind == BUS_OWN:
+            owner = self._owners.setdefault(message['client_id'], peer.client_id)
+            if owner != peer.client_id and owner in self._peers:
+                # Claimed by another worker while this one was disconnected from the bus, drop its session
+                peer.writer.write(_encode_message(
+                    {'type': BUS_TAKEOVER, 'client_id': message['client_id'], 'clean': True}))
+        elif kind == BUS_HANDOVER:
+            if self._claims.get(message['client_id'], (None, None))[1] == peer.client_id:
+                self._hand_over(message['client_id'], message['session'])
+        else:
+            self.logger.warning("Unknown bus message type '%s' from worker %s" % (kind, peer.client_id))
+
+    def _forward(self, frame, targets, droppable=False):
+        # Forwarding can't wait for every target to drain without letting the slowest worker stall all others:
+        # the transport write buffer is bounded by dropping PUBLISH messages instead. Other messages change the
+        # state of workers, they are small and rare and are always forwarded.
+        data = _frame_header.pack(len(frame)) + frame
+        for target in targets:
+            if droppable:
+                if 0 < self._max_buffer < target.writer.transport.get_write_buffer_size():
+                    if not target.dropped:
+                        self.logger.warning("Bus buffer of worker %s is full, dropping messages forwarded to it" %
+                                            target.client_id)
+                    target.dropped += 1
+                    continue
+                if target.dropped:
+                    self.logger.info("Worker %s caught up with the bus, %d messages were dropped" %
+                                     (target.client_id, target.dropped))
+                    target.dropped = 0
+            target.writer.write(data)
+
+    def _claim(self, peer, client_id, clean_session):
+        owner = self._owners.get(client_id)
+        self._owners[client_id] = peer.client_id
+        previous = self._claims.get(client_id)
+        if previous is not None:
+            # Claimed again while the session is handed over: it goes to the last connection, the previous claim
+            # goes on without it
+            self._hand_over(client_id, None)
+            self._claims[client_id] = (peer.client_id, previous[1])
+            return
+        if owner is None or owner == peer.client_id or owner not in self._peers:
+            peer.writer.write(_encode_message({'type': BUS_CLAIMED, 'client_id': client_id, 'session': None}))
+            return
+        self._claims[client_id] = (peer.client_id, owner)
+        self._peers[owner].writer.write(
+            _encode_message({'type': BUS_TAKEOVER, 'client_id': client_id, 'clean': clean_session}))
+
+    def _hand_over(self, client_id, session):
+        claimer = self._peers.get(self._claims.pop(client_id)[0])
+        if claimer is not None:
+            claimer.writer.write(_encode_message({'type': BUS_CLAIMED, 'client_id': client_id, 'session': session}))
+
+    def _release(self, peer, name):
+        waiters = self._locks.get(name)
+        if not waiters:
+            return
+        if waiters[0] is peer:
+            waiters.popleft()
+            if waiters:
+                waiters[0].writer.write(_encode_message({'type': BUS_GRANTED, 'name': name}))
+            else:
+                del self._locks[name]
+        else:
+            try:
+                waiters.remove(peer)
+            except ValueError:
+                pass
+
+
+class BrokerBus:
+    """
+    Worker side of the routing bus, given to :class:`~hbmqtt.broker.Broker` with the ``bus`` parameter
+
+    When the connection to the hub is lost, the bus reconnects and sends the worker digest again. If the hub can't
+    be reached, the event loop of the worker is stopped.
+
+    :param path: Unix socket path of the bus hub
+    :param worker: worker ID
+    :param loop: asyncio loop to use. Defaults to ``asyncio.get_event_loop()`` if none is given
+    """
+
+    def __init__(self, path, worker, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.worker = worker
+        if loop is not None:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self._broker = None
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._grants = dict()
+        self._filters = set()
+        # Client IDs whose session is on this worker
+        self._clients = set()
+        # Client ID -> (future, clean session flag) of pending claims
+        self._claims = dict()
+        self._takeover_tasks = set()
+
+    @asyncio.coroutine
+    def connect(self, broker, retries=50):
+        """
+        Connect to the bus hub, waiting for it to be started
+        :param broker: broker receiving messages from other workers
+        :param retries: number of connection attempts, 100ms apart
+        """
+        self._broker = broker
+        yield from self._open(retries)
+        self._reader_task = asyncio.ensure_future(self._reader_loop(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _open(self, retries):
+        for attempt in range(retries):
+            try:
+                self._reader, self._writer = yield from asyncio.open_unix_connection(self.path, loop=self._loop)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == retries - 1:
+                    raise
+                yield from asyncio.sleep(0.1, loop=self._loop)
+        self._send({'type': BUS_HELLO, 'worker': self.worker})
+        # Restore the state the hub dropped with the previous connection
+        for a_filter in self._filters:
+            self._send({'type': BUS_SUBSCRIBE, 'filter': a_filter})
+        for name, future in self._grants.items():
+            if not future.done():
+                self._send({'type': BUS_ACQUIRE, 'name': name})
+        for client_id in self._clients:
+            self._send({'type': BUS_OWN, 'client_id': client_id})
+        for client_id, (future, clean_session) in self._claims.items():
+            if not future.done():
+                self._send({'type': BUS_CLAIM, 'client_id': client_id, 'clean': clean_session})
+
+    @asyncio.coroutine
+    def _reconnect(self, retries=50):
+        self._writer.close()
+        self._reader, self._writer = None, None
+        try:
+            yield from self._open(retries)
+        except OSError as e:
+            self.logger.error("Worker %s can't reconnect to bus: %r, stopping" % (self.worker, e))
+            self._loop.stop()
+            return False
+        self.logger.info("Worker %s reconnected to bus" % self.worker)
+        return True
+
+    @asyncio.coroutine
+    def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for future in self._grants.values():
+            if not future.done():
+                future.cancel()
+        self._grants = dict()
+        for task in self._takeover_tasks:
+            task.cancel()
+
+    def _send(self, message):
+        if self._writer is not None:
+            self._writer.write(_encode_message(message))
+
+    def subscribe(self, a_filter):
+        """
+        Add a filter to the worker digest
+        """
+        self._filters.add(a_filter)
+        self._send({'type': BUS_SUBSCRIBE, 'filter': a_filter})
+
+    def unsubscribe(self, a_filter):
+        """
+        Remove a filter from the worker digest
+        """
+        self._filters.discard(a_filter)
+        self._send({'type': BUS_UNSUBSCRIBE, 'filter': a_filter})
+
+    @asyncio.coroutine
+    def publish(self, topic, data, qos=None):
+        """
+        Send a message published on this worker to the workers having matching subscriptions
+        """
+        self._send({'type': BUS_PUBLISH, 'topic': topic, 'data': _payload(data), 'qos': qos})
+        if self._writer is not None:
+            try:
+                yield from self._writer.drain()
+            except ConnectionError:
+                # Lost connection is handled by the reader loop
+                pass
+
+    def retain(self, topic, data, qos=None):
+        """
+        Replicate a retained message (or its deletion when data is empty) to the other workers
+        """
+        self._send({'type': BUS_RETAIN, 'topic': topic, 'data': _payload(data), 'qos': qos})
+
+    def identities_changed(self):
+        """
+        Notify other workers that the users or ACL files have been written
+        """
+        self._send({'type': BUS_IDENTITIES})
+
+    @asyncio.coroutine
+    def acquire(self, name):
+        """
+        Acquire a lock shared by all workers
+        """
+        future = asyncio.Future(loop=self._loop)
+        self._grants[name] = future
+        self._send({'type': BUS_ACQUIRE, 'name': name})
+        try:
+            yield from future
+        finally:
+            self._grants.pop(name, None)
+
+    def release(self, name):
+        self._send({'type': BUS_RELEASE, 'name': name})
+
+    @asyncio.coroutine
+    def claim(self, client_id, clean_session, timeout=DEFAULT_CLAIM_TIMEOUT):
+        """
+        Register a client ID connecting to this worker. A client connected to another worker with the same ID is
+        disconnected, and its persistent session is handed over unless ``clean_session`` is set.
+        :param client_id: client ID
+        :param clean_session: clean session flag of the connection
+        :param timeout: delay in seconds after which the connection goes on without the session of the other worker
+        :return: (subscriptions, state) of the session handed over, None if there is none
+        """
+        future = asyncio.Future(loop=self._loop)
+        self._claims[client_id] = (future, clean_session)
+        self._send({'type': BUS_CLAIM, 'client_id': client_id, 'clean': clean_session})
+        try:
+            session = yield from asyncio.wait_for(future, timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            self.logger.warning("Worker %s: client ID %s not released by other workers within %s seconds" %
+                                (self.worker, client_id, timeout))
+            session = None
+        finally:
+            if self._claims.get(client_id, (None, None))[0] is future:
+                del self._claims[client_id]
+        self._clients.add(client_id)
+        if session is None:
+            return None
+        subscriptions, state = session
+        return decode_subscriptions(subscriptions), decode_state(state)
+
+    def own(self, client_id):
+        """
+        Register the client ID of a session restored by this worker
+        """
+        self._clients.add(client_id)
+        self._send({'type': BUS_OWN, 'client_id': client_id})
+
+    @asyncio.coroutine
+    def _takeover(self, client_id, clean_session):
+        self._clients.discard(client_id)
+        session = None
+        try:
+            handed_over = yield from self._broker.bus_takeover(client_id, clean_session)
+            if handed_over is not None:
+                subscriptions, state = handed_over
+                session = (encode_subscriptions(subscriptions), encode_state(state))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error("Worker %s: client ID %s takeover failed: %r" % (self.worker, client_id, e))
+        self._send({'type': BUS_HANDOVER, 'client_id': client_id, 'session': session})
+
+    @asyncio.coroutine
+    def _reader_loop(self):
+        try:
+            while True:
+                try:
+                    frame = yield from _read_frame(self._reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    self.logger.error("Worker %s lost connection to bus" % self.worker)
+                    if (yield from self._reconnect()):
+                        continue
+                    return
+                message = pickle.loads(frame)
+                kind = message['type']
+                if kind == BUS_PUBLISH:
+                    yield from self._broker.bus_message_broadcast(message['topic'], message['data'], message['qos'])
+                elif kind == BUS_RETAIN:
+                    self._broker.retain_message(None, message['topic'], message['data'], message['qos'])
+                elif kind == BUS_IDENTITIES:
+                    yield from self._broker.bus_identities_changed()
+                elif kind == BUS_GRANTED:
+                    future = self._grants.get(message['name'])
+                    if future is not None and not future.done():
+                        future.set_result(True)
+                elif kind == BUS_CLAIMED:
+                    future = self._claims.get(message['client_id'], (None, None))[0]
+                    if future is not None and not future.done():
+                        future.set_result(message['session'])
+                elif kind == BUS_TAKEOVER:
+                    # Not awaited, the client disconnection waits for its messages to be stored
+                    task = asyncio.ensure_future(
+                        self._takeover(message['client_id'], message['clean']), loop=self._loop)
+                    self._takeover_tasks.add(task)
+                    task.add_done_callback(self._takeover_tasks.discard)
+        except asyncio.CancelledError:
+            pass
+
+
+def _run_worker(config, worker, bus_path):
+    from hbmqtt.broker import Broker
+
+    # The master process stops workers with SIGTERM on interruption
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if config.get('offline-spool-dir', None):
+        # Sessions are local to workers, so are their offline messages
+        config = dict(config)
+        config['offline-spool-dir'] = os.path.join(config['offline-spool-dir'], 'worker-%d' % worker)
+    if config.get('retained-dir', None):
+        # Retained messages are replicated to all workers, each one saves its copy
+        config = dict(config)
+        config['retained-dir'] = os.path.join(config['retained-dir'], 'worker-%d' % worker)
+    if config.get('persistence', None) and config['persistence'].get('file', None):
+        # Persistent sessions are restored by the worker which saved them
+        config = dict(config)
+        root, ext = os.path.splitext(config['persistence']['file'])
+        config['persistence'] = dict(config['persistence'], file='%s.worker-%d%s' % (root, worker, ext))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    broker = Broker(config, loop=loop, bus=BrokerBus(bus_path, worker, loop=loop))
+    try:
+        loop.run_until_complete(broker.start())
+        loop.run_forever()
+    finally:
+        if broker.transitions.state == 'started':
+            loop.run_until_complete(broker.shutdown())
+        loop.close()
+
+
+def run_workers(config, workers):
+    """
+    Run the broker in ``workers`` processes sharing the configured listeners, until interrupted
+    :param config: broker configuration
+    :param workers: number of worker processes
+    """
+    logger = logging.getLogger(__name__)
+    bus_path = config.get('workers-bus', None)
+    bus_dir = None
+    if not bus_path:
+        # Private directory (mode 0700), its path can't be guessed
+        bus_dir = tempfile.mkdtemp(prefix='hbmqtt-bus-')
+        bus_path = os.path.join(bus_dir, 'bus.sock')
+
+    worker_config = dict(config)
+    worker_config['listeners'] = copy.deepcopy(config['listeners'])
+    for listener in worker_config['listeners'].values():
+        listener['reuse_port'] = True
+
+    # Fork workers before the master event loop exists, they connect to the bus once it is started
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for worker in range(workers):
+        process = context.Process(target=_run_worker, args=(worker_config, worker, bus_path),
+                                  name='hbmqtt-worker-%d' % worker)
+        process.start()
+        processes.append(process)
+        logger.info("Worker %d started (pid=%d)" % (worker, process.pid))
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    hub = BusHub(bus_path, config.get('workers-bus-buffer', DEFAULT_BUS_BUFFER), loop=loop)
+    try:
+        loop.run_until_complete(hub.start())
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        loop.run_until_complete(hub.close())
+        loop.close()
+        if bus_dir is not None:
+            shutil.rmtree(bus_dir, ignore_errors=True)